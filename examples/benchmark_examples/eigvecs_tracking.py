@@ -0,0 +1,65 @@
+"""
+This is a benchmark of the eigenvector tracking of the FSSH algorithm.
+
+It times FSSH simulations of models with an increasing number of quantum
+states, once with the eigenvectors found by np.linalg.eigh at every time step
+and once with the eigenvectors tracked from the previous time step by a few
+Jacobi sweeps (the "track_eigvecs" setting), and reports the largest
+difference between the outputs of the two. Run it in terminal with
+
+python eigvecs_tracking.py
+
+Each Jacobi sweep costs O(n^3) scalar operations, so tracking is most useful for
+small systems, and where eigenvectors with continuous phases are wanted.
+"""
+
+import time
+import numpy as np
+from qclab import Simulation
+from qclab.models import FMOComplex, HolsteinLattice
+from qclab.algorithms import FewestSwitchesSurfaceHopping
+from qclab.dynamics import serial_driver
+
+
+def run(model, track_eigvecs):
+    # instantiate a simulation
+    sim = Simulation()
+    # change settings to customize simulation
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 200
+    sim.settings.batch_size = 200
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+    sim.model = model
+    # instantiate an algorithm with or without eigenvector tracking
+    sim.algorithm = FewestSwitchesSurfaceHopping({"track_eigvecs": track_eigvecs})
+    sim.model.initialize_constants()
+    # define an initial diabatic wavefunction
+    sim.initial_state["wf_db"] = np.zeros(
+        sim.model.constants.num_quantum_states, dtype=complex
+    )
+    sim.initial_state["wf_db"][0] = 1.0
+    # Compile the numba functions before timing.
+    serial_driver(sim)
+    start = time.perf_counter()
+    data = serial_driver(sim)
+    return time.perf_counter() - start, data
+
+
+print("model              states  eigh time (s)  tracked time (s)  max difference")
+for name, model in [
+    ("FMOComplex", FMOComplex()),
+    ("HolsteinLattice", HolsteinLattice({"N": 10})),
+    ("HolsteinLattice", HolsteinLattice({"N": 20})),
+]:
+    time_eigh, data_eigh = run(model, False)
+    time_tracked, data_tracked = run(model, True)
+    difference = max(
+        np.max(np.abs(val - data_eigh.data_dict[key]))
+        for key, val in data_tracked.data_dict.items()
+        if key != "seed"
+    )
+    print(
+        f"{name:17s}  {model.constants.num_quantum_states:6d}  "
+        f"{time_eigh:13.2f}  {time_tracked:16.2f}  {difference:14.2e}"
+    )
@@ -0,0 +1,63 @@
+"""
+This is a scaling benchmark of the thread budget of the multiprocessing driver.
+
+It times the same simulation with an increasing number of worker processes,
+once with the BLAS and numba threads of each worker limited so that the CPU
+cores are divided evenly between the workers, and once with every worker
+allowed to use all of the CPU cores. Run it in terminal with
+
+python thread_budget_scaling.py
+
+Without a thread budget each worker starts as many BLAS threads as there are
+CPU cores, so the workers compete for the cores once several of them run at
+the same time.
+"""
+
+import time
+import numpy as np
+from qclab import Simulation
+from qclab.models import HolsteinLattice
+from qclab.algorithms import FewestSwitchesSurfaceHopping
+from qclab.dynamics import WorkerPool, parallel_driver_multiprocessing
+from qclab.dynamics.thread_budget import available_cpus
+
+num_cpus = len(available_cpus())
+
+# instantiate a simulation
+sim = Simulation()
+
+# change settings to customize simulation
+sim.settings.progress_bar = False
+sim.settings.tmax = 5
+sim.settings.dt_update = 0.01
+
+# instantiate a model with enough quantum states for eigh to use BLAS threads
+sim.model = HolsteinLattice({"N": 50})
+# instantiate an algorithm
+sim.algorithm = FewestSwitchesSurfaceHopping()
+sim.model.initialize_constants()
+# define an initial diabatic wavefunction
+sim.initial_state["wf_db"] = np.zeros(
+    sim.model.constants.num_quantum_states, dtype=complex
+)
+sim.initial_state["wf_db"][0] = 1.0
+
+num_tasks_list = [n for n in [1, 2, 4, 8, 16, 32, 64] if n <= num_cpus]
+print("tasks  threads/task  time (s)  pinned time (s)  unlimited time (s)")
+for num_tasks in num_tasks_list:
+    times = []
+    for threads_per_task, pin_cpus in [(None, False), (None, True), (num_cpus, False)]:
+        sim.settings.num_trajs = 20 * num_tasks
+        sim.settings.batch_size = 20
+        sim.settings.threads_per_task = threads_per_task
+        sim.settings.pin_cpus = pin_cpus
+        # Start the workers and compile the numba functions before timing.
+        with WorkerPool(num_tasks=num_tasks) as pool:
+            parallel_driver_multiprocessing(sim, pool=pool)
+            start = time.perf_counter()
+            parallel_driver_multiprocessing(sim, pool=pool)
+            times.append(time.perf_counter() - start)
+    print(
+        f"{num_tasks:5d}  {max(num_cpus // num_tasks, 1):12d}  "
+        f"{times[0]:8.2f}  {times[1]:15.2f}  {times[2]:18.2f}"
+    )
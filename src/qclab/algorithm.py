@@ -3,8 +3,12 @@ This module contains the Algorithm class.
 """
 
 import copy
+import functools
+import logging
 from qclab.constants import Constants
 
+logger = logging.getLogger(__name__)
+
 
 class Algorithm:
     """
@@ -33,6 +37,45 @@ class Algorithm:
     update_recipe = []
     collect_recipe = []
 
+    def compile_recipe(self, sim, recipe):
+        """
+        Compile a recipe into a list of tasks with their keyword arguments,
+        settings, and ingredients resolved for a batch.
+
+        Tasks that have a binder (see ``functions.bind_task``), including those
+        wrapped in ``functools.partial``, are replaced by the function returned
+        by their binder, so that they do not look up their keyword arguments,
+        the settings, or the ingredients of the model at every time step. Other
+        tasks are kept as they are. Because the tasks are bound to the settings
+        and the model at the start of each batch, changes made to them or to
+        the recipe while a batch runs take effect from the next batch on.
+
+        .. rubric:: Args
+        sim: Simulation
+            The simulation object containing the model, algorithm, and settings.
+        recipe: list
+            The list of functions to execute in order.
+
+        .. rubric:: Returns
+        recipe: tuple
+            The compiled tasks of the recipe in order.
+        """
+        compiled_recipe = []
+        for task in recipe:
+            if not callable(task):
+                logger.critical("The recipe task %r is not callable.", task)
+                raise TypeError(f"The recipe task {task!r} is not callable.")
+            if isinstance(task, functools.partial):
+                bind = getattr(task.func, "bind", None)
+                if bind is not None and not task.args:
+                    task = bind(sim, **task.keywords)
+            else:
+                bind = getattr(task, "bind", None)
+                if bind is not None:
+                    task = bind(sim)
+            compiled_recipe.append(task)
+        return tuple(compiled_recipe)
+
     def execute_recipe(self, sim, state, parameters, recipe):
         """
         Carry out the given recipe for the simulation by running
@@ -45,8 +88,9 @@ class Algorithm:
             The dictionary containing the current simulation state.
         parameters: dict
             The dictionary containing the current simulation parameters.
-        recipe: list
-            The list of functions to execute in order.
+        recipe: list or tuple
+            The list of functions to execute in order, or the tasks returned by
+            ``compile_recipe``.
 
         .. rubric:: Returns
         state: dict
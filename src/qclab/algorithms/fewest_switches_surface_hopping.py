@@ -19,6 +19,8 @@ class FewestSwitchesSurfaceHopping(Algorithm):
             "fssh_deterministic": False,
             "gauge_fixing": "sign_overlap",
             "use_gauge_field_force": False,
+            "track_eigvecs": False,
+            "store_prop_db": False,
         }
         super().__init__(self.default_settings, settings)
 
@@ -101,6 +103,7 @@ class FewestSwitchesSurfaceHopping(Algorithm):
             matrix_name="h_q_tot",
             eigvals_name="eigvals",
             eigvecs_name="eigvecs",
+            eigvecs_previous_name="eigvecs_previous",
         ),
         tasks.update_eigvecs_gauge,
         partial(
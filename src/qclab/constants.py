@@ -9,6 +9,9 @@ class Constants:
     """
 
     def __init__(self, update_function=None):
+        # Names of the constants that were set directly rather than by the
+        # update function, in the order in which they were first set.
+        super().__setattr__("_input_names", {})
         self._updating = False
         self._init_complete = False
         self._update_function = update_function
@@ -19,6 +22,8 @@ class Constants:
         changed, preventing recursion.
         """
         super().__setattr__(name, value)
+        if not self._updating and not name.startswith("_"):
+            self._input_names[name] = None
         if not self._updating and name not in {
             "_updating",
             "_update_function",
@@ -45,3 +50,16 @@ class Constants:
             The value of the attribute.
         """
         return getattr(self, name, default)
+
+    def get_inputs(self):
+        """
+        Get the constants that were set directly rather than by the update function.
+
+        .. rubric:: Returns
+        inputs : dict
+            The names and values of the constants.
+        """
+        input_names = self.__dict__.get("_input_names", {})
+        return {
+            name: getattr(self, name) for name in input_names if hasattr(self, name)
+        }
@@ -21,6 +21,16 @@ class Data:
         if seeds is None:
             seeds = np.array([], dtype=int)
         self.data_dict = {"seed": seeds, "norm_factor": 0}
+        # Statistics of the batch averages of each output, used to estimate
+        # the standard error of the outputs. This attribute is populated by
+        # ``init_batch_stats`` at the end of each batch.
+        self.batch_stats = {}
+        # Batch size selected automatically by the driver, if any.
+        self.batch_size = None
+        # Seeds of the batches that failed and are not included in the data.
+        self.failed_seeds = np.array([], dtype=int)
+        # Time in seconds each worker spent running the batches in the data.
+        self.worker_times = {}
         # Store log messages captured during a simulation run. This attribute is
         # populated by the drivers when they return the Data object.
         self.log = ""
@@ -67,6 +77,93 @@ class Data:
                 np.sum(val, axis=0) / self.data_dict["norm_factor"]
             )
 
+    def init_batch_stats(self):
+        """
+        Initialize the batch statistics ``self.batch_stats``, treating the data
+        collected so far as a single batch.
+
+        The batch statistics hold the sum of the squared normalization factors
+        of the batches and, for each output, the sum of the squared deviations
+        of the batch averages from the overall average weighted by their
+        normalization factors. They are combined in ``add_data``.
+        """
+        norm_factor = self.data_dict["norm_factor"]
+        self.batch_stats = {
+            "norm_factor_sq": norm_factor**2,
+            "m2": {
+                key: np.zeros(np.shape(val))
+                for key, val in self.data_dict.items()
+                if key not in ("seed", "norm_factor")
+            },
+        }
+
+    def _add_batch_stats(self, new_data):
+        """
+        Combine the batch statistics of ``new_data`` with ``self.batch_stats``.
+
+        This has to be called before the outputs in ``self.data_dict`` are
+        updated.
+
+        .. rubric:: Args
+        new_data: Data
+            A Data instance containing the new data to merge.
+        """
+        norm_factor = self.data_dict["norm_factor"]
+        new_norm_factor = new_data.data_dict["norm_factor"]
+        new_batch_stats = getattr(new_data, "batch_stats", {})
+        if norm_factor == 0:
+            self.batch_stats = new_batch_stats
+            return
+        if new_norm_factor == 0:
+            return
+        if not self.batch_stats or not new_batch_stats:
+            # The statistics are only meaningful if they cover every batch.
+            self.batch_stats = {}
+            return
+        m2 = {}
+        for key, val in self.batch_stats["m2"].items():
+            if key in new_batch_stats["m2"]:
+                delta = new_data.data_dict[key] - self.data_dict[key]
+                m2[key] = (
+                    val
+                    + new_batch_stats["m2"][key]
+                    + np.abs(delta) ** 2
+                    * norm_factor
+                    * new_norm_factor
+                    / (norm_factor + new_norm_factor)
+                )
+        self.batch_stats = {
+            "norm_factor_sq": self.batch_stats["norm_factor_sq"]
+            + new_batch_stats["norm_factor_sq"],
+            "m2": m2,
+        }
+
+    def standard_error(self, key):
+        """
+        Estimate the standard error of the output ``key`` from the spread of
+        its batch averages.
+
+        .. rubric:: Args
+        key: str
+            The name of the output.
+
+        .. rubric:: Returns
+        standard_error: ndarray
+            The estimated standard error of each element of the output. It is
+            infinite if fewer than two batches have been collected.
+        """
+        shape = np.shape(self.data_dict[key])
+        norm_factor = self.data_dict["norm_factor"]
+        if key not in self.batch_stats.get("m2", {}) or norm_factor == 0:
+            return np.full(shape, np.inf)
+        norm_factor_sq = self.batch_stats["norm_factor_sq"]
+        # Number of degrees of freedom of the weighted batch averages.
+        dof = norm_factor - norm_factor_sq / norm_factor
+        if dof <= 0:
+            return np.full(shape, np.inf)
+        variance = self.batch_stats["m2"][key] / dof
+        return np.sqrt(variance * norm_factor_sq) / norm_factor
+
     def add_data(self, new_data):
         """
         Add data from ``new_data`` to the output dictionary ``self.data_dict``.
@@ -75,6 +172,7 @@ class Data:
         new_data: Data
             A Data instance containing the new data to merge.
         """
+        self._add_batch_stats(new_data)
         new_norm_factor = (
             new_data.data_dict["norm_factor"] + self.data_dict["norm_factor"]
         )
@@ -92,6 +190,11 @@ class Data:
                 else:
                     self.data_dict[key] = val
         self.data_dict["norm_factor"] = new_norm_factor
+        self.failed_seeds = np.concatenate(
+            (self.failed_seeds, getattr(new_data, "failed_seeds", []))
+        ).astype(int)
+        for name, busy_time in getattr(new_data, "worker_times", {}).items():
+            self.worker_times[name] = self.worker_times.get(name, 0.0) + busy_time
         # Append any log messages stored in new_data to this instance's log.
         if getattr(new_data, "log", ""):
             self.log += new_data.log
@@ -109,12 +212,34 @@ class Data:
         disable_h5py : bool, default: qclab.utils.DISABLE_H5PY
             If True, h5py is not used even if available.
         """
+        worker_names = list(self.worker_times)
+        worker_times = np.array(
+            [self.worker_times[name] for name in worker_names], dtype=float
+        )
         if disable_h5py:
-            np.savez(filename, log=self.log, **self.data_dict)
+            extra = {}
+            if self.batch_size is not None:
+                extra["batch_size"] = self.batch_size
+            np.savez(
+                filename,
+                log=self.log,
+                failed_seeds=self.failed_seeds,
+                worker_names=np.array(worker_names, dtype=str),
+                worker_times=worker_times,
+                **extra,
+                **self.data_dict,
+            )
         else:
             with h5py.File(filename, "w") as h5file:
                 self._recursive_save(h5file, "/", self.data_dict)
+                h5file.create_dataset("failed_seeds", data=self.failed_seeds)
                 h5file.attrs["log"] = self.log
+                if self.batch_size is not None:
+                    h5file.attrs["batch_size"] = self.batch_size
+                h5file.attrs["worker_names"] = np.array(
+                    worker_names, dtype=h5py.string_dtype()
+                )
+                h5file.attrs["worker_times"] = worker_times
 
     def load(self, filename, disable_h5py=DISABLE_H5PY):
         """
@@ -131,18 +256,47 @@ class Data:
             The loaded Data object.
         """
         new_data = Data()
+        # Files saved by earlier versions do not have the failed seeds, the
+        # worker times, or the batch size.
+        worker_names = []
+        worker_times = []
         if disable_h5py:
             loaded = np.load(filename, allow_pickle=True)
+            run_info_keys = (
+                "log",
+                "batch_size",
+                "failed_seeds",
+                "worker_names",
+                "worker_times",
+            )
             new_data.data_dict = {
-                key: loaded[key] for key in loaded.files if key != "log"
+                key: loaded[key] for key in loaded.files if key not in run_info_keys
             }
             new_data.log = str(loaded.get("log", ""))
-            self.add_data(new_data)
-            return self
-        with h5py.File(filename, "r") as h5file:
-            new_data._recursive_load(h5file, "/", new_data.data_dict)
-            new_data.log = h5file.attrs["log"]
-            self.add_data(new_data)
+            if "batch_size" in loaded.files:
+                new_data.batch_size = int(loaded["batch_size"])
+            if "failed_seeds" in loaded.files:
+                new_data.failed_seeds = loaded["failed_seeds"].astype(int)
+            if "worker_names" in loaded.files:
+                worker_names = loaded["worker_names"].tolist()
+                worker_times = loaded["worker_times"].tolist()
+        else:
+            with h5py.File(filename, "r") as h5file:
+                new_data._recursive_load(h5file, "/", new_data.data_dict)
+                if "failed_seeds" in new_data.data_dict:
+                    new_data.failed_seeds = new_data.data_dict.pop(
+                        "failed_seeds"
+                    ).astype(int)
+                new_data.log = h5file.attrs["log"]
+                if "batch_size" in h5file.attrs:
+                    new_data.batch_size = int(h5file.attrs["batch_size"])
+                if "worker_names" in h5file.attrs:
+                    worker_names = h5file.attrs["worker_names"].tolist()
+                    worker_times = h5file.attrs["worker_times"].tolist()
+        new_data.worker_times = dict(zip(worker_names, worker_times))
+        self.add_data(new_data)
+        if new_data.batch_size is not None:
+            self.batch_size = new_data.batch_size
         return self
 
     def _recursive_save(self, h5file, path, dict):
@@ -6,5 +6,20 @@ from qclab.dynamics.parallel_driver_multiprocessing import (
     parallel_driver_multiprocessing,
 )
 from qclab.dynamics.parallel_driver_mpi import parallel_driver_mpi
+from qclab.dynamics.parallel_driver_threads import parallel_driver_threads
 from qclab.dynamics.serial_driver import serial_driver
+from qclab.dynamics.worker_pool import WorkerPool
+from qclab.dynamics.executor_driver import executor_driver, plan_batches
+from qclab.dynamics.async_driver import run_async
+from qclab.dynamics.convergence_driver import convergence_driver
+from qclab.dynamics.sweep_driver import sweep_driver
+from qclab.dynamics.batch_size import auto_batch_size
+from qclab.dynamics.thread_budget import set_thread_budget
+from qclab.dynamics.executors import (
+    Executor,
+    SerialExecutor,
+    ThreadExecutor,
+    ProcessExecutor,
+    MPIExecutor,
+)
 from qclab.dynamics.dynamics import run_dynamics
@@ -0,0 +1,110 @@
+"""
+This module contains the asyncio driver.
+"""
+
+import asyncio
+import logging
+from qclab.dynamics.executor_driver import (
+    _start_run,
+    _finish_run,
+    _next_chunks,
+    _handle_failed_chunk,
+)
+from qclab.dynamics.executors import ThreadExecutor
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+
+async def run_async(sim, executor=None, seeds=None, data=None, progress_callback=None):
+    """
+    Asynchronous driver for the dynamics core.
+
+    Batches are run by ``executor`` while the event loop stays free to handle
+    other work. After each chunk of batches finishes, the progress of the
+    simulation and the output data of the batches finished so far are yielded.
+    The last item yielded holds the complete output data.
+
+    The simulation can be cancelled between batches by cancelling the task
+    iterating over the generator or by closing the generator. No new batches
+    are started afterwards and batches that are still queued are cancelled,
+    but batches that are already running cannot be interrupted.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    executor: Executor, optional
+        The executor that runs the batches. If None, a ``ThreadExecutor`` is
+        used. The executor must not run batches in the calling thread, so the
+        serial and MPI executors are not supported.
+    seeds: ndarray, optional
+        An array of integer seeds for the trajectories. If None, seeds will be
+        generated automatically.
+    data: Data, optional
+        A Data object for collecting output data. If None, a new Data object
+        will be created.
+    progress_callback: callable, optional
+        Called with the progress of the simulation each time a chunk of
+        batches finishes (see ``qclab.dynamics.progress.ProgressReporter``).
+
+    .. rubric:: Yields
+    num_batches_done: int
+        The number of batches finished so far.
+    num_batches: int
+        The total number of batches.
+    data: Data
+        The merged output data of the batches finished so far, which must not
+        be modified. Once all batches are finished, this is the updated
+        ``data`` object containing the collected output data.
+    """
+    if executor is None:
+        executor = ThreadExecutor()
+    loop = asyncio.get_running_loop()
+    # Starting the executor may start worker processes, so it is done off the
+    # event loop.
+    seeds, data, chunk_iter, reporter = await loop.run_in_executor(
+        None, _start_run, sim, executor, seeds, data, progress_callback
+    )
+    num_batches = len(range(0, len(seeds), sim.settings.batch_size))
+    local_data = Data()
+    num_batches_done = 0
+    pending = {}
+    retry_chunks = []
+    attempts = {}
+    try:
+        while True:
+            for chunk in _next_chunks(
+                retry_chunks, chunk_iter, executor.max_pending - len(pending)
+            ):
+                future = executor.submit(chunk)
+                pending[asyncio.wrap_future(future)] = (future, chunk)
+            if not pending:
+                break
+            done, _ = await asyncio.wait(
+                pending.keys(), return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                _, chunk = pending.pop(future)
+                try:
+                    chunk_data = future.result()
+                except Exception as e:
+                    retry_chunks.extend(
+                        _handle_failed_chunk(sim, chunk, e, attempts, local_data)
+                    )
+                    continue
+                local_data.add_data(chunk_data)
+                reporter.update(chunk_data)
+                num_batches_done += len(chunk)
+            if pending or num_batches_done < num_batches:
+                yield num_batches_done, num_batches, local_data
+    except BaseException:
+        logger.info("Cancelling dynamics calculation.")
+        for future, _ in pending.values():
+            future.cancel()
+        reporter.close()
+        executor.stop(terminate=True)
+        raise
+    reporter.close()
+    await loop.run_in_executor(None, executor.stop)
+    _finish_run(executor, seeds, data, local_data)
+    yield num_batches_done, num_batches, data
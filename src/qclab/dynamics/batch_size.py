@@ -0,0 +1,124 @@
+"""
+This module contains the automatic selection of the batch size.
+"""
+
+import copy
+import logging
+import tracemalloc
+import numpy as np
+import qclab.dynamics as dynamics
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+
+def _probe_peak_memory(sim, batch_size):
+    """
+    Measure the peak memory allocated while running the first time steps of a
+    batch.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    batch_size: int
+        The number of trajectories in the probe batch.
+
+    .. rubric:: Returns
+    peak: int
+        The peak memory allocated in bytes.
+    """
+    probe_sim = copy.copy(sim)
+    probe_sim.settings = copy.copy(sim.settings)
+    probe_sim.settings.batch_size = batch_size
+    probe_sim.settings.progress_bar = False
+    probe_sim.settings.checkpoint_dir = None
+    # Run the initialization, one collect step and two update steps. The time
+    # arrays keep their full length since some state variables depend on it.
+    probe_sim.settings.t_update_n = sim.settings.t_update_n[:2]
+    seeds = np.arange(batch_size)
+    was_tracing = tracemalloc.is_tracing()
+    if was_tracing:
+        logger.warning(
+            "tracemalloc is already tracing, the memory estimate may be too large."
+        )
+    else:
+        tracemalloc.start()
+    try:
+        dynamics.run_dynamics(probe_sim, {"seed": seeds}, {}, Data(seeds))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    return peak
+
+
+def auto_batch_size(sim, num_trajs=None, num_tasks=1, memory_budget=None):
+    """
+    Select the batch size from the memory used by a short probe simulation.
+
+    After a warm-up run, two probe batches of different sizes are run for a
+    couple of time steps while the allocated memory is traced, which gives the
+    memory used per trajectory and the memory used independently of the batch
+    size. The batch size is then chosen as the largest one that fits in
+    ``memory_budget``, rounded down to a multiple of 8 trajectories for
+    efficient vectorized operations once it is large enough. It is limited to the number of
+    trajectories each task has to run, so that no task is left idle.
+
+    If the algorithm uses deterministic surface hopping, the batch size is a
+    multiple of the number of quantum states.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    num_trajs: int, optional
+        The total number of trajectories. If None, ``sim.settings.num_trajs``
+        is used.
+    num_tasks: int, default: 1
+        The number of tasks running batches at the same time.
+    memory_budget: float, optional
+        The memory in bytes available to each task. If None,
+        ``sim.settings.memory_budget`` is used.
+
+    .. rubric:: Returns
+    batch_size: int
+        The selected batch size.
+    """
+    if num_trajs is None:
+        num_trajs = sim.settings.num_trajs
+    if memory_budget is None:
+        memory_budget = sim.settings.get("memory_budget", 1e9)
+    # Number of trajectories that the batch size has to be a multiple of.
+    if sim.algorithm.settings.get("fssh_deterministic", False):
+        unit = sim.model.constants.num_quantum_states
+    else:
+        unit = 1
+    # The first run of a simulation also allocates memory once, for example
+    # when compiling the numba functions, so it is not measured.
+    _probe_peak_memory(sim, unit)
+    probe_sizes = (4 * unit, 16 * unit)
+    peaks = [_probe_peak_memory(sim, probe_size) for probe_size in probe_sizes]
+    mem_per_traj = max((peaks[1] - peaks[0]) / (probe_sizes[1] - probe_sizes[0]), 1)
+    mem_fixed = max(peaks[0] - mem_per_traj * probe_sizes[0], 0)
+    batch_size = int((memory_budget - mem_fixed) // mem_per_traj)
+    # Do not make batches larger than needed to give each task one batch.
+    max_batch_size = -(-num_trajs // num_tasks)
+    batch_size = min(batch_size, unit * -(-max_batch_size // unit))
+    if batch_size >= 8 * unit:
+        batch_size -= batch_size % (8 * unit)
+    else:
+        batch_size -= batch_size % unit
+    if batch_size < unit:
+        logger.warning(
+            "A single trajectory needs more memory than the memory budget of %s bytes.",
+            memory_budget,
+        )
+        batch_size = unit
+    logger.info(
+        "Selected batch_size %s from an estimated %s bytes per trajectory and "
+        "%s bytes per batch with a memory budget of %s bytes.",
+        batch_size,
+        int(mem_per_traj),
+        int(mem_fixed),
+        memory_budget,
+    )
+    return batch_size
@@ -0,0 +1,191 @@
+"""
+This module contains functions for checkpointing batches of trajectories.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_path(checkpoint_dir, seeds):
+    """
+    Get the path of the checkpoint file of a batch.
+
+    .. rubric:: Args
+    checkpoint_dir: str
+        The directory where checkpoints are stored.
+    seeds: ndarray
+        The seeds of the batch.
+
+    .. rubric:: Returns
+    path: str
+        The path of the checkpoint file.
+    """
+    return os.path.join(
+        checkpoint_dir, "batch_" + str(seeds[0]) + "_" + str(len(seeds)) + ".pkl"
+    )
+
+
+def _hash_update(digest, value):
+    """
+    Add a value to a hash in a way that does not depend on the process or the
+    memory layout of the value.
+
+    .. rubric:: Args
+    digest: hashlib.sha256
+        The hash object.
+    value: any
+        The value, which may be a nested dict, list, or tuple of arrays,
+        numbers, strings, and callables.
+    """
+    if (
+        isinstance(value, (np.ndarray, np.generic))
+        and np.asarray(value).dtype != object
+    ):
+        value = np.ascontiguousarray(value)
+        digest.update(f"array:{value.dtype.str}:{value.shape}:".encode())
+        digest.update(value.tobytes())
+    elif isinstance(value, np.ndarray):
+        _hash_update(digest, value.tolist())
+    elif isinstance(value, dict):
+        digest.update(f"dict:{len(value)}:".encode())
+        for key in sorted(value, key=repr):
+            _hash_update(digest, key)
+            _hash_update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}:{len(value)}:".encode())
+        for item in value:
+            _hash_update(digest, item)
+    elif callable(value):
+        name = (
+            getattr(value, "__module__", "")
+            + "."
+            + getattr(value, "__qualname__", type(value).__qualname__)
+        )
+        digest.update(f"callable:{name}:".encode())
+    else:
+        text = repr(value)
+        digest.update(f"{type(value).__name__}:{len(text)}:{text}".encode())
+
+
+def _constants_hash(constants):
+    """
+    Hash the constants of a Constants object that were set directly, such as
+    the constants of a model or the settings of an algorithm.
+
+    .. rubric:: Args
+    constants: Constants
+        The Constants object.
+
+    .. rubric:: Returns
+    hash: str
+        The hexadecimal digest of the constants.
+    """
+    digest = hashlib.sha256()
+    _hash_update(digest, constants.get_inputs())
+    return digest.hexdigest()
+
+
+def _fingerprint(sim, seeds):
+    """
+    Summarize the simulation so that a checkpoint written for a different
+    simulation is not used by mistake.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    seeds: ndarray
+        The seeds of the batch.
+
+    .. rubric:: Returns
+    fingerprint: dict
+        The settings that must match for a checkpoint to be used.
+    """
+    return {
+        "model": type(sim.model).__name__,
+        "algorithm": type(sim.algorithm).__name__,
+        "model_constants": _constants_hash(sim.model.constants),
+        "algorithm_settings": _constants_hash(sim.algorithm.settings),
+        "tmax_n": int(sim.settings.tmax_n),
+        "dt_update": float(sim.settings.dt_update),
+        "dt_collect_n": int(sim.settings.dt_collect_n),
+        "seed": np.asarray(seeds).tolist(),
+    }
+
+
+def save_checkpoint(path, sim, state, parameters, t_ind, data):
+    """
+    Save the state of a batch to a checkpoint file.
+
+    The file is first written to a temporary file and then renamed, so that an
+    interrupted write never replaces a valid checkpoint.
+
+    .. rubric:: Args
+    path: str
+        The path of the checkpoint file.
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    state: dict
+        The state object of the batch.
+    parameters: dict
+        The parameters object of the batch.
+    t_ind: int
+        The time index from which the batch continues.
+    data: Data
+        The data object containing the output data collected so far.
+    """
+    checkpoint = {
+        "fingerprint": _fingerprint(sim, state["seed"]),
+        "t_ind": t_ind,
+        "state": state,
+        "parameters": parameters,
+        "data": data,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    logger.info("Saved checkpoint at time index %s to %s.", t_ind, path)
+
+
+def load_checkpoint(path, sim, seeds):
+    """
+    Load the state of a batch from a checkpoint file.
+
+    .. rubric:: Args
+    path: str
+        The path of the checkpoint file.
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    seeds: ndarray
+        The seeds of the batch.
+
+    .. rubric:: Returns
+    checkpoint: tuple or None
+        The state, parameters, time index from which the batch continues, and
+        data object stored in the checkpoint, or None if there is no usable
+        checkpoint.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        checkpoint = pickle.load(f)
+    if checkpoint["fingerprint"] != _fingerprint(sim, seeds):
+        logger.warning(
+            "Ignoring checkpoint %s because it was written for a different simulation.",
+            path,
+        )
+        return None
+    logger.info(
+        "Resuming from checkpoint %s at time index %s.", path, checkpoint["t_ind"]
+    )
+    return (
+        checkpoint["state"],
+        checkpoint["parameters"],
+        checkpoint["t_ind"],
+        checkpoint["data"],
+    )
@@ -0,0 +1,153 @@
+"""
+This module contains the compiled dynamics engine, which carries out the
+update steps between collect steps in a single numba-compiled loop for
+simulations whose update recipe and ingredients are all available as
+low-level functions.
+"""
+
+import functools
+import logging
+import numpy as np
+from qclab import ingredients, functions, tasks
+from qclab.algorithms import MeanField
+from qclab.utils import DISABLE_NUMBA
+
+logger = logging.getLogger(__name__)
+
+
+def _task_key(task):
+    """
+    Get a key identifying a recipe task, such that copies of the same task
+    have the same key.
+
+    .. rubric:: Args
+    task: callable
+        The task.
+
+    .. rubric:: Returns
+    key: hashable
+        The function of the task and its bound arguments.
+    """
+    if isinstance(task, functools.partial):
+        return (task.func, task.args, tuple(sorted(task.keywords.items())))
+    return task
+
+
+def _same_recipe(recipe, reference_recipe):
+    """
+    Check if a recipe consists of the same tasks as a reference recipe.
+
+    .. rubric:: Args
+    recipe: list
+        The recipe to check.
+    reference_recipe: list
+        The reference recipe.
+
+    .. rubric:: Returns
+    same: bool
+        True if the recipes have the same tasks in the same order.
+    """
+    return [_task_key(task) for task in recipe] == [
+        _task_key(task) for task in reference_recipe
+    ]
+
+
+def _mean_field_harmonic_diagonal_linear(sim, state, parameters, num_steps):
+    """
+    Carry out update steps of the mean-field algorithm for a model with a
+    harmonic classical Hamiltonian and a diagonal linear quantum-classical
+    Hamiltonian.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, and settings.
+    state: dict
+        The state object.
+    parameters: dict
+        The parameters object.
+    num_steps: int
+        The number of update steps.
+
+    .. rubric:: Returns
+    state: dict
+        The updated state object.
+    parameters: dict
+        The updated parameters object.
+
+    .. rubric:: Modifications
+    state["z"] : ndarray
+        Classical coordinates after the update steps.
+    state["wf_db"] : ndarray
+        Diabatic wavefunction after the update steps.
+    state["h_qc"], state["h_q_tot"] : ndarray
+        Hamiltonians of the updated classical coordinates.
+    """
+    constants = sim.model.constants
+    gamma = constants.diagonal_linear_coupling
+    # Each classical coordinate typically couples to few quantum states, so
+    # only the nonzero coupling strengths are passed.
+    rows, cols = np.nonzero(gamma)
+    functions.mean_field_harmonic_diagonal_linear_steps(
+        state["z"],
+        state["wf_db"],
+        state["h_q_tot"],
+        state["h_q"],
+        rows,
+        cols,
+        gamma[rows, cols],
+        constants.classical_coordinate_weight,
+        constants.harmonic_frequency,
+        sim.settings.dt_update,
+        num_steps,
+    )
+    return tasks.update_h_q_tot(sim, state, parameters)
+
+
+def get_update_engine(sim):
+    """
+    Get a compiled function that carries out several update steps of a
+    simulation at once, if one is available.
+
+    A compiled function is available for the ``MeanField`` algorithm with its
+    default update recipe and a model whose ``h_qc``, ``dh_qc_dzc`` and
+    ``dh_c_dzc`` ingredients are ``h_qc_diagonal_linear``,
+    ``dh_qc_dzc_diagonal_linear`` and ``dh_c_dzc_harmonic``, and whose
+    quantum Hamiltonian does not change during the simulation.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, and settings.
+
+    .. rubric:: Returns
+    engine: callable or None
+        A function called as ``engine(sim, state, parameters, num_steps)``
+        that returns the updated state and parameters objects, or None if the
+        simulation cannot be compiled.
+    """
+    if DISABLE_NUMBA:
+        logger.info("Numba is not available, not using compiled dynamics.")
+        return None
+    if not isinstance(sim.algorithm, MeanField) or not _same_recipe(
+        sim.algorithm.update_recipe, MeanField.update_recipe
+    ):
+        logger.info(
+            "Compiled dynamics are only available for the default MeanField "
+            "update recipe."
+        )
+        return None
+    required_ingredients = {
+        "h_qc": ingredients.h_qc_diagonal_linear,
+        "dh_qc_dzc": ingredients.dh_qc_dzc_diagonal_linear,
+        "dh_c_dzc": ingredients.dh_c_dzc_harmonic,
+    }
+    for name, ingredient in required_ingredients.items():
+        if sim.model.get(name)[0] is not ingredient:
+            logger.info(
+                "Compiled dynamics are not available for the %s ingredient.", name
+            )
+            return None
+    if sim.model.update_h_q:
+        logger.info("Compiled dynamics are not available for a time-dependent h_q.")
+        return None
+    logger.info("Using compiled dynamics.")
+    return _mean_field_harmonic_diagonal_linear
@@ -0,0 +1,143 @@
+"""
+This module contains the convergence driver.
+"""
+
+import concurrent.futures
+import logging
+import numpy as np
+from qclab.dynamics.executor_driver import (
+    _start_run,
+    _finish_run,
+    _next_chunks,
+    _handle_failed_chunk,
+)
+from qclab.dynamics.executors import SerialExecutor, MPIExecutor
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+
+def _is_converged(data, target_errors):
+    """
+    Check if the standard errors of the outputs are below their targets.
+
+    .. rubric:: Args
+    data: Data
+        The Data object containing the output data collected so far.
+    target_errors: dict
+        The target standard error of each output.
+
+    .. rubric:: Returns
+    converged: bool
+        True if the largest standard error of every output is below its target.
+    """
+    for key, target_error in target_errors.items():
+        if key not in data.data_dict:
+            logger.critical("The output %s is not collected by the algorithm.", key)
+            raise ValueError(f"The output {key} is not collected by the algorithm.")
+        error = np.max(data.standard_error(key))
+        logger.info("Standard error of %s is %s (target %s).", key, error, target_error)
+        if error > target_error:
+            return False
+    return True
+
+
+def convergence_driver(
+    sim,
+    target_errors,
+    executor=None,
+    seeds=None,
+    data=None,
+    min_batches=2,
+    progress_callback=None,
+):
+    """
+    Driver for the dynamics core that runs batches until the outputs have
+    converged.
+
+    Batches are run until the standard error of each output in
+    ``target_errors``, estimated from the spread of the batch averages, is
+    below its target at every time step, or until ``sim.settings.num_trajs``
+    trajectories have been run. The standard errors are checked each time a
+    chunk of batches finishes, and the results of batches that are still
+    running at that point are included in the output data.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    target_errors: dict
+        The target standard error of each output, for example
+        ``{"classical_energy": 1e-3}``. For complex outputs the error is that
+        of the complex average.
+    executor: Executor, optional
+        The executor that runs the batches. If None, a ``SerialExecutor`` is
+        used. The MPI executor is not supported.
+    seeds: ndarray, optional
+        An array of integer seeds for the trajectories, in the order in which
+        they are run. If None, seeds will be generated automatically.
+    data: Data, optional
+        A Data object for collecting output data. If None, a new Data object
+        will be created.
+    min_batches: int, default: 2
+        The number of batches to run before the standard errors are checked.
+    progress_callback: callable, optional
+        Called with the progress of the simulation each time a chunk of
+        batches finishes (see ``qclab.dynamics.progress.ProgressReporter``).
+
+    .. rubric:: Returns
+    data: Data
+        The updated Data object containing collected output data.
+    """
+    if executor is None:
+        executor = SerialExecutor()
+    if isinstance(executor, MPIExecutor):
+        # Each rank would decide on its own when the outputs have converged.
+        logger.critical("The convergence driver does not support the MPI executor.")
+        raise ValueError("The convergence driver does not support the MPI executor.")
+    seeds, data, chunk_iter, reporter = _start_run(
+        sim, executor, seeds, data, progress_callback
+    )
+    local_data = Data()
+    num_batches_done = 0
+    converged = False
+    try:
+        pending = {}
+        retry_chunks = []
+        attempts = {}
+        while True:
+            if not converged:
+                for chunk in _next_chunks(
+                    retry_chunks, chunk_iter, executor.max_pending - len(pending)
+                ):
+                    pending[executor.submit(chunk)] = chunk
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending.keys(), return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    chunk_data = future.result()
+                except Exception as e:
+                    retry_chunks.extend(
+                        _handle_failed_chunk(sim, chunk, e, attempts, local_data)
+                    )
+                    continue
+                num_batches_done += len(chunk)
+                local_data.add_data(chunk_data)
+                reporter.update(chunk_data)
+            if not converged and num_batches_done >= min_batches:
+                converged = _is_converged(local_data, target_errors)
+                if converged:
+                    logger.info("Outputs converged after %s batches.", num_batches_done)
+    except BaseException:
+        reporter.close()
+        executor.stop(terminate=True)
+        raise
+    reporter.close()
+    executor.stop()
+    if not converged:
+        logger.warning("Outputs did not converge within %s trajectories.", len(seeds))
+    _finish_run(executor, seeds, data, local_data)
+    return data
@@ -2,14 +2,37 @@
 This module contains the dynamics core.
 """
 
-import numpy as np
+import logging
+import os
 from tqdm import tqdm
+from qclab.dynamics import checkpoint
+from qclab.dynamics.compiled_dynamics import get_update_engine
+
+logger = logging.getLogger(__name__)
 
 
 def run_dynamics(sim, state, parameters, data):
     """
     Dynamics core for QC Lab.
 
+    If ``sim.settings.checkpoint_dir`` is set, the state, parameters and
+    collected data of the batch are saved to a checkpoint file in that
+    directory every ``sim.settings.checkpoint_interval`` collect steps and at
+    the end of the batch. If a checkpoint of the same batch exists when the
+    batch starts, the dynamics continue from it instead of from the first time
+    step, and the data of a batch that already finished is returned as it was
+    saved.
+
+    If ``sim.settings.compiled_dynamics`` is True and checkpointing is
+    disabled, the update steps between two collect steps are carried out in a
+    single compiled function when one is available for the simulation (see
+    ``qclab.dynamics.compiled_dynamics``). Otherwise the update recipe is
+    executed at every time step.
+
+    If ``sim.settings.progress_bar`` is True and the batch holds all
+    trajectories of the simulation, a progress bar shows the time steps of the
+    batch.
+
     .. rubric:: Args
     sim: Simulation
         The simulation object containing the model, algorithm, and settings.
@@ -24,28 +47,80 @@ def run_dynamics(sim, state, parameters, data):
     data: Data
         The updated data object containing collected output data.
     """
-    # Define an update iterator using tqdm if progress_bar is True.
-    t_update_iterator = sim.settings.t_update_n
-    if getattr(sim.settings, "progress_bar", True):
-        t_update_iterator = tqdm(t_update_iterator)
-
+    t_start = 0
+    checkpoint_dir = sim.settings.get("checkpoint_dir")
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint_path = checkpoint.checkpoint_path(checkpoint_dir, state["seed"])
+        loaded = checkpoint.load_checkpoint(checkpoint_path, sim, state["seed"])
+        if loaded is not None:
+            state, parameters, t_start, data = loaded
+        checkpoint_n = sim.settings.dt_collect_n * sim.settings.get(
+            "checkpoint_interval", 1
+        )
+    # Bind the tasks of the recipes and look up the settings used at every time
+    # step once per batch.
+    algorithm = sim.algorithm
+    initialization_recipe = algorithm.compile_recipe(
+        sim, algorithm.initialization_recipe
+    )
+    update_recipe = algorithm.compile_recipe(sim, algorithm.update_recipe)
+    collect_recipe = algorithm.compile_recipe(sim, algorithm.collect_recipe)
+    execute_recipe = algorithm.execute_recipe
+    dt_collect_n = sim.settings.dt_collect_n
+    t_update_n = sim.settings.t_update_n.tolist()
+    t_last = t_update_n[-1]
+    if t_start > t_last:
+        # The checkpoint was saved at the end of the batch.
+        return data
+    update_engine = None
+    if sim.settings.get("compiled_dynamics", False):
+        if checkpoint_dir is None:
+            update_engine = get_update_engine(sim)
+        else:
+            logger.info("Compiled dynamics are not used with checkpointing.")
+    # Progress is reported by the driver each time a batch finishes, so a
+    # simulation with a single batch also reports the progress of its time steps.
+    t_update_iterator = t_update_n[t_start:]
+    if (
+        sim.settings.get("progress_bar", True)
+        and sim.settings.batch_size == sim.settings.num_trajs
+    ):
+        t_update_iterator = tqdm(t_update_iterator, unit="step")
     # Iterate over each time step.
     for sim.t_ind in t_update_iterator:
         if sim.t_ind == 0:
             # Execute initialization recipe.
-            state, parameters = sim.algorithm.execute_recipe(
-                sim, state, parameters, sim.algorithm.initialization_recipe
+            state, parameters = execute_recipe(
+                sim, state, parameters, initialization_recipe
             )
         # Detect collect timesteps.
-        if np.mod(sim.t_ind, sim.settings.dt_collect_n) == 0:
+        if sim.t_ind % dt_collect_n == 0:
             # Calculate output variables.
-            state, parameters = sim.algorithm.execute_recipe(
-                sim, state, parameters, sim.algorithm.collect_recipe
-            )
+            state, parameters = execute_recipe(sim, state, parameters, collect_recipe)
             # Collect totals in output dictionary.
             data.add_output_to_data_dict(sim, state, sim.t_ind)
+            if update_engine is not None:
+                # Carry out the update steps up to the next collect step.
+                state, parameters = update_engine(
+                    sim, state, parameters, min(dt_collect_n, t_last + 1 - sim.t_ind)
+                )
         # Execute update recipe.
-        state, parameters = sim.algorithm.execute_recipe(
-            sim, state, parameters, sim.algorithm.update_recipe
+        if update_engine is None:
+            state, parameters = execute_recipe(sim, state, parameters, update_recipe)
+        # Save a checkpoint from which the dynamics continue at the next step.
+        if (
+            checkpoint_dir is not None
+            and sim.t_ind % checkpoint_n == 0
+            and sim.t_ind != t_last
+        ):
+            checkpoint.save_checkpoint(
+                checkpoint_path, sim, state, parameters, sim.t_ind + 1, data
+            )
+    # Record the statistics of this batch to estimate the standard errors.
+    data.init_batch_stats()
+    if checkpoint_dir is not None:
+        checkpoint.save_checkpoint(
+            checkpoint_path, sim, state, parameters, t_last + 1, data
         )
     return data
@@ -0,0 +1,338 @@
+"""
+This module contains the batch planner and the driver shared by all executors.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import numpy as np
+from qclab.dynamics.batch_size import auto_batch_size
+from qclab.utils import get_log_output, reset_log_output
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+
+def plan_batches(sim, seeds=None, data=None):
+    """
+    Determine the seeds of the trajectories and split them into batches.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    seeds: ndarray, optional
+        An array of integer seeds for the trajectories. If None, seeds will be
+        generated automatically, continuing from the largest seed in ``data``.
+    data: Data, optional
+        A Data object the results will be added to.
+
+    .. rubric:: Returns
+    seeds: ndarray
+        The seeds of all trajectories.
+    batch_seeds_list: list
+        The seeds of each batch.
+
+    .. rubric:: Modifications
+    sim.settings.num_trajs: int
+        Set to the number of provided seeds if ``seeds`` is given.
+    """
+    if seeds is None:
+        if data is not None and len(data.data_dict["seed"]) > 0:
+            offset = np.max(data.data_dict["seed"]) + 1
+        else:
+            offset = 0
+        seeds = offset + np.arange(sim.settings.num_trajs, dtype=int)
+        num_trajs = sim.settings.num_trajs
+    else:
+        num_trajs = len(seeds)
+        logger.warning(
+            "Setting sim.settings.num_trajs to the number of provided seeds: %s",
+            num_trajs,
+        )
+        sim.settings.num_trajs = num_trajs
+    # Determine the number of batches required to execute the total number
+    # of trajectories.
+    batch_size = sim.settings.batch_size
+    if num_trajs % batch_size == 0:
+        num_batches = num_trajs // batch_size
+    else:
+        num_batches = num_trajs // batch_size + 1
+    logger.info(
+        "Running %s batches with %s seeds in each batch.",
+        num_batches,
+        batch_size,
+    )
+    batch_seeds_list = [
+        seeds[n * batch_size : (n + 1) * batch_size] for n in range(num_batches)
+    ]
+    return seeds, batch_seeds_list
+
+
+def _start_run(sim, executor, seeds, data, progress_callback=None):
+    """
+    Prepare a simulation to be run with an executor.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    executor: Executor
+        The executor that runs the batches.
+    seeds: ndarray or None
+        An array of integer seeds for the trajectories.
+    data: Data or None
+        A Data object for collecting output data.
+    progress_callback: callable, optional
+        Called with the progress of the simulation each time a chunk of
+        batches finishes.
+
+    .. rubric:: Returns
+    seeds: ndarray
+        The seeds of all trajectories.
+    data: Data
+        The Data object for collecting output data.
+    chunk_iter: iterator
+        The chunks of batches to submit to the executor, as lists of the index
+        and the seeds of each batch.
+    reporter: ProgressReporter
+        The reporter of the progress of the batches run in this process.
+    """
+    # Clear any in-memory log output from previous runs.
+    reset_log_output()
+    # First initialize the model constants.
+    sim.model.initialize_constants()
+    if data is None:
+        data = Data()
+    logger.info("Using %s tasks for parallel processing.", executor.num_tasks)
+    sim.initialize_timesteps()
+    if isinstance(sim.settings.batch_size, str) and sim.settings.batch_size == "auto":
+        # The batch size is selected in one process so that all processes
+        # split the trajectories into the same batches.
+        sim.settings.batch_size = executor.share_result(
+            auto_batch_size,
+            sim,
+            num_trajs=sim.settings.num_trajs if seeds is None else len(seeds),
+            num_tasks=executor.num_tasks,
+        )
+        data.batch_size = sim.settings.batch_size
+    seeds, batch_seeds_list = plan_batches(sim, seeds, data)
+    logger.info("Starting dynamics calculation.")
+    executor.start(sim)
+
+    def batch_seeds_iter():
+        for n in executor.batch_inds(len(batch_seeds_list)):
+            logger.info("Running batch %s with seeds %s.", n + 1, batch_seeds_list[n])
+            yield n, batch_seeds_list[n]
+
+    batches = batch_seeds_iter()
+    chunk_iter = iter(lambda: list(itertools.islice(batches, executor.chunk_size)), [])
+    reporter = executor.progress_reporter(sim, len(seeds), progress_callback)
+    return seeds, data, chunk_iter, reporter
+
+
+def _next_chunks(retry_chunks, chunk_iter, num_chunks):
+    """
+    Generate the next chunks of batches to submit, starting with the chunks
+    that are retried.
+
+    .. rubric:: Args
+    retry_chunks: list
+        The chunks of batches to retry. Chunks are removed from the list as
+        they are generated.
+    chunk_iter: iterator
+        The chunks of batches that have not been submitted yet.
+    num_chunks: int
+        The maximum number of chunks to generate.
+
+    .. rubric:: Yields
+    chunk: list
+        The index and the seeds of each batch in the chunk.
+    """
+    for _ in range(num_chunks):
+        if retry_chunks:
+            yield retry_chunks.pop(0)
+        else:
+            chunk = next(chunk_iter, None)
+            if chunk is None:
+                return
+            yield chunk
+
+
+def _handle_failed_chunk(sim, chunk, error, attempts, local_data):
+    """
+    Decide what to do with a chunk of batches that raised an error.
+
+    If ``sim.settings.batch_retries`` is None the error is raised again.
+    Otherwise each batch of the chunk is retried on its own until it has
+    failed ``sim.settings.batch_retries + 1`` times, after which its seeds are
+    added to ``local_data.failed_seeds``.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    chunk: list
+        The index and the seeds of each batch in the chunk.
+    error: Exception
+        The error raised by the chunk.
+    attempts: dict
+        The number of failed attempts of each batch index.
+    local_data: Data
+        The merged output data of the batches run in this process.
+
+    .. rubric:: Returns
+    retry_chunks: list
+        The chunks of batches to retry.
+    """
+    batch_retries = sim.settings.get("batch_retries")
+    if batch_retries is None:
+        raise error
+    retry_chunks = []
+    for n, batch_seeds in chunk:
+        attempts[n] = attempts.get(n, 0) + 1
+        if attempts[n] <= batch_retries:
+            logger.warning(
+                "Batch %s failed with %r, retrying (%s of %s).",
+                n + 1,
+                error,
+                attempts[n],
+                batch_retries,
+            )
+            retry_chunks.append([(n, batch_seeds)])
+        else:
+            logger.error(
+                "Batch %s failed with %r after %s attempts, skipping seeds %s.",
+                n + 1,
+                error,
+                attempts[n],
+                batch_seeds,
+            )
+            local_data.failed_seeds = np.concatenate(
+                (local_data.failed_seeds, batch_seeds)
+            )
+    return retry_chunks
+
+
+def _finish_run(executor, seeds, data, local_data):
+    """
+    Combine the results of a simulation run with an executor into ``data``.
+
+    .. rubric:: Args
+    executor: Executor
+        The executor that ran the batches.
+    seeds: ndarray
+        The seeds of all trajectories.
+    data: Data
+        The Data object for collecting output data.
+    local_data: Data
+        The merged output data of the batches run in this process.
+
+    .. rubric:: Modifications
+    data: Data
+        The combined output data and log output are added.
+    """
+    logger.info("Dynamics calculation completed.")
+    reduced_data = executor.reduce(local_data)
+    if reduced_data is not None:
+        num_prev_seeds = len(data.data_dict["seed"])
+        # Seeds that are run again are no longer considered failed.
+        data.failed_seeds = data.failed_seeds[~np.isin(data.failed_seeds, seeds)]
+        data.add_data(reduced_data)
+        # Batches finish in arbitrary order, so restore the seeds to the order
+        # in which they were scheduled. Batches that failed or were not run
+        # because the driver stopped early are left out.
+        data.data_dict["seed"] = np.concatenate(
+            (
+                data.data_dict["seed"][:num_prev_seeds],
+                seeds[np.isin(seeds, reduced_data.data_dict["seed"])],
+            )
+        )
+        if len(reduced_data.failed_seeds) > 0:
+            logger.error(
+                "Batches with %s seeds failed and are not included in the data.",
+                len(reduced_data.failed_seeds),
+            )
+    logger.info("Simulation complete.")
+    # Attach the collected log output.
+    log = executor.gather_log(get_log_output())
+    if log is not None:
+        data.log = log
+
+
+def executor_driver(sim, executor, seeds=None, data=None, progress_callback=None):
+    """
+    Driver for the dynamics core that runs the batches with an executor.
+
+    The batches are planned once and submitted to the executor
+    ``executor.chunk_size`` batches at a time, keeping at most
+    ``executor.max_pending`` chunks in flight. Results are merged as they
+    finish and the results of all processes are combined by the executor at
+    the end.
+
+    If ``sim.settings.batch_retries`` is not None, a batch that raises an error
+    is retried up to that many times. Batches that keep failing are skipped,
+    and their seeds are stored in ``data.failed_seeds`` so that they can be run
+    again later. Otherwise the first error is raised.
+
+    The progress is reported each time a chunk of batches finishes, with a
+    progress bar if ``sim.settings.progress_bar`` is True and by calling
+    ``progress_callback``. The time each worker spent running batches is
+    stored in ``data.worker_times``.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    executor: Executor
+        The executor that runs the batches (see ``qclab.dynamics.executors``).
+    seeds: ndarray, optional
+        An array of integer seeds for the trajectories. If None, seeds will be
+        generated automatically.
+    data: Data, optional
+        A Data object for collecting output data. If None, a new Data object
+        will be created.
+    progress_callback: callable, optional
+        Called with the progress of the simulation each time a chunk of
+        batches finishes (see ``qclab.dynamics.progress.ProgressReporter``).
+
+    .. rubric:: Returns
+    data: Data
+        The updated Data object containing collected output data.
+    """
+    seeds, data, chunk_iter, reporter = _start_run(
+        sim, executor, seeds, data, progress_callback
+    )
+    local_data = Data()
+    try:
+        pending = {}
+        retry_chunks = []
+        attempts = {}
+        while True:
+            for chunk in _next_chunks(
+                retry_chunks, chunk_iter, executor.max_pending - len(pending)
+            ):
+                pending[executor.submit(chunk)] = chunk
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending.keys(), return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            # Merge the results and release them before submitting the next chunk.
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    chunk_data = future.result()
+                except Exception as e:
+                    retry_chunks.extend(
+                        _handle_failed_chunk(sim, chunk, e, attempts, local_data)
+                    )
+                    continue
+                local_data.add_data(chunk_data)
+                reporter.update(chunk_data)
+                del chunk_data
+            del done
+    except BaseException:
+        reporter.close()
+        executor.stop(terminate=True)
+        raise
+    reporter.close()
+    executor.stop()
+    _finish_run(executor, seeds, data, local_data)
+    return data
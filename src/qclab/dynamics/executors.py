@@ -0,0 +1,704 @@
+"""
+This module contains the executors used by the drivers to run batches of
+trajectories.
+
+An executor runs chunks of batches for ``qclab.dynamics.executor_driver``. It
+hands out a ``concurrent.futures.Future`` for the Data object of each chunk,
+decides which batches run in this process, and combines the results of
+several processes if needed. New parallel backends are added by subclassing
+``Executor``.
+"""
+
+import concurrent.futures
+import copy
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+import qclab.dynamics as dynamics
+from qclab.dynamics.worker_pool import WorkerPool
+from qclab.dynamics.thread_budget import available_cpus, set_thread_budget
+from qclab.dynamics.shared_results import SharedResultBuffers, shared_size
+from qclab.dynamics.progress import ProgressReporter, worker_name
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+
+def _run_chunk(sim, batch_seeds_chunk):
+    """
+    Run the dynamics core for a chunk of batches and merge their output data.
+
+    The simulation object is copied shallowly with its own settings so that
+    the batch size and time index of each batch do not change the simulation
+    object of the caller, while the model and algorithm are shared.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    batch_seeds_chunk: list
+        The index and the seeds of each batch.
+
+    .. rubric:: Returns
+    data: Data
+        The Data object containing the merged output data of the batches.
+    """
+    start_time = time.perf_counter()
+    batch_sim = copy.copy(sim)
+    batch_sim.settings = copy.copy(sim.settings)
+    chunk_data = Data()
+    for _, batch_seeds in batch_seeds_chunk:
+        # Determine the batch size from the seeds in the state object.
+        batch_sim.settings.batch_size = len(batch_seeds)
+        chunk_data.add_data(
+            dynamics.run_dynamics(
+                batch_sim, {"seed": batch_seeds}, {}, Data(batch_seeds)
+            )
+        )
+    chunk_data.worker_times = {worker_name(): time.perf_counter() - start_time}
+    return chunk_data
+
+
+class Executor:
+    """
+    Base class for the executors that run batches of trajectories.
+
+    .. rubric:: Attributes
+    num_tasks: int
+        The number of tasks used to run batches concurrently.
+    chunk_size: int
+        The number of batches submitted at a time.
+    max_pending: int
+        The maximum number of chunks in flight at any time.
+    """
+
+    num_tasks = 1
+    chunk_size = 1
+
+    @property
+    def max_pending(self):
+        # Keep at most two chunks per task in flight so that the memory used
+        # by the driver does not grow with the number of batches.
+        return 2 * self.num_tasks
+
+    def start(self, sim):
+        """
+        Prepare the executor to run batches of a simulation.
+
+        .. rubric:: Args
+        sim: Simulation
+            The simulation object containing the model, algorithm, initial state, and settings.
+        """
+        self.sim = sim
+
+    def share_result(self, func, *args, **kwargs):
+        """
+        Call a function in one process and return its result in all processes.
+
+        This is used for choices that every process has to make in the same
+        way, such as the automatic batch size.
+
+        .. rubric:: Args
+        func: callable
+            The function to call.
+        *args: any
+            The positional arguments of the function.
+        **kwargs: any
+            The keyword arguments of the function.
+
+        .. rubric:: Returns
+        result: any
+            The return value of the function.
+        """
+        return func(*args, **kwargs)
+
+    def batch_inds(self, num_batches):
+        """
+        Generate the indices of the batches to run in this process.
+
+        .. rubric:: Args
+        num_batches: int
+            The total number of batches.
+
+        .. rubric:: Yields
+        batch_ind: int
+            The index of the next batch to run.
+        """
+        return iter(range(num_batches))
+
+    def progress_reporter(self, sim, num_trajs, callback=None):
+        """
+        Create the reporter of the progress of the batches run in this process.
+
+        .. rubric:: Args
+        sim: Simulation
+            The simulation object containing the model, algorithm, initial state, and settings.
+        num_trajs: int
+            The total number of trajectories.
+        callback: callable, optional
+            Called with the progress each time a chunk of batches finishes.
+
+        .. rubric:: Returns
+        reporter: ProgressReporter
+            The progress reporter.
+        """
+        return ProgressReporter(
+            num_trajs,
+            sim.settings.tmax_n,
+            self.num_tasks,
+            progress_bar=sim.settings.get("progress_bar", True),
+            callback=callback,
+        )
+
+    def submit(self, batch_seeds_chunk):
+        """
+        Submit a chunk of batches.
+
+        .. rubric:: Args
+        batch_seeds_chunk: list
+            The index and the seeds of each batch.
+
+        .. rubric:: Returns
+        future: concurrent.futures.Future
+            A future for the Data object containing the merged output data of
+            the batches.
+        """
+        raise NotImplementedError
+
+    def reduce(self, data):
+        """
+        Combine the output data of all processes.
+
+        .. rubric:: Args
+        data: Data
+            The output data of the batches run in this process.
+
+        .. rubric:: Returns
+        data: Data or None
+            The combined output data, or None in processes that do not
+            return the results.
+        """
+        return data
+
+    def gather_log(self, log):
+        """
+        Combine the log output of all processes.
+
+        .. rubric:: Args
+        log: str
+            The log output of this process.
+
+        .. rubric:: Returns
+        log: str or None
+            The combined log output, or None in processes that do not return
+            the results.
+        """
+        return log
+
+    def stop(self, terminate=False):
+        """
+        Release the resources used to run the batches.
+
+        .. rubric:: Args
+        terminate: bool, default: False
+            If True, the batches are being abandoned because of an error and
+            any running batch may be stopped immediately.
+        """
+        self.sim = None
+
+
+class SerialExecutor(Executor):
+    """
+    Executor that runs each chunk of batches in the calling thread when it is
+    submitted.
+    """
+
+    @property
+    def max_pending(self):
+        return 1
+
+    def submit(self, batch_seeds_chunk):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(_run_chunk(self.sim, batch_seeds_chunk))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class ThreadExecutor(Executor):
+    """
+    Executor that runs chunks of batches on a pool of threads in the calling
+    process.
+
+    .. rubric:: Args
+    num_tasks: int, optional
+        The number of threads. If None, the number of available CPU cores will
+        be used.
+    """
+
+    def __init__(self, num_tasks=None):
+        if num_tasks is None:
+            num_tasks = os.cpu_count()
+        self.num_tasks = num_tasks
+        self._executor = None
+
+    def start(self, sim):
+        super().start(sim)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.num_tasks
+        )
+
+    def submit(self, batch_seeds_chunk):
+        return self._executor.submit(_run_chunk, self.sim, batch_seeds_chunk)
+
+    def stop(self, terminate=False):
+        # Running batches cannot be interrupted, so when terminating only wait
+        # for them in the background.
+        self._executor.shutdown(wait=not terminate)
+        self._executor = None
+        super().stop(terminate)
+
+
+class ProcessExecutor(Executor):
+    """
+    Executor that runs chunks of batches on a pool of worker processes.
+
+    The simulation object is sent to each worker process once, after which
+    only the seeds of each batch are sent.
+
+    .. rubric:: Args
+    num_tasks: int, optional
+        The number of worker processes. If None, the number of available CPU
+        cores will be used. Ignored if ``pool`` is given.
+    chunk_size: int, default: 1
+        The number of batches handed to a worker at a time.
+    pool: WorkerPool, optional
+        A pool of worker processes to run the batches on. If None, a new pool
+        is started in ``start`` and stopped in ``stop``.
+    shared_memory: bool, default: False
+        If True, the worker processes write the arrays of their output data
+        into shared memory blocks allocated by this process instead of sending
+        them through the pipe of the pool.
+    """
+
+    def __init__(self, num_tasks=None, chunk_size=1, pool=None, shared_memory=False):
+        if pool is not None:
+            num_tasks = pool.num_tasks
+        elif num_tasks is None:
+            num_tasks = multiprocessing.cpu_count()
+        self.num_tasks = num_tasks
+        self.chunk_size = chunk_size
+        self.pool = pool
+        self.shared_memory = shared_memory
+        self._own_pool = None
+        self._token = None
+        self._shared_buffers = None
+
+    def start(self, sim):
+        super().start(sim)
+        if self.pool is None:
+            self._own_pool = WorkerPool(self.num_tasks)
+        self._worker_pool.set_thread_budget(
+            sim.settings.get("threads_per_task"), sim.settings.get("pin_cpus", False)
+        )
+        self._token = self._worker_pool.add_simulation(sim)
+        if self.shared_memory:
+            self._shared_buffers = SharedResultBuffers()
+
+    @property
+    def _worker_pool(self):
+        if self.pool is not None:
+            return self.pool
+        return self._own_pool
+
+    def submit(self, batch_seeds_chunk):
+        future = concurrent.futures.Future()
+        shared_buffers = self._shared_buffers
+        shm_name = None
+        if shared_buffers is not None:
+            shm_name = shared_buffers.acquire()
+
+        def set_result(result):
+            _, chunk_data, layout = result
+            try:
+                if layout is not None:
+                    shared_buffers.read(chunk_data, layout, shm_name)
+                elif shared_buffers is not None and shared_buffers.size is None:
+                    # The outputs of every chunk have the same shape, so the
+                    # first one determines the size of the shared memory blocks.
+                    shared_buffers.size = shared_size(chunk_data)
+            except Exception as e:
+                set_exception(e)
+                return
+            if shm_name is not None:
+                shared_buffers.release(shm_name)
+            future.set_result(chunk_data)
+
+        def set_exception(e):
+            if shm_name is not None:
+                shared_buffers.release(shm_name)
+            future.set_exception(e)
+
+        self._worker_pool.submit(
+            self._token,
+            batch_seeds_chunk,
+            callback=set_result,
+            error_callback=set_exception,
+            shm_name=shm_name,
+        )
+        return future
+
+    def stop(self, terminate=False):
+        if self._own_pool is not None:
+            if terminate:
+                self._own_pool.terminate()
+            else:
+                self._own_pool.remove_simulation(self._token)
+                self._own_pool.close()
+            self._own_pool = None
+        elif self._token is not None:
+            # Batches of a failed run may still be running on the shared pool,
+            # so when terminating the simulation is removed after they finish.
+            self.pool.remove_simulation(self._token, wait=not terminate)
+        if self._shared_buffers is not None:
+            self._shared_buffers.close()
+            self._shared_buffers = None
+        self._token = None
+        super().stop(terminate)
+
+
+class MPIExecutor(SerialExecutor):
+    """
+    Executor that runs batches on the ranks of an MPI communicator.
+
+    Each rank runs its batches in order and the results of all ranks are
+    combined on rank 0 with collective operations. By default the batches are
+    split evenly between the ranks in advance. If ``dynamic`` is True, the
+    index of the next batch is instead taken from a counter on rank 0 that
+    every rank increments atomically with one-sided MPI operations, so that a
+    rank picks up the next batch as soon as it finishes the previous one.
+
+    .. rubric:: Args
+    num_tasks: int, optional
+        The number of ranks to split the batches over. If None, the size of
+        the communicator will be used.
+    dynamic: bool, default: False
+        If True, hand out the batches to the ranks dynamically instead of
+        splitting them evenly in advance.
+    comm: MPI.Comm, optional
+        The MPI communicator. If None, ``MPI.COMM_WORLD`` will be used.
+    """
+
+    def __init__(self, num_tasks=None, dynamic=False, comm=None):
+        try:
+            from mpi4py import MPI
+        except ImportError:
+            raise ImportError(
+                "The package mpi4py is required for the MPI executor."
+            ) from None
+        except Exception as e:
+            raise RuntimeError(
+                f"An error occurred when importing mpi4py: {e}"
+            ) from None
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        if num_tasks is None:
+            num_tasks = comm.Get_size()
+        self.num_tasks = num_tasks
+        self.dynamic = dynamic
+        self._win = None
+
+    def start(self, sim):
+        from mpi4py import MPI
+
+        super().start(sim)
+        if self.dynamic:
+            self._win = _create_counter_window(self.comm, root=0)
+        # Divide the CPU cores of each node between the ranks on that node.
+        node_comm = self.comm.Split_type(MPI.COMM_TYPE_SHARED)
+        cpus = sorted(set().union(*node_comm.allgather(available_cpus())))
+        set_thread_budget(
+            node_comm.Get_rank(),
+            node_comm.Get_size(),
+            sim.settings.get("threads_per_task"),
+            sim.settings.get("pin_cpus", False),
+            cpus,
+        )
+        node_comm.Free()
+
+    def share_result(self, func, *args, **kwargs):
+        # Call the function on rank 0 only and send its result to the other ranks.
+        result = func(*args, **kwargs) if self.rank == 0 else None
+        return self.comm.bcast(result, root=0)
+
+    def batch_inds(self, num_batches):
+        if self.dynamic:
+            return _dynamic_batch_inds(self._win, num_batches, root=0)
+        # Split the batches into chunks for each MPI process.
+        chunk_inds = np.linspace(0, num_batches, self.num_tasks + 1, dtype=int)
+        return iter(range(chunk_inds[self.rank], chunk_inds[self.rank + 1]))
+
+    def progress_reporter(self, sim, num_trajs, callback=None):
+        # The utilization is that of the worker of this rank.
+        return MPIProgressReporter(
+            self.comm,
+            num_trajs,
+            sim.settings.tmax_n,
+            1,
+            progress_bar=sim.settings.get("progress_bar", True),
+            callback=callback,
+            root=0,
+        )
+
+    def reduce(self, data):
+        logger.info("Collecting results from all tasks.")
+        return _reduce_data(self.comm, data, root=0)
+
+    def gather_log(self, log):
+        # Collect logs from all ranks and attach combined output on root rank.
+        gathered_logs = self.comm.gather(log, root=0)
+        if self.rank == 0:
+            return "".join(log for log in gathered_logs if log)
+        return None
+
+    def stop(self, terminate=False):
+        # Freeing the window is collective, so it is done once every rank has
+        # stopped fetching batch indices.
+        try:
+            if self._win is not None:
+                self._win.Free()
+        finally:
+            self._win = None
+            super().stop(terminate)
+
+
+class MPIProgressReporter(ProgressReporter):
+    """
+    Progress of a simulation run on the ranks of an MPI communicator.
+
+    Each rank adds the trajectories of its finished batches to a counter on
+    the root rank with one-sided MPI operations, so the progress of every rank
+    counts the trajectories of all ranks without waiting for the other ranks.
+    The progress bar is only shown on the root rank.
+
+    .. rubric:: Args
+    comm: MPI.Comm
+        The MPI communicator.
+    num_trajs: int
+        The number of trajectories run by all ranks.
+    num_steps: int
+        The number of update time steps of each trajectory.
+    num_tasks: int
+        The number of tasks running batches at the same time on this rank.
+    progress_bar: bool, default: True
+        If True, show a progress bar on the root rank.
+    callback: callable, optional
+        Called with the dictionary returned by ``progress`` each time a chunk
+        of batches of this rank finishes.
+    root: int, default: 0
+        The rank holding the counter.
+    """
+
+    def __init__(
+        self,
+        comm,
+        num_trajs,
+        num_steps,
+        num_tasks,
+        progress_bar=True,
+        callback=None,
+        root=0,
+    ):
+        self.comm = comm
+        self.root = root
+        self._win = _create_counter_window(comm, root=root)
+        super().__init__(
+            num_trajs,
+            num_steps,
+            num_tasks,
+            progress_bar=progress_bar and comm.Get_rank() == root,
+            callback=callback,
+        )
+
+    def _count_trajs(self, num_trajs):
+        from mpi4py import MPI
+
+        count = np.array([num_trajs], dtype=np.int64)
+        num_trajs_done = np.zeros(1, dtype=np.int64)
+        self._win.Lock(self.root, MPI.LOCK_SHARED)
+        self._win.Fetch_and_op(count, num_trajs_done, self.root, 0, MPI.SUM)
+        self._win.Unlock(self.root)
+        return int(num_trajs_done[0]) + num_trajs
+
+    def close(self):
+        # Wait until every rank has counted its trajectories, so that the final
+        # progress includes all of them.
+        self.comm.Barrier()
+        try:
+            self._set_trajs_done(self._count_trajs(0))
+        finally:
+            self._win.Free()
+        super().close()
+
+
+def _create_counter_window(comm, root=0):
+    """
+    Create an MPI window holding a counter on the root rank.
+
+    .. rubric:: Args
+    comm: MPI.Comm
+        The MPI communicator.
+    root: int, default: 0
+        The rank holding the counter.
+
+    .. rubric:: Returns
+    win: MPI.Win
+        The window exposing the counter, which starts at zero.
+    """
+    from mpi4py import MPI
+
+    if comm.Get_rank() == root:
+        counter = np.zeros(1, dtype=np.int64)
+    else:
+        counter = None
+    return MPI.Win.Create(counter, disp_unit=np.dtype(np.int64).itemsize, comm=comm)
+
+
+def _dynamic_batch_inds(win, num_batches, root=0):
+    """
+    Generate the indices of the batches to run on this rank from a counter
+    shared by all ranks.
+
+    The counter lives in an MPI window on the root rank and is incremented
+    atomically with ``Fetch_and_op``, so no rank has to wait for a dedicated
+    master to answer its request.
+
+    .. rubric:: Args
+    win: MPI.Win
+        The window holding the counter (see ``_create_counter_window``).
+    num_batches: int
+        The total number of batches.
+    root: int, default: 0
+        The rank holding the counter.
+
+    .. rubric:: Yields
+    batch_ind: int
+        The index of the next batch to run.
+    """
+    from mpi4py import MPI
+
+    one = np.ones(1, dtype=np.int64)
+    batch_ind = np.zeros(1, dtype=np.int64)
+    while True:
+        win.Lock(root, MPI.LOCK_SHARED)
+        win.Fetch_and_op(one, batch_ind, root, 0, MPI.SUM)
+        win.Unlock(root)
+        if batch_ind[0] >= num_batches:
+            return
+        yield int(batch_ind[0])
+
+
+def _reduce_data(comm, local_data, root=0):
+    """
+    Combine the Data objects of all ranks on the root rank with collective
+    operations.
+
+    Each output is reduced as a sum weighted by the normalization factor of
+    each rank and the seeds are gathered in rank order, so that no Data object
+    has to be pickled and the cost of the reduction grows logarithmically with
+    the number of ranks.
+
+    .. rubric:: Args
+    comm: MPI.Comm
+        The MPI communicator.
+    local_data: Data
+        The merged output data of the batches run on this rank.
+    root: int, default: 0
+        The rank on which the data is combined.
+
+    .. rubric:: Returns
+    data: Data or None
+        The combined output data on the root rank and None on the other ranks.
+    """
+    from mpi4py import MPI
+
+    rank = comm.Get_rank()
+    local_norm_factor = local_data.data_dict["norm_factor"]
+    # Ranks without batches have no outputs, so the shape and type of each
+    # output is shared first.
+    local_meta = {
+        key: (np.shape(val), np.asarray(val).dtype.str)
+        for key, val in local_data.data_dict.items()
+        if key not in ("seed", "norm_factor")
+    }
+    meta = {}
+    for rank_meta in comm.allgather(local_meta):
+        for key, (shape, dtype) in rank_meta.items():
+            if key in meta:
+                dtype = np.result_type(meta[key][1], dtype).str
+            meta[key] = (shape, dtype)
+    norm_factor = comm.allreduce(local_norm_factor, op=MPI.SUM)
+    # The batch statistics are only combined if every rank with batches has them.
+    local_batch_stats = local_data.batch_stats
+    has_batch_stats = comm.allreduce(
+        bool(local_batch_stats) or local_norm_factor == 0, op=MPI.LAND
+    )
+    if has_batch_stats:
+        norm_factor_sq = comm.allreduce(
+            local_batch_stats.get("norm_factor_sq", 0), op=MPI.SUM
+        )
+        m2 = {}
+    data = Data() if rank == root else None
+    for key in sorted(meta):
+        shape, dtype = meta[key]
+        dtype = np.result_type(dtype, np.float64)
+        if key in local_data.data_dict:
+            sendbuf = np.ascontiguousarray(
+                local_data.data_dict[key] * local_norm_factor, dtype=dtype
+            )
+        else:
+            sendbuf = np.zeros(shape, dtype=dtype)
+        recvbuf = np.empty(shape, dtype=dtype) if rank == root else None
+        comm.Reduce(sendbuf, recvbuf, op=MPI.SUM, root=root)
+        if rank == root:
+            data.data_dict[key] = recvbuf / norm_factor
+        if has_batch_stats:
+            # Reduce the weighted sum of the squared batch averages, from which
+            # the spread around the overall average follows.
+            if key in local_data.data_dict and key in local_batch_stats["m2"]:
+                sq_sendbuf = np.ascontiguousarray(
+                    local_batch_stats["m2"][key]
+                    + local_norm_factor * np.abs(local_data.data_dict[key]) ** 2,
+                    dtype=np.float64,
+                )
+            else:
+                sq_sendbuf = np.zeros(shape, dtype=np.float64)
+            sq_recvbuf = np.empty(shape, dtype=np.float64) if rank == root else None
+            comm.Reduce(sq_sendbuf, sq_recvbuf, op=MPI.SUM, root=root)
+            if rank == root:
+                m2[key] = np.maximum(
+                    sq_recvbuf - norm_factor * np.abs(data.data_dict[key]) ** 2, 0
+                )
+    if has_batch_stats and rank == root:
+        data.batch_stats = {"norm_factor_sq": norm_factor_sq, "m2": m2}
+    gathered_failed_seeds = comm.gather(local_data.failed_seeds, root=root)
+    if rank == root:
+        data.failed_seeds = np.concatenate(gathered_failed_seeds).astype(int)
+    gathered_worker_times = comm.gather(local_data.worker_times, root=root)
+    if rank == root:
+        for worker_times in gathered_worker_times:
+            data.worker_times.update(worker_times)
+    local_seeds = np.ascontiguousarray(local_data.data_dict["seed"], dtype=np.int64)
+    counts = comm.gather(len(local_seeds), root=root)
+    if rank == root:
+        seeds = np.empty(sum(counts), dtype=np.int64)
+        comm.Gatherv(local_seeds, (seeds, counts), root=root)
+        data.data_dict["seed"] = seeds
+        data.data_dict["norm_factor"] = norm_factor
+    else:
+        comm.Gatherv(local_seeds, None, root=root)
+    return data
@@ -0,0 +1,39 @@
+"""
+This module contains the parallel driver using threads.
+"""
+
+from qclab.dynamics.executor_driver import executor_driver
+from qclab.dynamics.executors import ThreadExecutor
+
+
+def parallel_driver_threads(sim, seeds=None, data=None, num_tasks=None):
+    """
+    Parallel driver for the dynamics core using a pool of threads in a single
+    process.
+
+    The numba functions in QC Lab are compiled with ``nogil=True`` and the
+    numpy linear algebra routines release the GIL, so batches run on separate
+    threads can execute concurrently. Compared to the multiprocessing driver,
+    no worker processes are started and the simulation object is neither
+    pickled nor duplicated in memory.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    seeds: ndarray, optional
+        An array of integer seeds for the trajectories. If None, seeds will be
+        generated automatically.
+    data: Data, optional
+        A Data object for collecting output data. If None, a new Data object
+        will be created.
+    num_tasks: int, optional
+        The number of threads to use for parallel processing. If None, the
+        number of available CPU cores will be used.
+
+    .. rubric:: Returns
+    data: Data
+        The updated Data object containing collected output data.
+    """
+    return executor_driver(
+        sim, ThreadExecutor(num_tasks=num_tasks), seeds=seeds, data=data
+    )
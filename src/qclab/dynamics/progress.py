@@ -0,0 +1,162 @@
+"""
+This module contains the progress reporting shared by the drivers.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    """
+    Get a name identifying the process and thread that runs batches.
+
+    .. rubric:: Returns
+    name: str
+        The host name, process id, and thread name.
+    """
+    return (
+        socket.gethostname()
+        + ":"
+        + str(os.getpid())
+        + ":"
+        + threading.current_thread().name
+    )
+
+
+class ProgressReporter:
+    """
+    Progress of a simulation, updated in the driver process each time a chunk
+    of batches finishes.
+
+    The progress is shown as a single progress bar and can be passed to a
+    callback. Because it is only updated once per chunk of batches, it adds
+    no work to the batches themselves.
+
+    .. rubric:: Args
+    num_trajs: int or None
+        The number of trajectories run by the driver, or None if it is not
+        known in this process.
+    num_steps: int
+        The number of update time steps of each trajectory.
+    num_tasks: int
+        The number of tasks running batches at the same time.
+    progress_bar: bool, default: True
+        If True, show a progress bar.
+    callback: callable, optional
+        Called with the dictionary returned by ``progress`` each time a chunk
+        of batches finishes.
+    """
+
+    def __init__(
+        self, num_trajs, num_steps, num_tasks, progress_bar=True, callback=None
+    ):
+        self.num_trajs = num_trajs
+        self.num_steps = num_steps
+        self.num_tasks = num_tasks
+        self.callback = callback
+        self.num_trajs_done = 0
+        self.worker_times = {}
+        self.start_time = time.perf_counter()
+        self._bar = tqdm(total=num_trajs, unit="traj", disable=not progress_bar)
+
+    def update(self, chunk_data):
+        """
+        Record a finished chunk of batches.
+
+        .. rubric:: Args
+        chunk_data: Data
+            The output data of the chunk.
+        """
+        num_trajs_done = self._count_trajs(len(chunk_data.data_dict["seed"]))
+        for name, busy_time in chunk_data.worker_times.items():
+            self.worker_times[name] = self.worker_times.get(name, 0.0) + busy_time
+        self._set_trajs_done(num_trajs_done)
+        if self.callback is not None:
+            self.callback(self.progress())
+
+    def _count_trajs(self, num_trajs):
+        """
+        Add finished trajectories to the count.
+
+        .. rubric:: Args
+        num_trajs: int
+            The number of trajectories that finished.
+
+        .. rubric:: Returns
+        num_trajs_done: int
+            The number of trajectories finished so far.
+        """
+        return self.num_trajs_done + num_trajs
+
+    def _set_trajs_done(self, num_trajs_done):
+        """
+        Set the number of finished trajectories and update the progress bar.
+
+        .. rubric:: Args
+        num_trajs_done: int
+            The number of trajectories finished so far.
+        """
+        num_trajs = num_trajs_done - self.num_trajs_done
+        self.num_trajs_done = num_trajs_done
+        if not self._bar.disable:
+            progress = self.progress()
+            self._bar.set_postfix(
+                steps_per_s=f"{progress['traj_steps_per_second']:.3g}",
+                utilization=f"{progress['mean_utilization']:.0%}",
+                refresh=False,
+            )
+            self._bar.update(num_trajs)
+
+    def progress(self):
+        """
+        Get the progress of the simulation.
+
+        .. rubric:: Returns
+        progress: dict
+            The number of trajectories finished (``num_trajs_done``) and to run
+            (``num_trajs``), the elapsed time in seconds (``elapsed``), the
+            trajectory time steps run per second (``traj_steps_per_second``),
+            the estimated time left in seconds (``eta``, None if unknown), the
+            fraction of the elapsed time each worker spent running batches
+            (``utilization``), and its average over the tasks
+            (``mean_utilization``).
+        """
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.num_trajs_done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.num_trajs is not None and rate > 0:
+            eta = (self.num_trajs - self.num_trajs_done) / rate
+        utilization = {
+            name: busy_time / elapsed if elapsed > 0 else 0.0
+            for name, busy_time in self.worker_times.items()
+        }
+        return {
+            "num_trajs_done": self.num_trajs_done,
+            "num_trajs": self.num_trajs,
+            "elapsed": elapsed,
+            "traj_steps_per_second": rate * self.num_steps,
+            "eta": eta,
+            "utilization": utilization,
+            "mean_utilization": sum(utilization.values()) / self.num_tasks,
+        }
+
+    def close(self):
+        """
+        Close the progress bar and log the throughput of the simulation.
+        """
+        self._bar.close()
+        progress = self.progress()
+        logger.info(
+            "Ran %s trajectories in %.3g s at %.3g trajectory steps per second "
+            "with a mean worker utilization of %.0f%%.",
+            progress["num_trajs_done"],
+            progress["elapsed"],
+            progress["traj_steps_per_second"],
+            100 * progress["mean_utilization"],
+        )
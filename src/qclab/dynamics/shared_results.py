@@ -0,0 +1,204 @@
+"""
+This module contains the shared-memory channel through which worker processes
+return the arrays of their output data.
+"""
+
+import logging
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Alignment in bytes of the arrays in a shared memory block.
+_ALIGNMENT = 64
+
+
+def _aligned(nbytes):
+    """
+    Round a number of bytes up to a multiple of the alignment.
+
+    .. rubric:: Args
+    nbytes: int
+        The number of bytes.
+
+    .. rubric:: Returns
+    nbytes: int
+        The aligned number of bytes.
+    """
+    return -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+
+def _shared_arrays(data):
+    """
+    Get the arrays of a Data object that are returned through shared memory.
+
+    .. rubric:: Args
+    data: Data
+        The Data object.
+
+    .. rubric:: Returns
+    arrays: list
+        The container name, key, and value of each array.
+    """
+    arrays = [
+        ("data_dict", key, val)
+        for key, val in data.data_dict.items()
+        if key not in ("seed", "norm_factor") and isinstance(val, np.ndarray)
+    ]
+    arrays += [
+        ("m2", key, val)
+        for key, val in data.batch_stats.get("m2", {}).items()
+        if isinstance(val, np.ndarray)
+    ]
+    return arrays
+
+
+def _container(data, name):
+    """
+    Get the dictionary of a Data object that holds the arrays of a container.
+
+    .. rubric:: Args
+    data: Data
+        The Data object.
+    name: str
+        The container name, either "data_dict" or "m2".
+
+    .. rubric:: Returns
+    container: dict
+        The dictionary holding the arrays.
+    """
+    if name == "data_dict":
+        return data.data_dict
+    return data.batch_stats["m2"]
+
+
+def shared_size(data):
+    """
+    Get the size of the shared memory block needed for the arrays of a Data
+    object.
+
+    .. rubric:: Args
+    data: Data
+        The Data object.
+
+    .. rubric:: Returns
+    size: int
+        The size in bytes.
+    """
+    return sum(_aligned(val.nbytes) for _, _, val in _shared_arrays(data))
+
+
+def write_shared_data(data, name):
+    """
+    Write the arrays of a Data object into a shared memory block and remove
+    them from the Data object.
+
+    .. rubric:: Args
+    data: Data
+        The Data object.
+    name: str
+        The name of the shared memory block.
+
+    .. rubric:: Returns
+    layout: list or None
+        The container name, key, offset, shape, and dtype of each array, or
+        None if the arrays do not fit in the block, in which case the Data
+        object is left unchanged.
+    """
+    arrays = _shared_arrays(data)
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        if sum(_aligned(val.nbytes) for _, _, val in arrays) > shm.size:
+            return None
+        layout = []
+        offset = 0
+        for container, key, val in arrays:
+            view = np.ndarray(val.shape, dtype=val.dtype, buffer=shm.buf, offset=offset)
+            view[...] = val
+            del view
+            layout.append((container, key, offset, val.shape, val.dtype.str))
+            offset += _aligned(val.nbytes)
+    finally:
+        shm.close()
+    for container, key, *_ in layout:
+        del _container(data, container)[key]
+    return layout
+
+
+class SharedResultBuffers:
+    """
+    Shared memory blocks that worker processes write their output data into.
+
+    The blocks are created by the driver process and reused for later chunks
+    of batches once their contents have been read, so at most one block is
+    allocated per chunk in flight. Their size is set from the first output
+    data returned through the pipe, since the outputs of every chunk of a
+    simulation have the same shape.
+    """
+
+    def __init__(self):
+        self.size = None
+        self._blocks = {}
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Get a free shared memory block.
+
+        .. rubric:: Returns
+        name: str or None
+            The name of the block, or None if the size of the blocks is not
+            known yet.
+        """
+        with self._lock:
+            if not self.size:
+                return None
+            if self._free:
+                return self._free.pop()
+            shm = shared_memory.SharedMemory(create=True, size=self.size)
+            self._blocks[shm.name] = shm
+            logger.info("Allocated a shared memory block of %s bytes.", self.size)
+            return shm.name
+
+    def release(self, name):
+        """
+        Return a shared memory block so that it can be reused.
+
+        .. rubric:: Args
+        name: str
+            The name of the block.
+        """
+        with self._lock:
+            self._free.append(name)
+
+    def read(self, data, layout, name):
+        """
+        Copy the arrays written into a shared memory block back into a Data
+        object.
+
+        .. rubric:: Args
+        data: Data
+            The Data object the arrays were removed from.
+        layout: list
+            The layout returned by ``write_shared_data``.
+        name: str
+            The name of the block.
+        """
+        buf = self._blocks[name].buf
+        for container, key, offset, shape, dtype in layout:
+            view = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+            _container(data, container)[key] = view.copy()
+            del view
+
+    def close(self):
+        """
+        Free all shared memory blocks.
+        """
+        with self._lock:
+            for shm in self._blocks.values():
+                shm.close()
+                shm.unlink()
+            self._blocks = {}
+            self._free = []
@@ -0,0 +1,354 @@
+"""
+This module contains the parameter sweep driver.
+"""
+
+import copy
+import functools
+import logging
+import os
+import numpy as np
+from qclab import ingredients
+from qclab.dynamics.batch_size import auto_batch_size
+from qclab.dynamics.executor_driver import executor_driver
+from qclab.dynamics.executors import SerialExecutor
+from qclab.model import Model
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+# Vectorized ingredients that can be evaluated separately for the trajectories
+# of each parameter point in a packed batch.
+_PACKED_INGREDIENTS = ("h_q", "h_qc", "h_c", "dh_qc_dzc", "dh_c_dzc", "init_classical")
+# Per-trajectory ingredients that only depend on the constants in
+# _PACKED_CONSTANTS, so they can be evaluated with the constants of any point.
+_SHARED_INGREDIENTS = {"hop": (ingredients.hop_harmonic, ingredients.hop_free)}
+# Constants used by the algorithm tasks, which must agree between the points.
+_PACKED_CONSTANTS = (
+    "num_quantum_states",
+    "num_classical_coordinates",
+    "classical_coordinate_mass",
+    "classical_coordinate_weight",
+    "harmonic_frequency",
+)
+
+
+def _packed_ingredient(name, model, parameters, **kwargs):
+    """
+    Evaluate an ingredient of a packed model by evaluating the ingredient of
+    each parameter point for its block of trajectories.
+
+    .. rubric:: Args
+    name: str
+        The name of the ingredient.
+    model: _PackedModel
+        The packed model.
+    parameters: dict
+        The parameters object.
+    **kwargs:
+        The keyword arguments of the ingredient.
+
+    .. rubric:: Returns
+    out: ndarray or tuple
+        The output of the ingredient for the whole batch.
+    """
+    num_points = len(model.point_models)
+    point_kwargs = [dict(kwargs) for _ in range(num_points)]
+    for key, val in kwargs.items():
+        if key in ("z", "seed"):
+            for p, block in enumerate(np.split(val, num_points)):
+                point_kwargs[p][key] = block
+        elif key == "batch_size":
+            for p in range(num_points):
+                point_kwargs[p][key] = val // num_points
+    outs = [
+        point_model.get(name)[0](point_model, parameters, **point_kwargs[p])
+        for p, point_model in enumerate(model.point_models)
+    ]
+    if name == "dh_qc_dzc":
+        # Offset the batch indices of the sparse gradient of each point.
+        block_size = outs[0][2][0]
+        inds = tuple(
+            np.concatenate(
+                [
+                    out[0][n] + (p * block_size if n == 0 else 0)
+                    for p, out in enumerate(outs)
+                ]
+            )
+            for n in range(len(outs[0][0]))
+        )
+        mels = np.concatenate([out[1] for out in outs])
+        shape = (block_size * num_points, *outs[0][2][1:])
+        return inds, mels, shape
+    return np.concatenate(outs)
+
+
+class _PackedModel(Model):
+    """
+    Model that runs the trajectories of several parameter points of the same
+    model in one batch.
+
+    A batch is divided into one block of trajectories per point, in order, and
+    the vectorized ingredients are evaluated for each block with the constants
+    of its point.
+
+    .. rubric:: Args
+    point_models: list
+        The model of each parameter point.
+    """
+
+    def __init__(self, point_models):
+        super().__init__()
+        self.point_models = point_models
+        self.constants = point_models[0].constants
+        self.ingredients = [
+            (name, functools.partial(_packed_ingredient, name))
+            for name in _PACKED_INGREDIENTS
+        ]
+        for name in _SHARED_INGREDIENTS:
+            ingredient, has_ingredient = point_models[0].get(name)
+            if has_ingredient:
+                self.ingredients.append((name, ingredient))
+        self.update_h_q = point_models[0].update_h_q
+        self.update_dh_qc_dzc = point_models[0].update_dh_qc_dzc
+
+
+def _can_pack(point_models):
+    """
+    Check if the trajectories of the parameter points can be run in the same
+    batches.
+
+    .. rubric:: Args
+    point_models: list
+        The model of each parameter point.
+
+    .. rubric:: Returns
+    can_pack: bool
+        True if the points can be packed.
+    """
+    model = point_models[0]
+    names = {ingredient[0] for ingredient in model.ingredients}
+    for name in names:
+        if name.startswith("_init_") or name in _PACKED_INGREDIENTS:
+            continue
+        ingredient, has_ingredient = model.get(name)
+        if has_ingredient and ingredient not in _SHARED_INGREDIENTS.get(name, ()):
+            logger.info("Not packing the sweep because of the ingredient %s.", name)
+            return False
+    for name in _PACKED_INGREDIENTS + tuple(_SHARED_INGREDIENTS):
+        if not model.get(name)[1]:
+            logger.info("Not packing the sweep because %s is missing.", name)
+            return False
+    for point_model in point_models[1:]:
+        if type(point_model) is not type(model) or (
+            point_model.update_h_q,
+            point_model.update_dh_qc_dzc,
+        ) != (model.update_h_q, model.update_dh_qc_dzc):
+            return False
+        for name in _PACKED_CONSTANTS:
+            if not np.array_equal(
+                point_model.constants.get(name), model.constants.get(name)
+            ):
+                logger.info("Not packing the sweep because %s differs.", name)
+                return False
+    return True
+
+
+def _sum_point_outputs(sim, state, parameters, **kwargs):
+    """
+    Replace each output of a packed batch by the sum over the trajectories of
+    each parameter point.
+
+    .. rubric:: Keyword Arguments
+    num_points: int
+        The number of parameter points in the batch.
+
+    .. rubric:: Modifications
+    state["output_dict"] : dict
+        Each output has the shape ``(1, num_points, *output_shape)``.
+    """
+    num_points = kwargs["num_points"]
+    for key, val in state["output_dict"].items():
+        state["output_dict"][key] = np.sum(
+            np.reshape(val, (num_points, -1, *np.shape(val)[1:])), axis=1
+        )[np.newaxis]
+    return state, parameters
+
+
+def _unpack_data(packed_data, point_seeds, num_points):
+    """
+    Split the output data of a packed sweep into the data of each point.
+
+    .. rubric:: Args
+    packed_data: Data
+        The output data of the packed sweep.
+    point_seeds: ndarray
+        The seeds of the trajectories of each point.
+    num_points: int
+        The number of parameter points.
+
+    .. rubric:: Returns
+    data_list: list
+        The Data object of each point.
+    """
+    data_list = []
+    norm_factor = packed_data.data_dict["norm_factor"]
+    for p in range(num_points):
+        data = Data(point_seeds[np.isin(point_seeds, packed_data.data_dict["seed"])])
+        data.log = packed_data.log
+        data.failed_seeds = np.unique(packed_data.failed_seeds)
+        if norm_factor == 0:
+            data_list.append(data)
+            continue
+        # Each point holds an equal share of the trajectories of every batch,
+        # and its outputs were normalized by the number of all trajectories.
+        data.data_dict["norm_factor"] = norm_factor // num_points
+        for key, val in packed_data.data_dict.items():
+            if key not in ("seed", "norm_factor"):
+                data.data_dict[key] = num_points * val[:, p]
+        if packed_data.batch_stats:
+            data.batch_stats = {
+                "norm_factor_sq": packed_data.batch_stats["norm_factor_sq"]
+                / num_points**2,
+                "m2": {
+                    key: num_points * val[:, p]
+                    for key, val in packed_data.batch_stats["m2"].items()
+                },
+            }
+        data_list.append(data)
+    return data_list
+
+
+def sweep_driver(
+    sim,
+    constants_list,
+    executor=None,
+    seeds=None,
+    data_list=None,
+    pack=True,
+    progress_callback=None,
+):
+    """
+    Driver for the dynamics core that runs a simulation for several sets of
+    model constants.
+
+    The model of each parameter point is a copy of ``sim.model`` with the
+    constants in the corresponding entry of ``constants_list`` changed. If
+    ``pack`` is True and the points only differ in constants used by the
+    vectorized ingredients of the model (``h_q``, ``h_qc``, ``h_c``,
+    ``dh_qc_dzc``, ``dh_c_dzc`` and ``init_classical``), the trajectories of
+    all points are run together in the same batches, so that many small
+    simulations run with the throughput of large batches. Each batch then
+    holds ``sim.settings.batch_size`` trajectories divided evenly between the
+    points. Otherwise the points are run one after the other.
+
+    Every point uses the same seeds, so the results of each point are the same
+    as those of a separate simulation with the same seeds.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    constants_list: list
+        The model constants of each parameter point as a dictionary, for
+        example ``[{"kBT": 0.5}, {"kBT": 1.0}]``.
+    executor: Executor, optional
+        The executor that runs the batches. If None, a ``SerialExecutor`` is
+        used.
+    seeds: ndarray, optional
+        An array of integer seeds for the trajectories of each point. If None,
+        seeds will be generated automatically.
+    data_list: list, optional
+        A Data object for each point to add the output data to. If None, new
+        Data objects will be created.
+    pack: bool, default: True
+        If True, run the trajectories of different points in the same batches
+        when possible.
+    progress_callback: callable, optional
+        Called with the progress of each run of the executor driver each time
+        a chunk of batches finishes.
+
+    .. rubric:: Returns
+    data_list: list
+        The Data object of each point containing its collected output data.
+    """
+    if executor is None:
+        executor = SerialExecutor()
+    num_points = len(constants_list)
+    if data_list is None:
+        data_list = [Data() for _ in range(num_points)]
+    point_models = []
+    for constants in constants_list:
+        point_model = copy.deepcopy(sim.model)
+        for key, val in constants.items():
+            setattr(point_model.constants, key, val)
+        point_model.initialize_constants()
+        point_models.append(point_model)
+    if seeds is None:
+        prev_seeds = np.concatenate([data.data_dict["seed"] for data in data_list])
+        offset = np.max(prev_seeds) + 1 if len(prev_seeds) > 0 else 0
+        seeds = offset + np.arange(sim.settings.num_trajs, dtype=int)
+    num_trajs = len(seeds)
+    checkpoint_dir = sim.settings.get("checkpoint_dir")
+    if not (pack and num_points > 1 and _can_pack(point_models)):
+        for p, point_model in enumerate(point_models):
+            logger.info("Running parameter point %s of %s.", p + 1, num_points)
+            point_sim = copy.copy(sim)
+            point_sim.settings = copy.copy(sim.settings)
+            point_sim.model = point_model
+            if checkpoint_dir is not None:
+                # The points share their seeds, so they need their own checkpoints.
+                point_sim.settings.checkpoint_dir = os.path.join(
+                    checkpoint_dir, "point_" + str(p)
+                )
+            data_list[p] = executor_driver(
+                point_sim,
+                executor,
+                seeds=seeds,
+                data=data_list[p],
+                progress_callback=progress_callback,
+            )
+        return data_list
+    logger.info("Packing %s parameter points into the same batches.", num_points)
+    packed_sim = copy.copy(sim)
+    packed_sim.settings = copy.copy(sim.settings)
+    packed_sim.model = point_models[0]
+    packed_sim.initialize_timesteps()
+    batch_size = packed_sim.settings.batch_size
+    if isinstance(batch_size, str) and batch_size == "auto":
+        batch_size = executor.share_result(
+            auto_batch_size,
+            packed_sim,
+            num_trajs=num_points * num_trajs,
+            num_tasks=executor.num_tasks,
+        )
+    # Number of trajectories that a block has to be a multiple of.
+    if sim.algorithm.settings.get("fssh_deterministic", False):
+        unit = point_models[0].constants.num_quantum_states
+    else:
+        unit = 1
+    block_size = max(batch_size // num_points // unit, 1) * unit
+    packed_sim.settings.batch_size = block_size * num_points
+    packed_sim.model = _PackedModel(point_models)
+    packed_sim.algorithm = copy.copy(sim.algorithm)
+    packed_sim.algorithm.collect_recipe = [
+        *sim.algorithm.collect_recipe,
+        functools.partial(_sum_point_outputs, num_points=num_points),
+    ]
+    if checkpoint_dir is not None:
+        packed_sim.settings.checkpoint_dir = os.path.join(checkpoint_dir, "packed")
+    # Each batch holds one block of trajectories of every point.
+    packed_seeds = np.concatenate(
+        [
+            np.tile(seeds[n : n + block_size], num_points)
+            for n in range(0, num_trajs, block_size)
+        ]
+    )
+    packed_data = executor_driver(
+        packed_sim, executor, seeds=packed_seeds, progress_callback=progress_callback
+    )
+    for data, point_data in zip(
+        data_list, _unpack_data(packed_data, seeds, num_points)
+    ):
+        data.add_data(point_data)
+        if isinstance(sim.settings.batch_size, str):
+            data.batch_size = packed_sim.settings.batch_size
+    return data_list
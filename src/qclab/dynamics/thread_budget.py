@@ -0,0 +1,90 @@
+"""
+This module contains functions for limiting the number of threads used by
+each parallel task and for pinning tasks to CPU cores.
+"""
+
+import logging
+import multiprocessing
+import os
+import threadpoolctl
+from qclab.utils import DISABLE_NUMBA
+
+logger = logging.getLogger(__name__)
+
+# Environment variables read by BLAS and OpenMP libraries when they are loaded.
+_THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def available_cpus():
+    """
+    Get the CPU cores the current process is allowed to run on.
+
+    .. rubric:: Returns
+    cpus: list
+        The indices of the available CPU cores.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def set_thread_budget(
+    task_ind, num_tasks, threads_per_task=None, pin_cpus=False, cpus=None
+):
+    """
+    Limit the number of threads used by BLAS and numba in the current process
+    and optionally pin it to a set of CPU cores.
+
+    The limits are applied at runtime with threadpoolctl, and the thread
+    environment variables are set for libraries that have not been loaded yet.
+
+    .. rubric:: Args
+    task_ind: int
+        The index of the task running in the current process.
+    num_tasks: int
+        The number of tasks sharing ``cpus``.
+    threads_per_task: int, optional
+        The number of threads of each task. If None, the CPU cores are divided
+        evenly between the tasks.
+    pin_cpus: bool, default: False
+        If True, pin the current process to ``threads_per_task`` CPU cores,
+        such that consecutive tasks use consecutive cores.
+    cpus: list, optional
+        The CPU cores shared by the tasks. If None, the cores available to the
+        current process will be used.
+
+    .. rubric:: Returns
+    threads_per_task: int
+        The number of threads of each task.
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    if threads_per_task is None:
+        threads_per_task = max(len(cpus) // num_tasks, 1)
+    for var in _THREAD_ENV_VARS:
+        os.environ[var] = str(threads_per_task)
+    threadpoolctl.threadpool_limits(limits=threads_per_task)
+    if not DISABLE_NUMBA:
+        import numba
+
+        numba.set_num_threads(min(threads_per_task, numba.config.NUMBA_NUM_THREADS))
+    if pin_cpus:
+        if hasattr(os, "sched_setaffinity"):
+            start = task_ind * threads_per_task
+            task_cpus = {
+                cpus[(start + n) % len(cpus)]
+                for n in range(min(threads_per_task, len(cpus)))
+            }
+            os.sched_setaffinity(0, task_cpus)
+            logger.info("Pinned task %s to CPU cores %s.", task_ind, sorted(task_cpus))
+        else:
+            logger.warning("Pinning to CPU cores is not supported on this platform.")
+    logger.info("Limited task %s to %s threads.", task_ind, threads_per_task)
+    return threads_per_task
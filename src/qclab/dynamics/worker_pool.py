@@ -0,0 +1,374 @@
+"""
+This module contains the WorkerPool class used by the multiprocessing driver.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+import logging
+import pickle
+from multiprocessing import resource_tracker, shared_memory
+import qclab.dynamics as dynamics
+from qclab.dynamics.thread_budget import available_cpus, set_thread_budget
+from qclab.dynamics.shared_results import write_shared_data
+from qclab.dynamics.progress import worker_name
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+# Barrier shared by the worker processes, used to run a task once in each worker.
+_worker_barrier = None
+# Index of the worker process within the pool.
+_worker_ind = None
+# Simulation objects cached in each worker process, keyed by their token.
+_worker_sims = {}
+
+
+def _initialize_worker(barrier, counter):
+    """
+    Initialize a worker process.
+
+    .. rubric:: Args
+    barrier: multiprocessing.Barrier
+        The barrier shared by all worker processes of the pool.
+    counter: multiprocessing.Value
+        The number of worker processes started so far, used to give each
+        worker process its index.
+    """
+    global _worker_barrier, _worker_ind
+    _worker_barrier = barrier
+    with counter.get_lock():
+        _worker_ind = counter.value
+        counter.value += 1
+
+
+def _set_worker_thread_budget(num_tasks, threads_per_task, pin_cpus, cpus):
+    """
+    Limit the threads of a worker process and optionally pin it to CPU cores.
+
+    .. rubric:: Args
+    num_tasks: int
+        The number of worker processes in the pool.
+    threads_per_task: int or None
+        The number of threads of each worker process.
+    pin_cpus: bool
+        If True, pin the worker process to CPU cores.
+    cpus: list
+        The CPU cores shared by the worker processes.
+    """
+    # Worker processes that replace a failed one reuse the cores of the pool.
+    set_thread_budget(
+        _worker_ind % num_tasks, num_tasks, threads_per_task, pin_cpus, cpus
+    )
+
+
+def _run_synchronized(func_args):
+    """
+    Run a function in a worker process and wait until every other worker
+    process has done the same.
+
+    Waiting on the barrier prevents a worker from picking up a second copy of
+    the same task, so that the function runs exactly once in each worker.
+
+    .. rubric:: Args
+    func_args: tuple
+        The function to run and its arguments.
+
+    .. rubric:: Returns
+    out: any
+        The output of the function.
+    """
+    func, args = func_args
+    out = func(*args)
+    _worker_barrier.wait()
+    return out
+
+
+def _load_simulation(token):
+    """
+    Load a simulation object from shared memory and cache it in a worker process.
+
+    This is used to install a simulation in every worker process, and to load it
+    into a worker process that replaced a failed one.
+
+    .. rubric:: Args
+    token: str
+        The token identifying the simulation, which is also the name of the
+        shared memory block holding the pickled simulation object.
+    """
+    shm = shared_memory.SharedMemory(name=token)
+    try:
+        # Bytes after the end of the pickle are ignored.
+        sim = pickle.loads(bytes(shm.buf))
+    finally:
+        shm.close()
+    _worker_sims[token] = sim
+
+
+def _remove_simulation(token):
+    """
+    Remove a simulation object from the cache of a worker process.
+
+    .. rubric:: Args
+    token: str
+        The token identifying the simulation.
+    """
+    _worker_sims.pop(token, None)
+
+
+def _run_batches(token, batch_seeds_chunk, shm_name=None):
+    """
+    Run the dynamics core for a chunk of batches in a worker process and merge
+    their output data.
+
+    .. rubric:: Args
+    token: str
+        The token identifying the simulation.
+    batch_seeds_chunk: list
+        The index and the seeds of each batch.
+    shm_name: str, optional
+        The name of a shared memory block to write the arrays of the output
+        data into instead of returning them.
+
+    .. rubric:: Returns
+    batch_inds: list
+        The indices of the batches.
+    data: Data
+        The Data object containing the merged output data of the batches.
+    layout: list or None
+        The layout of the arrays written into the shared memory block, or None
+        if the arrays are returned in ``data``.
+    """
+    start_time = time.perf_counter()
+    sim = _worker_sims.get(token)
+    if sim is None:
+        # The worker process was started after the simulation was installed.
+        logger.info("Loading simulation %s into a new worker process.", token)
+        _load_simulation(token)
+        sim = _worker_sims[token]
+    batch_inds = []
+    chunk_data = Data()
+    for batch_ind, batch_seeds in batch_seeds_chunk:
+        # Determine the batch size from the seeds in the state object.
+        sim.settings.batch_size = len(batch_seeds)
+        chunk_data.add_data(
+            dynamics.run_dynamics(sim, {"seed": batch_seeds}, {}, Data(batch_seeds))
+        )
+        batch_inds.append(batch_ind)
+    chunk_data.worker_times = {worker_name(): time.perf_counter() - start_time}
+    layout = None
+    if shm_name is not None:
+        layout = write_shared_data(chunk_data, shm_name)
+    return batch_inds, chunk_data, layout
+
+
+class WorkerPool:
+    """
+    Pool of worker processes that can be shared between calls of the
+    multiprocessing driver.
+
+    The worker processes are started once and stay alive until the pool is
+    closed, so repeated simulations do not pay for starting the processes,
+    importing QC Lab, and compiling the numba functions more than once.
+
+    Simulations are installed in each worker once, after which only the seeds
+    of each batch are sent to the workers. The pickled simulation is kept in
+    shared memory, so that worker processes that replace failed ones can load it.
+
+    .. rubric:: Args
+    num_tasks: int, optional
+        The number of worker processes. If None, the number of available CPU
+        cores will be used.
+    """
+
+    def __init__(self, num_tasks=None):
+        if num_tasks is None:
+            num_tasks = multiprocessing.cpu_count()
+        self.num_tasks = num_tasks
+        # Shared memory blocks holding the pickled simulations, keyed by token.
+        self._payloads = {}
+        # Broadcasting tasks to all workers must not interleave, otherwise a
+        # worker could pass the barrier twice for different broadcasts.
+        self._broadcast_lock = threading.Lock()
+        if os.name == "posix":
+            # Start the resource tracker before the worker processes so that
+            # they share it, otherwise shared memory blocks opened by a worker
+            # would be removed when the worker exits.
+            resource_tracker.ensure_running()
+        self._pool = multiprocessing.Pool(
+            processes=num_tasks,
+            initializer=_initialize_worker,
+            initargs=(
+                multiprocessing.Barrier(num_tasks),
+                multiprocessing.Value("i", 0),
+            ),
+        )
+        # The CPU cores are read before any worker process is pinned.
+        self._cpus = available_cpus()
+        logger.info("Started worker pool with %s processes.", num_tasks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def close(self):
+        """
+        Wait for the submitted batches to finish and stop the worker processes.
+        """
+        self._pool.close()
+        self._pool.join()
+        self._release_payloads()
+
+    def terminate(self):
+        """
+        Stop the worker processes immediately.
+        """
+        self._pool.terminate()
+        self._pool.join()
+        self._release_payloads()
+
+    def _release_payloads(self, tokens=None):
+        """
+        Remove the shared memory blocks holding pickled simulations.
+
+        .. rubric:: Args
+        tokens: list, optional
+            The tokens of the simulations. If None, all blocks are removed.
+        """
+        if tokens is None:
+            tokens = list(self._payloads)
+        for token in tokens:
+            shm = self._payloads.pop(token, None)
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def broadcast(self, func, *args):
+        """
+        Run a function exactly once in every worker process.
+
+        .. rubric:: Args
+        func: callable
+            The function to run. It must be picklable.
+        *args: any
+            The arguments of the function.
+
+        .. rubric:: Returns
+        out: list
+            The output of the function in each worker process.
+        """
+        with self._broadcast_lock:
+            return self._pool.map(
+                _run_synchronized, [(func, args)] * self.num_tasks, chunksize=1
+            )
+
+    def _broadcast_async(self, func, *args):
+        """
+        Run a function exactly once in every worker process without waiting for it.
+
+        The tasks are queued behind the batches already submitted to the pool,
+        so each worker process runs the function after it has finished those.
+
+        .. rubric:: Args
+        func: callable
+            The function to run. It must be picklable.
+        *args: any
+            The arguments of the function.
+        """
+        with self._broadcast_lock:
+            self._pool.map_async(
+                _run_synchronized, [(func, args)] * self.num_tasks, chunksize=1
+            )
+
+    def set_thread_budget(self, threads_per_task=None, pin_cpus=False):
+        """
+        Limit the number of threads used by BLAS and numba in every worker
+        process and optionally pin each worker process to its own CPU cores.
+
+        .. rubric:: Args
+        threads_per_task: int, optional
+            The number of threads of each worker process. If None, the CPU
+            cores are divided evenly between the worker processes.
+        pin_cpus: bool, default: False
+            If True, pin each worker process to ``threads_per_task`` CPU cores.
+        """
+        self.broadcast(
+            _set_worker_thread_budget,
+            self.num_tasks,
+            threads_per_task,
+            pin_cpus,
+            self._cpus,
+        )
+
+    def add_simulation(self, sim):
+        """
+        Install a simulation object in every worker process.
+
+        .. rubric:: Args
+        sim: Simulation
+            The simulation object containing the model, algorithm, initial state, and settings.
+
+        .. rubric:: Returns
+        token: str
+            The token identifying the simulation in the worker processes.
+        """
+        payload = pickle.dumps(sim)
+        shm = shared_memory.SharedMemory(create=True, size=len(payload))
+        shm.buf[: len(payload)] = payload
+        token = shm.name
+        self._payloads[token] = shm
+        try:
+            self.broadcast(_load_simulation, token)
+        except BaseException:
+            self._release_payloads([token])
+            raise
+        return token
+
+    def remove_simulation(self, token, wait=True):
+        """
+        Remove a simulation object from every worker process.
+
+        .. rubric:: Args
+        token: str
+            The token identifying the simulation in the worker processes.
+        wait: bool, default: True
+            If False, return immediately and remove the simulation from each
+            worker process once the batches submitted before have finished.
+        """
+        try:
+            if wait:
+                self.broadcast(_remove_simulation, token)
+            else:
+                self._broadcast_async(_remove_simulation, token)
+        finally:
+            self._release_payloads([token])
+
+    def submit(self, token, batch_seeds_chunk, callback, error_callback, shm_name=None):
+        """
+        Submit a chunk of batches to the worker processes.
+
+        .. rubric:: Args
+        token: str
+            The token identifying the simulation in the worker processes.
+        batch_seeds_chunk: list
+            The index and the seeds of each batch.
+        callback: callable
+            Called with ``(batch_inds, data, layout)`` when the chunk finishes.
+        error_callback: callable
+            Called with the exception if the chunk fails.
+        shm_name: str, optional
+            The name of a shared memory block the worker process writes the
+            arrays of the output data into (see ``_run_batches``).
+        """
+        self._pool.apply_async(
+            _run_batches,
+            (token, batch_seeds_chunk, shm_name),
+            callback=callback,
+            error_callback=error_callback,
+        )
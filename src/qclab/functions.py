@@ -6,6 +6,7 @@ dynamics drivers.
 
 import logging
 import functools
+import collections
 import numpy as np
 from qclab.utils import njit
 import qclab.numerical_constants as numerical_constants
@@ -102,8 +103,75 @@ def transform_mat(mat, basis, adb_to_db=False):
     return out
 
 
-@njit
-def update_z_rk4_k123_sum(z_k, classical_force, quantum_classical_force, dt_update):
+def state_buffer(state, name, shape, dtype=complex):
+    """
+    Get a preallocated array stored in the state object to write the output of
+    a task into.
+
+    The array ``state[name]`` is reused if it is a writeable ndarray with the
+    requested shape and dtype, so that a task called at every time step only
+    allocates its output once per batch. Otherwise a new (uninitialized) array
+    is allocated and stored in the state object. The array must not be shared
+    with other variables in the state object, since it is overwritten in place.
+
+    .. rubric:: Args
+    state : dict
+        The state object.
+    name : str
+        Name of the array in the state object.
+    shape : tuple
+        Shape of the array.
+    dtype : data-type, default: complex
+        Data type of the array.
+
+    .. rubric:: Returns
+    out : ndarray
+        The array ``state[name]``.
+    """
+    out = state.get(name)
+    if (
+        isinstance(out, np.ndarray)
+        and out.shape == tuple(shape)
+        and out.dtype == dtype
+        and out.flags.writeable
+        and out.flags.c_contiguous
+    ):
+        return out
+    out = np.empty(shape, dtype=dtype)
+    state[name] = out
+    return out
+
+
+def bind_task(binder):
+    """
+    Decorator that attaches a binder to a task, which ``Algorithm.compile_recipe``
+    uses to resolve the keyword arguments, settings, and ingredients of the task
+    once per batch instead of at every call.
+
+    The binder is called as ``binder(sim, **kwargs)`` with the keyword arguments
+    given to the task in the recipe, and returns a function with the signature
+    ``step(sim, state, parameters)`` that carries out the task.
+
+    .. rubric:: Args
+    binder : function
+        Binder of the task.
+
+    .. rubric:: Returns
+    decorator : function
+        Decorator that stores the binder as the ``bind`` attribute of the task.
+    """
+
+    def decorator(task):
+        task.bind = binder
+        return task
+
+    return decorator
+
+
+@njit(nogil=True)
+def update_z_rk4_k123_sum(
+    z_k, classical_force, quantum_classical_force, dt_update, out=None, k=None
+):
     """
     Low-level function to calculate the intermediate z coordinate and k values
     for RK4 update. Applies to steps 1-3.
@@ -117,6 +185,11 @@ def update_z_rk4_k123_sum(z_k, classical_force, quantum_classical_force, dt_upda
         Quantum-classical force.
     dt_update : float
         Time step for the update.
+    out : ndarray | None
+        Preallocated array for the updated coordinates. If ``None``, a new
+        array is created.
+    k : ndarray | None
+        Preallocated array for the k value. If ``None``, a new array is created.
 
     .. rubric:: Returns
     out : ndarray
@@ -125,8 +198,10 @@ def update_z_rk4_k123_sum(z_k, classical_force, quantum_classical_force, dt_upda
         The k value used in the RK4 update.
     """
     batch_size, num_classical_coordinates = z_k.shape
-    k = np.empty((batch_size, num_classical_coordinates), dtype=np.complex128)
-    out = np.empty((batch_size, num_classical_coordinates), dtype=np.complex128)
+    if k is None:
+        k = np.empty((batch_size, num_classical_coordinates), dtype=np.complex128)
+    if out is None:
+        out = np.empty((batch_size, num_classical_coordinates), dtype=np.complex128)
     for i in range(z_k.shape[0]):
         for j in range(z_k.shape[1]):
             k[i, j] = -1j * (classical_force[i, j] + quantum_classical_force[i, j])
@@ -134,7 +209,7 @@ def update_z_rk4_k123_sum(z_k, classical_force, quantum_classical_force, dt_upda
     return out, k
 
 
-@njit
+@njit(nogil=True)
 def update_z_rk4_k4_sum(
     z_0, k1, k2, k3, classical_force, quantum_classical_force, dt_update
 ):
@@ -172,7 +247,316 @@ def update_z_rk4_k4_sum(
     return z_0
 
 
-@njit
+@njit(nogil=True)
+def update_wf_db_rk4_step(wf_db, h_q_tot, dt_update, work):
+    """
+    Low-level function to propagate a wavefunction by one time step using the
+    4th-order Runge-Kutta method, in place.
+
+    .. rubric:: Args
+    wf_db : ndarray
+        Diabatic wavefunction with shape ``(batch_size, num_quantum_states)``,
+        overwritten with the propagated wavefunction.
+    h_q_tot : ndarray
+        Quantum Hamiltonian with shape
+        ``(batch_size, num_quantum_states, num_quantum_states)``.
+    dt_update : float
+        Time step for the update.
+    work : ndarray
+        Complex work array with shape ``(3, num_quantum_states)``.
+
+    .. rubric:: Returns
+    wf_db : ndarray
+        Propagated diabatic wavefunction.
+    """
+    batch_size, num_quantum_states = wf_db.shape
+    k = work[0]
+    wf_k = work[1]
+    k_sum = work[2]
+    for t in range(batch_size):
+        for i in range(num_quantum_states):
+            wf_k[i] = wf_db[t, i]
+            k_sum[i] = 0.0
+        for step in range(4):
+            if step == 0:
+                weight, dt_factor = 1.0, 0.5
+            elif step == 1:
+                weight, dt_factor = 2.0, 0.5
+            elif step == 2:
+                weight, dt_factor = 2.0, 1.0
+            else:
+                weight, dt_factor = 1.0, 0.0
+            for i in range(num_quantum_states):
+                acc = 0.0j
+                for j in range(num_quantum_states):
+                    acc += h_q_tot[t, i, j] * wf_k[j]
+                k[i] = -1j * acc
+            for i in range(num_quantum_states):
+                k_sum[i] += weight * k[i]
+                wf_k[i] = wf_db[t, i] + dt_factor * dt_update * k[i]
+        for i in range(num_quantum_states):
+            wf_db[t, i] += (dt_update / 6.0) * k_sum[i]
+    return wf_db
+
+
+@njit(nogil=True)
+def update_wf_db_propagator_step(wf_db, eigvals, eigvecs, dt_update, work):
+    """
+    Low-level function to propagate a wavefunction by one time step using the
+    propagator of its eigenvalues and eigenvectors, in place.
+
+    The wavefunction is transformed to the adiabatic basis, multiplied by the
+    phases ``exp(-i E dt)`` and transformed back, so that the propagator itself
+    is never constructed.
+
+    .. rubric:: Args
+    wf_db : ndarray
+        Diabatic wavefunction with shape ``(batch_size, num_quantum_states)``,
+        overwritten with the propagated wavefunction.
+    eigvals : ndarray
+        Eigenvalues with shape ``(batch_size, num_quantum_states)``.
+    eigvecs : ndarray
+        Eigenvectors with shape
+        ``(batch_size, num_quantum_states, num_quantum_states)``.
+    dt_update : float
+        Time step for the update.
+    work : ndarray
+        Complex work array with shape ``(num_quantum_states,)``.
+
+    .. rubric:: Returns
+    wf_db : ndarray
+        Propagated diabatic wavefunction.
+    """
+    batch_size, num_quantum_states = wf_db.shape
+    wf_adb = work
+    for t in range(batch_size):
+        for k in range(num_quantum_states):
+            wf_adb[k] = 0.0
+        for i in range(num_quantum_states):
+            for k in range(num_quantum_states):
+                wf_adb[k] += np.conj(eigvecs[t, i, k]) * wf_db[t, i]
+        for k in range(num_quantum_states):
+            wf_adb[k] *= np.exp(-1j * eigvals[t, k] * dt_update)
+        for i in range(num_quantum_states):
+            acc = 0.0j
+            for k in range(num_quantum_states):
+                acc += eigvecs[t, i, k] * wf_adb[k]
+            wf_db[t, i] = acc
+    return wf_db
+
+
+@njit(nogil=True)
+def eigh_2x2(matrix, eigvals, eigvecs):
+    """
+    Low-level function to calculate the eigenvalues and eigenvectors of a batch
+    of 2x2 Hermitian matrices in closed form.
+
+    The eigenvalues are returned in ascending order and the first element of
+    each eigenvector is real and non-negative, as with ``np.linalg.eigh`` up to
+    the phase of the eigenvectors. Only the upper triangle of each matrix is
+    used.
+
+    .. rubric:: Args
+    matrix : ndarray
+        Hermitian matrices with shape ``(batch_size, 2, 2)``.
+    eigvals : ndarray
+        Real array with shape ``(batch_size, 2)``, overwritten with the
+        eigenvalues.
+    eigvecs : ndarray
+        Array with shape ``(batch_size, 2, 2)`` and the dtype of ``matrix``,
+        overwritten with the eigenvectors as its columns.
+
+    .. rubric:: Returns
+    eigvals : ndarray
+        Eigenvalues.
+    eigvecs : ndarray
+        Eigenvectors.
+    """
+    for t in range(matrix.shape[0]):
+        h_00 = matrix[t, 0, 0].real
+        h_11 = matrix[t, 1, 1].real
+        h_01 = matrix[t, 0, 1]
+        mean = 0.5 * (h_00 + h_11)
+        half_diff = 0.5 * (h_00 - h_11)
+        abs_h_01 = np.abs(h_01)
+        radius = np.hypot(half_diff, abs_h_01)
+        eigvals[t, 0] = mean - radius
+        eigvals[t, 1] = mean + radius
+        if abs_h_01 == 0.0:
+            # Diagonal matrices have the unit vectors as eigenvectors.
+            if half_diff > 0.0:
+                cos_theta, sin_theta = 1.0, 0.0
+            else:
+                cos_theta, sin_theta = 0.0, 1.0
+            phase_conj = 1.0
+        else:
+            # The mixing angle theta satisfies cos(2 theta) = half_diff / radius
+            # and sin(2 theta) = abs_h_01 / radius. The larger of cos(theta)
+            # and sin(theta) is calculated first to avoid cancellation.
+            if half_diff >= 0.0:
+                cos_theta = np.sqrt(0.5 * (1.0 + half_diff / radius))
+                sin_theta = abs_h_01 / (2.0 * radius * cos_theta)
+            else:
+                sin_theta = np.sqrt(0.5 * (1.0 - half_diff / radius))
+                cos_theta = abs_h_01 / (2.0 * radius * sin_theta)
+            phase_conj = np.conj(h_01) / abs_h_01
+        eigvecs[t, 0, 0] = sin_theta
+        eigvecs[t, 1, 0] = -cos_theta * phase_conj
+        eigvecs[t, 0, 1] = cos_theta
+        eigvecs[t, 1, 1] = sin_theta * phase_conj
+    return eigvals, eigvecs
+
+
+@njit(nogil=True)
+def eigh_tracking(
+    matrix,
+    eigvecs_previous,
+    eigvals,
+    eigvecs,
+    tracked,
+    work,
+    degeneracy_threshold,
+    num_sweeps,
+):
+    """
+    Low-level function to calculate the eigenvalues and eigenvectors of a batch
+    of Hermitian matrices starting from the eigenvectors of a nearby matrix,
+    such as the eigenvectors of the previous time step.
+
+    The matrices are transformed to the basis of ``eigvecs_previous``, in which
+    they are nearly diagonal, and refined there with at most ``num_sweeps``
+    sweeps of complex Jacobi rotations. Each eigenvector is therefore the
+    continuation of the previous eigenvector with the same index, and its sign
+    is chosen so that the real part of its overlap with the previous
+    eigenvector is positive, as with the ``"sign_overlap"`` gauge fixing. If the
+    rotations do not converge, or if the resulting eigenvalues are not in
+    ascending order or are separated by less than ``degeneracy_threshold``,
+    ``tracked`` is set to False for that trajectory and the matrix has to be
+    diagonalized by other means.
+
+    .. rubric:: Args
+    matrix : ndarray
+        Hermitian matrices with shape
+        ``(batch_size, num_quantum_states, num_quantum_states)``.
+    eigvecs_previous : ndarray
+        Eigenvectors to start from, with the shape of ``matrix``.
+    eigvals : ndarray
+        Real array with shape ``(batch_size, num_quantum_states)``, overwritten
+        with the eigenvalues.
+    eigvecs : ndarray
+        Complex array with the shape of ``matrix``, overwritten with the
+        eigenvectors as its columns.
+    tracked : ndarray
+        Boolean array with shape ``(batch_size,)``, overwritten with True for
+        the trajectories whose eigenvalues and eigenvectors were found.
+    work : ndarray
+        Complex work array with shape ``(2, num_quantum_states, num_quantum_states)``.
+    degeneracy_threshold : float
+        Smallest allowed difference between consecutive eigenvalues.
+    num_sweeps : int
+        Largest number of Jacobi sweeps carried out for each matrix.
+
+    .. rubric:: Returns
+    tracked : ndarray
+        True for the trajectories whose eigenvalues and eigenvectors were found.
+    """
+    batch_size, num_quantum_states, _ = matrix.shape
+    mat_v = work[0]
+    # Only the upper triangle of mat_adb is updated.
+    mat_adb = work[1]
+    for t in range(batch_size):
+        for i in range(num_quantum_states):
+            for j in range(num_quantum_states):
+                acc = 0.0j
+                for k in range(num_quantum_states):
+                    acc += matrix[t, i, k] * eigvecs_previous[t, k, j]
+                mat_v[i, j] = acc
+        scale = 0.0
+        for i in range(num_quantum_states):
+            for j in range(i, num_quantum_states):
+                acc = 0.0j
+                for k in range(num_quantum_states):
+                    acc += np.conj(eigvecs_previous[t, k, i]) * mat_v[k, j]
+                mat_adb[i, j] = acc
+                scale = max(scale, np.abs(acc))
+            for j in range(num_quantum_states):
+                eigvecs[t, i, j] = eigvecs_previous[t, i, j]
+        for i in range(num_quantum_states):
+            eigvals[t, i] = mat_adb[i, i].real
+        # Off-diagonal elements below this threshold are at the level of
+        # rounding errors and are not rotated away.
+        threshold = 1e-15 * scale
+        converged = False
+        for _ in range(num_sweeps):
+            rotated = False
+            for p in range(num_quantum_states - 1):
+                for q in range(p + 1, num_quantum_states):
+                    abs_mel = np.abs(mat_adb[p, q])
+                    if abs_mel <= threshold:
+                        continue
+                    rotated = True
+                    # Rotation by the smaller of the two angles that zero
+                    # the (p, q) element, so that the eigenvectors stay close
+                    # to the previous ones.
+                    phase = mat_adb[p, q] / abs_mel
+                    tau = (eigvals[t, q] - eigvals[t, p]) / (2.0 * abs_mel)
+                    if tau >= 0.0:
+                        tan_theta = 1.0 / (tau + np.sqrt(1.0 + tau * tau))
+                    else:
+                        tan_theta = -1.0 / (-tau + np.sqrt(1.0 + tau * tau))
+                    cos_theta = 1.0 / np.sqrt(1.0 + tan_theta * tan_theta)
+                    sin_theta = tan_theta * cos_theta
+                    rot_pq = sin_theta * phase
+                    rot_qp = -sin_theta * np.conj(phase)
+                    eigvals[t, p] -= tan_theta * abs_mel
+                    eigvals[t, q] += tan_theta * abs_mel
+                    mat_adb[p, q] = 0.0
+                    for r in range(num_quantum_states):
+                        if r == p or r == q:
+                            continue
+                        if r < p:
+                            mel_rp = mat_adb[r, p]
+                        else:
+                            mel_rp = np.conj(mat_adb[p, r])
+                        if r < q:
+                            mel_rq = mat_adb[r, q]
+                        else:
+                            mel_rq = np.conj(mat_adb[q, r])
+                        new_rp = cos_theta * mel_rp + rot_qp * mel_rq
+                        new_rq = rot_pq * mel_rp + cos_theta * mel_rq
+                        if r < p:
+                            mat_adb[r, p] = new_rp
+                        else:
+                            mat_adb[p, r] = np.conj(new_rp)
+                        if r < q:
+                            mat_adb[r, q] = new_rq
+                        else:
+                            mat_adb[q, r] = np.conj(new_rq)
+                    for r in range(num_quantum_states):
+                        vec_rp = eigvecs[t, r, p]
+                        vec_rq = eigvecs[t, r, q]
+                        eigvecs[t, r, p] = cos_theta * vec_rp + rot_qp * vec_rq
+                        eigvecs[t, r, q] = rot_pq * vec_rp + cos_theta * vec_rq
+            if not rotated:
+                converged = True
+                break
+        tracked[t] = converged
+        for k in range(num_quantum_states - 1):
+            if eigvals[t, k + 1] - eigvals[t, k] < degeneracy_threshold:
+                tracked[t] = False
+        # Make the real part of the overlap with the previous eigenvector
+        # positive.
+        for j in range(num_quantum_states):
+            overlap = 0.0
+            for r in range(num_quantum_states):
+                overlap += (np.conj(eigvecs_previous[t, r, j]) * eigvecs[t, r, j]).real
+            if overlap < 0.0:
+                for r in range(num_quantum_states):
+                    eigvecs[t, r, j] = -eigvecs[t, r, j]
+    return tracked
+
+
+@njit(nogil=True)
 def dqdp_to_dzc(dq, dp, m, h):
     """
     Convert derivatives w.r.t. q and p (``dq`` and ``dp``, respectively) to
@@ -203,7 +587,7 @@ def dqdp_to_dzc(dq, dp, m, h):
     raise ValueError("At least one of dq or dp must be provided.")
 
 
-@njit
+@njit(nogil=True)
 def dzdzc_to_dqdp(dz, dzc, m, h):
     """
     Convert derivatives w.r.t. z and zc (``dz`` and ``dzc``) to derivatives w.r.t.
@@ -243,7 +627,7 @@ def dzdzc_to_dqdp(dz, dzc, m, h):
     raise ValueError("At least one of dz or dzc must be provided.")
 
 
-@njit
+@njit(nogil=True)
 def z_to_q(z, m, h):
     """
     Convert complex coordinates to position coordinate.
@@ -263,7 +647,7 @@ def z_to_q(z, m, h):
     return np.sqrt(2.0 / (m * h)) * z.real
 
 
-@njit
+@njit(nogil=True)
 def z_to_p(z, m, h):
     """
     Convert complex coordinates to momentum coordinate.
@@ -283,7 +667,7 @@ def z_to_p(z, m, h):
     return np.sqrt(2.0 * m * h) * z.imag
 
 
-@njit
+@njit(nogil=True)
 def qp_to_z(q, p, m, h):
     """
     Convert real coordinates to complex coordinates.
@@ -380,7 +764,7 @@ def vectorize_ingredient(ingredient):
     return vectorized_ingredient
 
 
-@njit
+@njit(nogil=True)
 def dh_c_dzc_harmonic_jit(z, h, w):
     """
     Derivative of the harmonic oscillator classical Hamiltonian function with respect to
@@ -411,7 +795,7 @@ def dh_c_dzc_harmonic_jit(z, h, w):
     return out
 
 
-@njit
+@njit(nogil=True)
 def h_qc_diagonal_linear_jit(z, gamma):
     """
     Low-level function to generate the diagonal linear quantum-classical Hamiltonian.
@@ -441,6 +825,169 @@ def h_qc_diagonal_linear_jit(z, gamma):
     return h_qc
 
 
+@njit(nogil=True)
+def _mean_field_harmonic_diagonal_linear_force(
+    z, wf_db, rows, cols, couplings, h, w2_over_h, force_qc, out
+):
+    """
+    Low-level function to calculate the total force on the classical
+    coordinates of one trajectory for a harmonic classical Hamiltonian and a
+    diagonal linear quantum-classical Hamiltonian.
+
+    .. rubric:: Args
+    z : ndarray
+        Complex coordinates of the trajectory.
+    wf_db : ndarray
+        Diabatic wavefunction of the trajectory.
+    rows : ndarray
+        Quantum state index of each nonzero coupling strength.
+    cols : ndarray
+        Classical coordinate index of each nonzero coupling strength.
+    couplings : ndarray
+        Nonzero classical coordinate coupling strengths.
+    h : ndarray
+        Classical coordinate weight.
+    w2_over_h : ndarray
+        Squared harmonic frequency divided by the classical coordinate weight.
+    force_qc : ndarray
+        Work array for the quantum-classical force.
+    out : ndarray
+        Array in which the force is stored.
+    """
+    force_qc[:] = 0.0j
+    for n in range(couplings.shape[0]):
+        i = rows[n]
+        force_qc[cols[n]] += (wf_db[i].real ** 2 + wf_db[i].imag ** 2) * couplings[n]
+    for j in range(z.shape[0]):
+        out[j] = complex(w2_over_h[j] * z[j].real, h[j] * z[j].imag) + force_qc[j]
+
+
+@njit(nogil=True)
+def mean_field_harmonic_diagonal_linear_steps(
+    z, wf_db, h_q_tot, h_q, rows, cols, couplings, h, w, dt_update, num_steps
+):
+    """
+    Low-level function that carries out several update steps of the
+    mean-field algorithm for a harmonic classical Hamiltonian and a diagonal
+    linear quantum-classical Hamiltonian.
+
+    Each step integrates the classical coordinates with RK4 using the forces
+    of the wavefunction at the start of the step, then integrates the
+    wavefunction with RK4 using the total quantum Hamiltonian at the start of
+    the step, and finally updates the total quantum Hamiltonian. This is the
+    same sequence of operations as the update recipe of ``MeanField``.
+
+    .. rubric:: Args
+    z : ndarray
+        Complex coordinates, updated in place.
+    wf_db : ndarray
+        Diabatic wavefunctions, updated in place.
+    h_q_tot : ndarray
+        Total quantum Hamiltonian at the start of the first step.
+    h_q : ndarray
+        Quantum Hamiltonian.
+    rows : ndarray
+        Quantum state index of each nonzero coupling strength.
+    cols : ndarray
+        Classical coordinate index of each nonzero coupling strength.
+    couplings : ndarray
+        Nonzero classical coordinate coupling strengths.
+    h : ndarray
+        Classical coordinate weight.
+    w : ndarray
+        Harmonic frequency.
+    dt_update : float
+        Time step for the update.
+    num_steps : int
+        Number of update steps.
+    """
+    batch_size, num_classical_coordinates = z.shape
+    num_states = wf_db.shape[1]
+    w2_over_h = (w**2) / h
+    force = np.empty(num_classical_coordinates, dtype=np.complex128)
+    force_qc = np.empty(num_classical_coordinates, dtype=np.complex128)
+    z_k = np.empty(num_classical_coordinates, dtype=np.complex128)
+    k1 = np.empty(num_classical_coordinates, dtype=np.complex128)
+    k2 = np.empty(num_classical_coordinates, dtype=np.complex128)
+    k3 = np.empty(num_classical_coordinates, dtype=np.complex128)
+    h_tot = np.empty((num_states, num_states), dtype=np.complex128)
+    wf_k = np.empty(num_states, dtype=np.complex128)
+    wf_k1 = np.empty(num_states, dtype=np.complex128)
+    wf_k2 = np.empty(num_states, dtype=np.complex128)
+    wf_k3 = np.empty(num_states, dtype=np.complex128)
+    wf_k4 = np.empty(num_states, dtype=np.complex128)
+    # The trajectories are independent, so each one is propagated through all
+    # steps before moving on to the next.
+    for b in range(batch_size):
+        zb = z[b]
+        wf = wf_db[b]
+        h_tot[:, :] = h_q_tot[b]
+        for _ in range(num_steps):
+            # RK4 integration of the classical coordinates.
+            _mean_field_harmonic_diagonal_linear_force(
+                zb, wf, rows, cols, couplings, h, w2_over_h, force_qc, force
+            )
+            for j in range(num_classical_coordinates):
+                k1[j] = -1j * force[j]
+                z_k[j] = zb[j] + 0.5 * dt_update * k1[j]
+            _mean_field_harmonic_diagonal_linear_force(
+                z_k, wf, rows, cols, couplings, h, w2_over_h, force_qc, force
+            )
+            for j in range(num_classical_coordinates):
+                k2[j] = -1j * force[j]
+                z_k[j] = zb[j] + 0.5 * dt_update * k2[j]
+            _mean_field_harmonic_diagonal_linear_force(
+                z_k, wf, rows, cols, couplings, h, w2_over_h, force_qc, force
+            )
+            for j in range(num_classical_coordinates):
+                k3[j] = -1j * force[j]
+                z_k[j] = zb[j] + dt_update * k3[j]
+            _mean_field_harmonic_diagonal_linear_force(
+                z_k, wf, rows, cols, couplings, h, w2_over_h, force_qc, force
+            )
+            for j in range(num_classical_coordinates):
+                zb[j] = zb[j] + (dt_update / 6.0) * (
+                    k1[j] + 2.0 * k2[j] + 2.0 * k3[j] - 1j * force[j]
+                )
+            # RK4 integration of the wavefunction.
+            for n in range(num_states):
+                acc = 0.0j
+                for m in range(num_states):
+                    acc += h_tot[n, m] * wf[m]
+                wf_k1[n] = -1j * acc
+            for n in range(num_states):
+                wf_k[n] = wf[n] + 0.5 * dt_update * wf_k1[n]
+            for n in range(num_states):
+                acc = 0.0j
+                for m in range(num_states):
+                    acc += h_tot[n, m] * wf_k[m]
+                wf_k2[n] = -1j * acc
+            for n in range(num_states):
+                wf_k[n] = wf[n] + 0.5 * dt_update * wf_k2[n]
+            for n in range(num_states):
+                acc = 0.0j
+                for m in range(num_states):
+                    acc += h_tot[n, m] * wf_k[m]
+                wf_k3[n] = -1j * acc
+            for n in range(num_states):
+                wf_k[n] = wf[n] + dt_update * wf_k3[n]
+            for n in range(num_states):
+                acc = 0.0j
+                for m in range(num_states):
+                    acc += h_tot[n, m] * wf_k[m]
+                wf_k4[n] = -1j * acc
+            for n in range(num_states):
+                wf[n] += dt_update * 0.16666666666666666 * wf_k1[n]
+                wf[n] += dt_update * 0.3333333333333333 * wf_k2[n]
+                wf[n] += dt_update * 0.3333333333333333 * wf_k3[n]
+                wf[n] += dt_update * 0.16666666666666666 * wf_k4[n]
+            # Update the total quantum Hamiltonian.
+            h_tot[:, :] = h_q[b]
+            for n in range(couplings.shape[0]):
+                i = rows[n]
+                h_tot[i, i] += couplings[n] * 2.0 * zb[cols[n]].real
+
+
 def gen_sample_gaussian(constants, z_initial=None, seed=None, separable=True):
     """
     Generates a complex number sampled from a Gaussian distribution.
@@ -476,27 +1023,31 @@ def gen_sample_gaussian(constants, z_initial=None, seed=None, separable=True):
     rand : ndarray
         Random number(s) used to generate the complex number.
     """
+    # Use a local random state so that concurrent batches do not share the
+    # global random state.
     if seed is not None:
-        np.random.seed(seed)
+        rng = np.random.RandomState(seed)
+    else:
+        rng = np.random
     num_classical_coordinates = constants.num_classical_coordinates
     if separable:
-        rand = np.random.rand(num_classical_coordinates)
+        rand = rng.rand(num_classical_coordinates)
     else:
-        rand = np.random.rand()
+        rand = rng.rand()
     if z_initial is None:
         z_initial = np.zeros(num_classical_coordinates, dtype=complex)
     mcmc_std = constants.get("mcmc_std", 1.0)
-    z_re = np.random.normal(
+    z_re = rng.normal(
         loc=z_initial.real, scale=mcmc_std, size=num_classical_coordinates
     )
-    z_im = np.random.normal(
+    z_im = rng.normal(
         loc=z_initial.imag, scale=mcmc_std, size=num_classical_coordinates
     )
     z = z_re + 1j * z_im
     return z, rand
 
 
-@njit
+@njit(nogil=True)
 def calc_sparse_inner_product(inds, mels, shape, vec_l_conj, vec_r, out=None):
     """
     Take a sparse gradient matrix with shape ``(batch_size, num_classical_coordinates,
@@ -549,6 +1100,150 @@ def calc_sparse_inner_product(inds, mels, shape, vec_l_conj, vec_r, out=None):
     return out
 
 
+class BatchInvariantSparseGradient(
+    collections.namedtuple("BatchInvariantSparseGradient", ["inds", "mels", "shape"])
+):
+    """
+    Sparse gradient of the quantum-classical Hamiltonian that is the same in
+    every trajectory of a batch.
+
+    Unlike the ``(inds, mels, shape)`` tuple of a general sparse gradient, the
+    indices and values of the nonzero elements are stored once for the whole
+    batch rather than repeated for each trajectory.
+
+    .. rubric:: Args
+    inds : tuple of ndarrays
+        Indices of the nonzero elements of the gradient of a single trajectory,
+        ``(coordinate_index, row_index, column_index)``.
+    mels : ndarray
+        Values of the nonzero elements of the gradient of a single trajectory.
+    shape : tuple
+        Shape of the full gradient,
+        ``(batch_size, num_classical_coordinates, num_states, num_states)``.
+    """
+
+    __slots__ = ()
+
+    def to_batched(self):
+        """
+        Converts the gradient to the ``(inds, mels, shape)`` tuple of a general
+        sparse gradient, which lists the nonzero elements of each trajectory.
+
+        .. rubric:: Returns
+        inds : tuple of ndarrays
+            Indices of the nonzero elements of the gradient,
+            ``(batch_index, coordinate_index, row_index, column_index)``.
+        mels : ndarray
+            Values of the nonzero elements of the gradient.
+        shape : tuple
+            Shape of the full gradient.
+        """
+        batch_size = self.shape[0]
+        num_nonzero = len(self.mels)
+        inds = (np.repeat(np.arange(batch_size), num_nonzero),) + tuple(
+            np.tile(ind, batch_size) for ind in self.inds
+        )
+        return inds, np.tile(self.mels, batch_size), self.shape
+
+
+# Index arrays built by batched_sparse_inds, keyed by the shape of the gradient.
+_batched_sparse_inds_cache = {}
+
+
+def batched_sparse_inds(traj_inds, shape):
+    """
+    Gets the indices of the nonzero elements of a sparse gradient whose nonzero
+    elements are at the same positions in every trajectory.
+
+    The index arrays are cached for each shape of the gradient, which includes
+    the batch size, and reused afterwards, so they are returned as read-only
+    arrays. Finding them in the cache compares ``traj_inds`` with the cached
+    indices of the same shape rather than hashing them.
+
+    .. rubric:: Args
+    traj_inds : tuple of array_like
+        Indices ``(coordinate_index, row_index, column_index)`` of the nonzero
+        elements in a single trajectory.
+    shape : tuple
+        Shape of the full gradient,
+        ``(batch_size, num_classical_coordinates, num_states, num_states)``.
+
+    .. rubric:: Returns
+    inds : tuple of ndarrays
+        Indices ``(batch_index, coordinate_index, row_index, column_index)``
+        of the nonzero elements of the batch, ordered by trajectory.
+    """
+    shape = tuple(shape)
+    traj_inds = tuple(np.asarray(ind, dtype=int) for ind in traj_inds)
+    cached = _batched_sparse_inds_cache.get(shape, ())
+    for cached_traj_inds, inds in cached:
+        if all(map(np.array_equal, cached_traj_inds, traj_inds)):
+            return inds
+    traj_inds = tuple(np.array(ind) for ind in traj_inds)
+    batch_size = shape[0]
+    num_nonzero = len(traj_inds[0])
+    inds = (np.repeat(np.arange(batch_size), num_nonzero),) + tuple(
+        np.tile(ind, batch_size) for ind in traj_inds
+    )
+    for ind in (*traj_inds, *inds):
+        ind.flags.writeable = False
+    # Keep a few index patterns for each shape, and a limited number of shapes.
+    if (
+        len(_batched_sparse_inds_cache) >= 32
+        and shape not in _batched_sparse_inds_cache
+    ):
+        _batched_sparse_inds_cache.pop(next(iter(_batched_sparse_inds_cache)))
+    _batched_sparse_inds_cache[shape] = (*cached[-3:], (traj_inds, inds))
+    return inds
+
+
+@njit(nogil=True)
+def calc_batch_invariant_sparse_inner_product(
+    inds, mels, shape, vec_l_conj, vec_r, out=None
+):
+    """
+    Take a sparse gradient matrix that is the same for every trajectory, with
+    shape ``(batch_size, num_classical_coordinates, num_quantum_state,
+    num_quantum_states)``, and calculate the matrix element of the vectors
+    ``vec_l_conj`` and ``vec_r`` with shape ``(batch_size, num_quantum_states)``.
+
+    .. rubric:: Args
+    inds : tuple of ndarrays
+        Indices ``(coordinate_index, row_index, column_index)`` of the nonzero
+        elements of the gradient of a single trajectory.
+    mels : ndarray
+        Nonzero elements of the gradient of a single trajectory.
+    shape : tuple
+        Shape of the sparse matrix.
+    vec_l_conj : ndarray
+        Left vector (conjugated) for the inner product.
+    vec_r : ndarray
+        Right vector for the inner product.
+    out : ndarray | None
+        Preallocated output array. If ``None``, a new array is created.
+
+    .. rubric:: Returns
+    out : ndarray
+        Result of the inner product with shape ``(batch_size * num_classical_coordinates)``.
+    """
+    batch_size, num_classical_coordinates = shape[0], shape[1]
+    c = inds[0]
+    a = inds[1]
+    b = inds[2]
+
+    if out is None:
+        out = np.zeros(batch_size * num_classical_coordinates, dtype=np.complex128)
+    if out is not None:
+        out.fill(0.0j)
+
+    for t in range(batch_size):
+        offset = t * num_classical_coordinates
+        for i in range(mels.shape[0]):
+            out[offset + c[i]] += vec_l_conj[t, a[i]] * mels[i] * vec_r[t, b[i]]
+
+    return out
+
+
 def analytic_der_couple_phase(sim, dh_qc_dzc, eigvals, eigvecs):
     """
     Calculates the phase change needed to fix the gauge using analytical derivative
@@ -563,7 +1258,7 @@ def analytic_der_couple_phase(sim, dh_qc_dzc, eigvals, eigvecs):
     .. rubric:: Args
     sim: Simulation
         Simulation object.
-    dh_qc_dzc : tuple
+    dh_qc_dzc : tuple or BatchInvariantSparseGradient
         Sparse representation of the derivative of the quantum-classical Hamiltonian
         with respect to the conjugate complex coordinate.
     eigvals : ndarray
@@ -581,6 +1276,14 @@ def analytic_der_couple_phase(sim, dh_qc_dzc, eigvals, eigvecs):
     """
     inds, mels, shape = dh_qc_dzc
     batch_size = shape[0]
+    if isinstance(dh_qc_dzc, BatchInvariantSparseGradient):
+        # The nonzero elements are the same in every trajectory.
+        batch_ind = slice(None)
+        traj_ind = (slice(None), np.newaxis)
+        coord_ind, row_ind, col_ind = inds
+    else:
+        batch_ind, coord_ind, row_ind, col_ind = inds
+        traj_ind = batch_ind
     m = sim.model.constants.classical_coordinate_mass
     h = sim.model.constants.classical_coordinate_weight
     num_classical_coords = shape[1]
@@ -627,19 +1330,19 @@ def analytic_der_couple_phase(sim, dh_qc_dzc, eigvals, eigvecs):
         )
         np.add.at(
             der_couple_dzc,
-            (inds[0], inds[1]),
-            np.conj(evec_i)[inds[0], inds[2]]
+            (batch_ind, coord_ind),
+            np.conj(evec_i)[batch_ind, row_ind]
             * mels
-            * evec_j[inds[0], inds[3]]
-            / ((eigval_diff + plus)[inds[0]]),
+            * evec_j[batch_ind, col_ind]
+            / ((eigval_diff + plus)[traj_ind]),
         )
         np.add.at(
             der_couple_dz,
-            (inds[0], inds[1]),
-            np.conj(evec_i)[inds[0], inds[3]]
+            (batch_ind, coord_ind),
+            np.conj(evec_i)[batch_ind, col_ind]
             * np.conj(mels)
-            * evec_j[inds[0], inds[2]]
-            / ((eigval_diff + plus)[inds[0]]),
+            * evec_j[batch_ind, row_ind]
+            / ((eigval_diff + plus)[traj_ind]),
         )
         der_couple_dq, der_couple_dp = dzdzc_to_dqdp(
             der_couple_dz, der_couple_dzc, m[np.newaxis, :], h[np.newaxis, :]
@@ -693,9 +1396,10 @@ def calc_resc_dir_z_fssh(
         Eigenvector of the initial state.
     eigvec_final_state : ndarray
         Eigenvector of the final state.
-    dh_qc_dzc_traj : tuple
+    dh_qc_dzc_traj : tuple or BatchInvariantSparseGradient
         Sparse representation of the derivative of the quantum-classical Hamiltonian
-        with respect to the conjugate complex coordinate.
+        with respect to the conjugate complex coordinate, either for the
+        trajectory alone or the same for every trajectory.
     m : ndarray
         Classical coordinate mass.
     h : ndarray
@@ -707,24 +1411,28 @@ def calc_resc_dir_z_fssh(
         Derivative is w.r.t. z*.
     """
     inds, mels, shape = dh_qc_dzc_traj
+    if isinstance(dh_qc_dzc_traj, BatchInvariantSparseGradient):
+        coord_ind, row_ind, col_ind = inds
+    else:
+        _, coord_ind, row_ind, col_ind = inds
     num_classical_coordinates = shape[1]
     dkj_z = np.zeros((num_classical_coordinates), dtype=complex)
     dkj_zc = np.zeros((num_classical_coordinates), dtype=complex)
     np.add.at(
         dkj_zc,
-        (inds[1]),
-        np.conj(eigvec_init_state)[inds[2]]
+        coord_ind,
+        np.conj(eigvec_init_state)[row_ind]
         * mels
-        * eigvec_final_state[inds[3]]
+        * eigvec_final_state[col_ind]
         / eigval_diff,
     )
     if sim.settings.debug:
         np.add.at(
             dkj_z,
-            (inds[1]),
-            np.conj(eigvec_init_state)[inds[3]]
+            coord_ind,
+            np.conj(eigvec_init_state)[col_ind]
             * np.conj(mels)
-            * eigvec_final_state[inds[2]]
+            * eigvec_final_state[row_ind]
             / eigval_diff,
         )
         # Determine the position of the maximum derivative coupling.
@@ -243,20 +243,13 @@ def dh_qc_dzc_diagonal_linear(model, parameters, **kwargs):
     num_states = model.constants.num_quantum_states
     num_classical_coordinates = model.constants.num_classical_coordinates
     gamma = model.constants.diagonal_linear_coupling
-    dh_qc_dzc = np.zeros(
-        (num_classical_coordinates, num_states, num_states), dtype=complex
-    )
-    for i in range(num_states):
-        for j in range(num_classical_coordinates):
-            dh_qc_dzc[j, i, i] = gamma[i, j]
-    dh_qc_dzc = dh_qc_dzc[np.newaxis, :, :, :] + np.zeros(
-        (batch_size, num_classical_coordinates, num_states, num_states),
-        dtype=complex,
-    )
-    inds = np.where(dh_qc_dzc != 0)
-    mels = dh_qc_dzc[inds]
-    shape = np.shape(dh_qc_dzc)
-    return inds, mels, shape
+    # Only the nonzero couplings enter the gradient, ordered by coordinate, and
+    # they are the same in every trajectory.
+    coord_ind, state_ind = np.nonzero(np.transpose(gamma))
+    mels = np.asarray(gamma[state_ind, coord_ind], dtype=complex)
+    shape = (batch_size, num_classical_coordinates, num_states, num_states)
+    inds = functions.batched_sparse_inds((coord_ind, state_ind, state_ind), shape)
+    return inds, np.tile(mels, batch_size), shape
 
 
 def hop_harmonic(model, parameters, **kwargs):
@@ -428,12 +421,12 @@ def init_classical_boltzmann_harmonic(model, parameters, **kwargs):
     std_q = np.sqrt(kBT / (m * (w**2)))
     std_p = np.sqrt(m * kBT)
     for s, seed_value in enumerate(seed):
-        np.random.seed(seed_value)
+        rng = np.random.RandomState(seed_value)
         # Generate random q and p values.
-        q = np.random.normal(
+        q = rng.normal(
             loc=0, scale=std_q, size=model.constants.num_classical_coordinates
         )
-        p = np.random.normal(
+        p = rng.normal(
             loc=0, scale=std_p, size=model.constants.num_classical_coordinates
         )
         # Calculate the complex-valued classical coordinate.
@@ -476,12 +469,12 @@ def init_classical_wigner_harmonic(model, parameters, **kwargs):
         std_q = np.sqrt(0.5 / (w * m))
         std_p = np.sqrt(0.5 * m * w)
     for s, seed_value in enumerate(seed):
-        np.random.seed(seed_value)
+        rng = np.random.RandomState(seed_value)
         # Generate random q and p values.
-        q = np.random.normal(
+        q = rng.normal(
             loc=0, scale=std_q, size=model.constants.num_classical_coordinates
         )
-        p = np.random.normal(
+        p = rng.normal(
             loc=0, scale=std_p, size=model.constants.num_classical_coordinates
         )
         # Calculate the complex-valued classical coordinate.
@@ -513,9 +506,8 @@ def init_classical_definite_position_momentum(model, parameters, **kwargs):
     m = model.constants.classical_coordinate_mass
     h = model.constants.classical_coordinate_weight
     z = np.zeros((len(seed), model.constants.num_classical_coordinates), dtype=complex)
-    for s, seed_value in enumerate(seed):
-        np.random.seed(seed_value)
-        z[s] = functions.qp_to_z(q, p, m, h)
+    # Every trajectory starts from the same coordinates, so no random numbers are drawn.
+    z[:] = functions.qp_to_z(q, p, m, h)
     return z
 
 
@@ -559,12 +551,12 @@ def init_classical_wigner_coherent_state(model, parameters, **kwargs):
     mu_q = np.sqrt(2.0 / (m * w)) * np.real(a)
     mu_p = np.sqrt(2.0 * m * w) * np.imag(a)
     for s, seed_value in enumerate(seed):
-        np.random.seed(seed_value)
+        rng = np.random.RandomState(seed_value)
         # Generate random q and p values.
-        q = np.random.normal(
+        q = rng.normal(
             loc=mu_q, scale=std_q, size=model.constants.num_classical_coordinates
         )
-        p = np.random.normal(
+        p = rng.normal(
             loc=mu_p, scale=std_p, size=model.constants.num_classical_coordinates
         )
         # Calculate the z coordinate.
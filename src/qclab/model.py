@@ -33,6 +33,9 @@ class Model:
         # gradients need to be updated.
         self.update_h_q = True
         self.update_dh_qc_dzc = True
+        # Flag to indicate if the quantum-classical gradient is the same in
+        # every trajectory.
+        self.batch_invariant_dh_qc_dzc = False
         self.initialize_constants()
 
     def get(self, ingredient_name):
@@ -51,21 +54,38 @@ class Model:
         tuple[callable | None, bool]: The ingredient function (or None if
             not found) and a flag indicating whether it exists.
         """
-        for ingredient in self.ingredients[::-1]:
-            if ingredient[0] == ingredient_name and not (ingredient[1] is None):
-                return ingredient[1], True
-            if ingredient[0] == ingredient_name and (ingredient[1] is None):
-                return None, False
-        return None, False
+        # Ingredients are looked up many times per time step, so the lookups
+        # are resolved once into a table that is rebuilt whenever the list of
+        # ingredients changes. The table is stored together with the list it
+        # was built from in a single assignment, so that threads sharing the
+        # model never see a table that does not match its list.
+        lookup = self.__dict__.get("_ingredient_lookup")
+        if lookup is None or lookup[0] != self.ingredients:
+            ingredients = list(self.ingredients)
+            # Later ingredients take precedence over earlier ones.
+            table = {
+                ingredient[0]: (ingredient[1], ingredient[1] is not None)
+                for ingredient in ingredients
+            }
+            lookup = (ingredients, table)
+            self._ingredient_lookup = lookup
+        return lookup[1].get(ingredient_name, (None, False))
 
     def initialize_constants(self):
         """
         Initialize the constants for the model and ingredients.
         Calls ingredients with names starting with "_init_".
         """
-        for ingredient in self.ingredients[::-1]:
-            if ingredient[0].startswith("_init_") and ingredient[1] is not None:
-                ingredient[1](self, None)
+        # Constants set here are derived from the other constants, so they do
+        # not trigger another initialization.
+        updating = self.constants._updating
+        self.constants._updating = True
+        try:
+            for ingredient in self.ingredients[::-1]:
+                if ingredient[0].startswith("_init_") and ingredient[1] is not None:
+                    ingredient[1](self, None)
+        finally:
+            self.constants._updating = updating
         return
 
     ingredients = []
@@ -35,6 +35,7 @@ class FMOComplex(Model):
         }
         super().__init__(self.default_constants, constants)
         self.update_dh_qc_dzc = False
+        self.batch_invariant_dh_qc_dzc = True
         self.update_h_q = False
 
     def _init_model(self, parameters, **kwargs):
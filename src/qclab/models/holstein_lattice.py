@@ -5,6 +5,7 @@ This module contains the Holstein lattice Model class.
 import numpy as np
 from qclab.model import Model
 from qclab import ingredients
+from qclab import functions
 
 
 class HolsteinLattice(Model):
@@ -30,6 +31,7 @@ class HolsteinLattice(Model):
         }
         super().__init__(self.default_constants, constants)
         self.update_dh_qc_dzc = False
+        self.batch_invariant_dh_qc_dzc = True
         self.update_h_q = False
 
     def _init_model(self, parameters, **kwargs):
@@ -103,6 +105,7 @@ class HolsteinLatticeReciprocalSpace(Model):
         }
         super().__init__(self.default_constants, constants)
         self.update_dh_qc_dzc = False
+        self.batch_invariant_dh_qc_dzc = True
         self.update_h_q = False
 
     def init_model(self, parameters, **kwargs):
@@ -157,7 +160,6 @@ class HolsteinLatticeReciprocalSpace(Model):
         w = self.constants.get("w")
         out = np.zeros(
             (
-                batch_size,
                 self.constants.num_classical_coordinates,
                 self.constants.num_quantum_states,
                 self.constants.num_quantum_states,
@@ -166,7 +168,7 @@ class HolsteinLatticeReciprocalSpace(Model):
         )
         for k_ind in self.constants.k_inds:
             pos = np.where(self.constants.k_diff_inds.transpose() == k_ind)
-            out[:, k_ind, pos[0], pos[1]] = (
+            out[k_ind, pos[0], pos[1]] = (
                 g * w / np.sqrt(self.constants.num_quantum_states)
             )
         shape = (
@@ -175,8 +177,10 @@ class HolsteinLatticeReciprocalSpace(Model):
             self.constants.num_quantum_states,
             self.constants.num_quantum_states,
         )
-        inds = np.where(out != 0)
-        mels = out[inds]
+        # The gradient is the same for every trajectory.
+        traj_inds = np.where(out != 0)
+        inds = functions.batched_sparse_inds(traj_inds, shape)
+        mels = np.tile(out[traj_inds], batch_size)
         return inds, mels, shape
 
     ingredients = [
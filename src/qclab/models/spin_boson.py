@@ -29,6 +29,7 @@ class SpinBoson(Model):
         }
         super().__init__(self.default_constants, constants)
         self.update_dh_qc_dzc = False
+        self.batch_invariant_dh_qc_dzc = True
         self.update_h_q = False
 
     def _init_h_q(self, parameters, **kwargs):
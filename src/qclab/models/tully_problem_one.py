@@ -39,8 +39,12 @@ class TullyProblemOne(Model):
             [self.constants.get("mass")]
         )
         self.constants.classical_coordinate_weight = np.array([1.0])
-        self.constants.init_position = np.array([self.constants.get("init_position")])
-        self.constants.init_momentum = np.array([self.constants.get("init_momentum")])
+        self.constants.init_position = np.atleast_1d(
+            self.constants.get("init_position")
+        )
+        self.constants.init_momentum = np.atleast_1d(
+            self.constants.get("init_momentum")
+        )
         return
 
     def h_qc(self, parameters, **kwargs):
@@ -97,18 +101,6 @@ class TullyProblemOne(Model):
         # Convert to complex gradients.
         dv_11_dzc = functions.dqdp_to_dzc(dv_11_dq, None, m[0], h[0])
         dv_12_dzc = functions.dqdp_to_dzc(dv_12_dq, None, m[0], h[0])
-        # Assemble indices.
-        batch_idx = np.repeat(np.arange(batch_size, dtype=int), 4)
-        coord_idx = np.zeros(4 * batch_size, dtype=int)
-        state_i_idx = np.tile(np.array([0, 0, 1, 1], dtype=int), batch_size)
-        state_j_idx = np.tile(np.array([0, 1, 0, 1], dtype=int), batch_size)
-        inds = (batch_idx, coord_idx, state_i_idx, state_j_idx)
-        # Assemble matrix elements.
-        mels = np.empty(4 * batch_size, dtype=complex)
-        mels[0::4] = dv_11_dzc
-        mels[1::4] = dv_12_dzc
-        mels[2::4] = dv_12_dzc
-        mels[3::4] = -dv_11_dzc
         # Assemble shape.
         shape = (
             batch_size,
@@ -116,6 +108,17 @@ class TullyProblemOne(Model):
             num_quantum_states,
             num_quantum_states,
         )
+        # Get the indices, which are the same for every trajectory and only
+        # built once for each shape.
+        inds = functions.batched_sparse_inds(
+            ((0, 0, 0, 0), (0, 0, 1, 1), (0, 1, 0, 1)), shape
+        )
+        # Assemble matrix elements.
+        mels = np.empty(4 * batch_size, dtype=complex)
+        mels[0::4] = dv_11_dzc
+        mels[1::4] = dv_12_dzc
+        mels[2::4] = dv_12_dzc
+        mels[3::4] = -dv_11_dzc
         return inds, mels, shape
 
     ingredients = [
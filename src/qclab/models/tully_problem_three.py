@@ -39,8 +39,12 @@ class TullyProblemThree(Model):
             [self.constants.get("mass", self.default_constants.get("mass"))]
         )
         self.constants.classical_coordinate_weight = np.array([1.0])
-        self.constants.init_position = np.array([self.constants.get("init_position")])
-        self.constants.init_momentum = np.array([self.constants.get("init_momentum")])
+        self.constants.init_position = np.atleast_1d(
+            self.constants.get("init_position")
+        )
+        self.constants.init_momentum = np.atleast_1d(
+            self.constants.get("init_momentum")
+        )
         return
 
     def h_qc(self, parameters, **kwargs):
@@ -93,16 +97,6 @@ class TullyProblemThree(Model):
         dv_12_dq[q < 0.0] = B * C * np.exp(C * q)[q < 0.0]
         # Convert to complex gradients.
         dv_12_dzc = functions.dqdp_to_dzc(dv_12_dq, None, m[0], h[0])
-        # Assemble indices.
-        batch_idx = np.repeat(np.arange(batch_size, dtype=int), 2)
-        coord_idx = np.zeros(2 * batch_size, dtype=int)
-        state_i_idx = np.tile(np.array([0, 1], dtype=int), batch_size)
-        state_j_idx = np.tile(np.array([1, 0], dtype=int), batch_size)
-        inds = (batch_idx, coord_idx, state_i_idx, state_j_idx)
-        # Assemble matrix elements.
-        mels = np.empty(2 * batch_size, dtype=complex)
-        mels[0::2] = dv_12_dzc
-        mels[1::2] = dv_12_dzc
         # Assemble shape.
         shape = (
             batch_size,
@@ -110,6 +104,13 @@ class TullyProblemThree(Model):
             num_quantum_states,
             num_quantum_states,
         )
+        # Get the indices, which are the same for every trajectory and only
+        # built once for each shape.
+        inds = functions.batched_sparse_inds(((0, 0), (0, 1), (1, 0)), shape)
+        # Assemble matrix elements.
+        mels = np.empty(2 * batch_size, dtype=complex)
+        mels[0::2] = dv_12_dzc
+        mels[1::2] = dv_12_dzc
         return inds, mels, shape
 
     ingredients = [
@@ -40,8 +40,12 @@ class TullyProblemTwo(Model):
             [self.constants.get("mass")]
         )
         self.constants.classical_coordinate_weight = np.array([1.0])
-        self.constants.init_position = np.array([self.constants.get("init_position")])
-        self.constants.init_momentum = np.array([self.constants.get("init_momentum")])
+        self.constants.init_position = np.atleast_1d(
+            self.constants.get("init_position")
+        )
+        self.constants.init_momentum = np.atleast_1d(
+            self.constants.get("init_momentum")
+        )
         return
 
     def h_qc(self, parameters, **kwargs):
@@ -95,17 +99,6 @@ class TullyProblemTwo(Model):
         # Convert to complex gradients.
         dv_12_dzc = functions.dqdp_to_dzc(dv_12_dq, None, m[0], h[0])
         dv_22_dzc = functions.dqdp_to_dzc(dv_22_dq, None, m[0], h[0])
-        # Assemble indices.
-        batch_idx = np.repeat(np.arange(batch_size, dtype=int), 3)
-        coord_idx = np.zeros(3 * batch_size, dtype=int)
-        state_i_idx = np.tile(np.array([0, 1, 1], dtype=int), batch_size)
-        state_j_idx = np.tile(np.array([1, 0, 1], dtype=int), batch_size)
-        inds = (batch_idx, coord_idx, state_i_idx, state_j_idx)
-        # Assemble matrix elements.
-        mels = np.empty(3 * batch_size, dtype=complex)
-        mels[0::3] = dv_12_dzc
-        mels[1::3] = dv_12_dzc
-        mels[2::3] = dv_22_dzc
         # Assemble shape.
         shape = (
             batch_size,
@@ -113,6 +106,14 @@ class TullyProblemTwo(Model):
             num_quantum_states,
             num_quantum_states,
         )
+        # Get the indices, which are the same for every trajectory and only
+        # built once for each shape.
+        inds = functions.batched_sparse_inds(((0, 0, 0), (0, 1, 1), (1, 0, 1)), shape)
+        # Assemble matrix elements.
+        mels = np.empty(3 * batch_size, dtype=complex)
+        mels[0::3] = dv_12_dzc
+        mels[1::3] = dv_12_dzc
+        mels[2::3] = dv_22_dzc
         return inds, mels, shape
 
     ingredients = [
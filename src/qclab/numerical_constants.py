@@ -18,6 +18,10 @@ GAUGE_FIX_THRESHOLD = 1e-3
 # Finite difference step size.
 FINITE_DIFFERENCE_DELTA = 1e-6
 
+# Largest number of Jacobi sweeps used to track eigenvectors from the previous
+# time step before falling back to a full diagonalization.
+EIGH_TRACKING_NUM_SWEEPS = 4
+
 # Speed of light [m/s].
 C_M_PER_S = 299792458
 
@@ -43,4 +47,4 @@ KBT_300K_INVCM = KB_INVCM_PER_K * 300
 
 # Conversion between inverse centimeters to reference energy.
 # A [INVCM] * INVCM_TO_300K = A [300K]
-INVCM_TO_300K = 1 / KBT_300K_INVCM
\ No newline at end of file
+INVCM_TO_300K = 1 / KBT_300K_INVCM
@@ -25,6 +25,13 @@ class Simulation:
             "batch_size": 25,
             "progress_bar": True,
             "debug": False,
+            "checkpoint_dir": None,
+            "checkpoint_interval": 1,
+            "memory_budget": 1e9,
+            "batch_retries": None,
+            "threads_per_task": None,
+            "pin_cpus": False,
+            "compiled_dynamics": False,
         }
         # Merge default settings with user-provided settings.
         settings = {**self.default_settings, **settings}
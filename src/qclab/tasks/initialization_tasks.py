@@ -186,8 +186,7 @@ def initialize_z_mcmc(sim, state, parameters, **kwargs):
         (sample_size, sim.model.constants.num_classical_coordinates), dtype=complex
     )
     for s, seed_s in enumerate(seed):
-        np.random.seed(seed_s)
-        save_inds[s] = np.random.randint(0, sample_size)
+        save_inds[s] = np.random.RandomState(seed_s).randint(0, sample_size)
     mcmc_z_initial, _ = functions.gen_sample_gaussian(
         sim.model.constants, z_initial=None, seed=0, separable=False
     )
@@ -322,6 +321,29 @@ def initialize_z(sim, state, parameters, **kwargs):
     return state, parameters
 
 
+def _bind_copy_in_state(sim, **kwargs):
+    """
+    Binds ``copy_in_state`` to the keyword arguments.
+    """
+    copy_name = kwargs["copy_name"]
+    orig_name = kwargs["orig_name"]
+
+    def step(sim, state, parameters):
+        orig = state[orig_name]
+        if isinstance(orig, np.ndarray):
+            # Copy into the existing array if it has the same shape and dtype.
+            np.copyto(
+                functions.state_buffer(state, copy_name, orig.shape, orig.dtype),
+                orig,
+            )
+        else:
+            state[copy_name] = np.copy(orig)
+        return state, parameters
+
+    return step
+
+
+@functions.bind_task(_bind_copy_in_state)
 def copy_in_state(sim, state, parameters, **kwargs):
     """
     Creates a copy of a variable in the state object with a new name.
@@ -339,8 +361,7 @@ def copy_in_state(sim, state, parameters, **kwargs):
     state[copy_name] : type of state[orig_name]
         Copy of ``state[orig_name]``.
     """
-    state[kwargs["copy_name"]] = np.copy(state[kwargs["orig_name"]])
-    return state, parameters
+    return _bind_copy_in_state(sim, **kwargs)(sim, state, parameters)
 
 
 def initialize_active_surface(sim, state, parameters, **kwargs):
@@ -453,9 +474,9 @@ def initialize_random_values_fssh(sim, state, parameters, **kwargs):
     hop_prob_rand_vals = np.zeros((batch_size, len(sim.settings.t_update)))
     init_act_surf_rand_vals = np.zeros((batch_size, num_branches))
     for nt in range(batch_size):
-        np.random.seed(seed[int(nt * num_branches)])
-        hop_prob_rand_vals[nt] = np.random.rand(len(sim.settings.t_update))
-        init_act_surf_rand_vals[nt] = np.random.rand(num_branches)
+        rng = np.random.RandomState(seed[int(nt * num_branches)])
+        hop_prob_rand_vals[nt] = rng.rand(len(sim.settings.t_update))
+        init_act_surf_rand_vals[nt] = rng.rand(num_branches)
     state[hop_prob_rand_vals_name] = hop_prob_rand_vals
     state[init_act_surf_rand_vals_name] = init_act_surf_rand_vals
     return state, parameters
@@ -6,6 +6,7 @@ during propagation.
 import logging
 import numpy as np
 from qclab import functions
+from qclab.utils import DISABLE_NUMBA
 import qclab.numerical_constants as numerical_constants
 
 logger = logging.getLogger(__name__)
@@ -94,6 +95,34 @@ def update_dh_c_dzc_finite_differences(sim, state, parameters, **kwargs):
     return state, parameters
 
 
+def _bind_update_classical_force(sim, **kwargs):
+    """
+    Binds ``update_classical_force`` to the keyword arguments and the ingredients
+    of the model.
+    """
+    z_name = kwargs.get("z_name", "z")
+    classical_force_name = kwargs.get("classical_force_name", "classical_force")
+    model = sim.model
+    dh_c_dzc, has_dh_c_dzc = model.get("dh_c_dzc")
+    if has_dh_c_dzc:
+
+        def step(sim, state, parameters):
+            state[classical_force_name] = dh_c_dzc(model, parameters, z=state[z_name])
+            return state, parameters
+
+        return step
+    if sim.settings.debug:
+        logger.info("dh_c_dzc not found; using finite differences.")
+
+    def step(sim, state, parameters):
+        return update_dh_c_dzc_finite_differences(
+            sim, state, parameters, dh_c_dzc_name=classical_force_name, z_name=z_name
+        )
+
+    return step
+
+
+@functions.bind_task(_bind_update_classical_force)
 def update_classical_force(sim, state, parameters, **kwargs):
     """
     Updates the gradient of the classical Hamiltonian w.r.t. the conjugate classical
@@ -112,19 +141,7 @@ def update_classical_force(sim, state, parameters, **kwargs):
     state[classical_force_name] : ndarray
             Gradient of the classical Hamiltonian.
     """
-    z_name = kwargs.get("z_name", "z")
-    classical_force_name = kwargs.get("classical_force_name", "classical_force")
-    z = state[z_name]
-    dh_c_dzc, has_dh_c_dzc = sim.model.get("dh_c_dzc")
-    if has_dh_c_dzc:
-        state[classical_force_name] = dh_c_dzc(sim.model, parameters, z=z)
-    else:
-        if sim.settings.debug:
-            logger.info("dh_c_dzc not found; using finite differences.")
-        state, parameters = update_dh_c_dzc_finite_differences(
-            sim, state, parameters, dh_c_dzc_name=classical_force_name, z_name=z_name
-        )
-    return state, parameters
+    return _bind_update_classical_force(sim, **kwargs)(sim, state, parameters)
 
 
 def update_dh_qc_dzc_finite_differences(sim, state, parameters, **kwargs):
@@ -132,9 +149,19 @@ def update_dh_qc_dzc_finite_differences(sim, state, parameters, **kwargs):
     Updates the gradient of the quantum-classical Hamiltonian using finite
     differences.
 
+    If the model constant ``dh_qc_dzc_finite_difference_learn_pattern`` is
+    ``True``, the positions of the nonzero elements of the gradient in any
+    trajectory are determined at the first call of each batch and stored in
+    the state object. Later calls then only offset the classical coordinates
+    that appear in this pattern and only evaluate its elements. Elements that
+    are zero in every trajectory at the first call are taken to remain zero.
+
     .. rubric:: Required Constants
     dh_qc_dzc_finite_difference_delta : float, default : numerical_constants.FINITE_DIFFERENCE_DELTA
         Finite-difference step size.
+    dh_qc_dzc_finite_difference_learn_pattern : bool, default : False
+        If ``True``, reuse the positions of the nonzero elements found at the
+        first call of each batch.
 
     .. rubric:: Keyword Arguments
     z_name : str, default: "z"
@@ -145,24 +172,41 @@ def update_dh_qc_dzc_finite_differences(sim, state, parameters, **kwargs):
     .. rubric:: Modifications
     state[dh_qc_dzc_name] : tuple
         Gradient of the quantum-classical Hamiltonian.
+    state["_" + dh_qc_dzc_name + "_pattern"] : tuple
+        Coordinates to offset, and indices of the nonzero elements of a single
+        trajectory and of the batch, if the pattern is learned.
     """
     z_name = kwargs.get("z_name", "z")
     dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
+    pattern_name = "_" + dh_qc_dzc_name + "_pattern"
     z = state[z_name]
     batch_size = len(z)
     delta_z = sim.model.constants.get(
         "dh_qc_dzc_finite_difference_delta", numerical_constants.FINITE_DIFFERENCE_DELTA
     )
+    learn_pattern = sim.model.constants.get(
+        "dh_qc_dzc_finite_difference_learn_pattern", False
+    )
     num_classical_coordinates = sim.model.constants.num_classical_coordinates
     num_quantum_states = sim.model.constants.num_quantum_states
-    # Calculate increments in the real and imaginary directions.
-    dz_re = delta_z * np.eye(num_classical_coordinates, dtype=z.dtype)
-    dz_im = 1j * dz_re
-    # Stack real/imag offset z coordinates.
-    z_offset = z[:, None, :]
-    z_offset_all = np.concatenate((z_offset + dz_re, z_offset + dz_im), axis=1).reshape(
-        -1, num_classical_coordinates
-    )
+    pattern = state.get(pattern_name) if learn_pattern else None
+    if pattern is not None and len(pattern[2][0]) != batch_size * len(pattern[1][0]):
+        # The pattern was learned for a different number of trajectories.
+        pattern = None
+    if pattern is None:
+        # Offset every classical coordinate.
+        coords = np.arange(num_classical_coordinates)
+    else:
+        # Only offset the classical coordinates that appear in the pattern.
+        coords, traj_inds, inds = pattern
+    num_coords = len(coords)
+    # Stack real/imag offset z coordinates, shifting each coordinate in place
+    # rather than adding dense increment matrices.
+    z_offset_all = np.repeat(z[:, None, :], 2 * num_coords, axis=1)
+    offset_ind = np.arange(num_coords)
+    z_offset_all[:, offset_ind, coords] += delta_z
+    z_offset_all[:, num_coords + offset_ind, coords] += 1j * delta_z
+    z_offset_all = z_offset_all.reshape(-1, num_classical_coordinates)
     # Get the quantum-classical Hamiltonian function.
     h_qc, _ = sim.model.get("h_qc")
     # Calculate it at the original z coordinate.
@@ -170,27 +214,99 @@ def update_dh_qc_dzc_finite_differences(sim, state, parameters, **kwargs):
     # Calculate h_qc at the offset coordinates.
     h_qc_all = h_qc(sim.model, parameters, z=z_offset_all).reshape(
         batch_size,
-        2 * num_classical_coordinates,
+        2 * num_coords,
         num_quantum_states,
         num_quantum_states,
     )
     # Split real/imag blocks of the offset h_qc.
-    h_qc_re = h_qc_all[:, :num_classical_coordinates, :, :]
-    h_qc_im = h_qc_all[:, num_classical_coordinates:, :, :]
+    h_qc_re = h_qc_all[:, :num_coords, :, :]
+    h_qc_im = h_qc_all[:, num_coords:, :, :]
+    shape = (
+        batch_size,
+        num_classical_coordinates,
+        num_quantum_states,
+        num_quantum_states,
+    )
+    if pattern is not None:
+        # Calculate finite-difference derivatives of the elements in the pattern.
+        coord_pos, row_ind, col_ind = traj_inds
+        h_qc_0_pattern = h_qc_0[:, row_ind, col_ind]
+        dh_qc_dzc_re = (
+            h_qc_re[:, coord_pos, row_ind, col_ind] - h_qc_0_pattern
+        ) / delta_z
+        dh_qc_dzc_im = (
+            h_qc_im[:, coord_pos, row_ind, col_ind] - h_qc_0_pattern
+        ) / delta_z
+        mels = (0.5 * (dh_qc_dzc_re + 1j * dh_qc_dzc_im)).reshape(-1)
+        state[dh_qc_dzc_name] = (inds, mels, shape)
+        return state, parameters
     # Calculate finite-difference derivatives.
     h_qc_0_new_ind = h_qc_0[:, None, :, :]
     dh_qc_dzc_re = (h_qc_re - h_qc_0_new_ind) / delta_z
     dh_qc_dzc_im = (h_qc_im - h_qc_0_new_ind) / delta_z
     dh_qc_dzc = 0.5 * (dh_qc_dzc_re + 1j * dh_qc_dzc_im)
+    if learn_pattern:
+        # Learn the positions of the nonzero elements in any trajectory.
+        coord_ind, row_ind, col_ind = np.nonzero(np.any(dh_qc_dzc != 0, axis=0))
+        coords, coord_pos = np.unique(coord_ind, return_inverse=True)
+        inds = (
+            np.repeat(np.arange(batch_size), len(coord_ind)),
+            np.tile(coord_ind, batch_size),
+            np.tile(row_ind, batch_size),
+            np.tile(col_ind, batch_size),
+        )
+        state[pattern_name] = (coords, (coord_pos, row_ind, col_ind), inds)
+        mels = dh_qc_dzc[:, coord_ind, row_ind, col_ind].reshape(-1)
+        state[dh_qc_dzc_name] = (inds, mels, shape)
+        return state, parameters
     # Get sparse representation of dh_qc_dzc.
     inds = np.where(dh_qc_dzc != 0)
     mels = dh_qc_dzc[inds]
-    shape = np.shape(dh_qc_dzc)
     # Update it in the state object.
     state[dh_qc_dzc_name] = (inds, mels, shape)
     return state, parameters
 
 
+def _bind_update_dh_qc_dzc(sim, **kwargs):
+    """
+    Binds ``update_dh_qc_dzc`` to the keyword arguments and the ingredients of
+    the model.
+    """
+    z_name = kwargs.get("z_name", "z")
+    dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
+    model = sim.model
+    update_dh_qc_dzc = model.update_dh_qc_dzc
+    # A gradient that is kept for the whole batch and is the same in every
+    # trajectory is calculated for a single trajectory and stored only once.
+    batch_invariant = not update_dh_qc_dzc and model.batch_invariant_dh_qc_dzc
+    dh_qc_dzc, has_dh_qc_dzc = model.get("dh_qc_dzc")
+    if not has_dh_qc_dzc and sim.settings.debug:
+        logger.info("dh_qc_dzc not found; using finite differences.")
+
+    def step(sim, state, parameters):
+        if update_dh_qc_dzc or not (dh_qc_dzc_name in state):
+            # If dh_qc_dzc has not been calculated yet, or if the
+            # model requires it to be updated, calculate it.
+            if has_dh_qc_dzc and batch_invariant:
+                z = state[z_name]
+                inds, mels, shape = dh_qc_dzc(model, parameters, z=z[:1])
+                state[dh_qc_dzc_name] = functions.BatchInvariantSparseGradient(
+                    inds[1:], mels, (len(z), *shape[1:])
+                )
+            elif has_dh_qc_dzc:
+                state[dh_qc_dzc_name] = dh_qc_dzc(model, parameters, z=state[z_name])
+            else:
+                state, parameters = update_dh_qc_dzc_finite_differences(
+                    sim, state, parameters, **kwargs
+                )
+        # If dh_qc_dzc has already been calculated and does not need to be
+        # updated, return the existing parameters and state objects.
+        return state, parameters
+
+    return step
+
+
+@functions.bind_task(_bind_update_dh_qc_dzc)
 def update_dh_qc_dzc(sim, state, parameters, **kwargs):
     """
     Updates the gradient of the quantum-classical Hamiltonian w.r.t. the conjugate
@@ -206,29 +322,72 @@ def update_dh_qc_dzc(sim, state, parameters, **kwargs):
         Name under which to store the gradient of the quantum-classical Hamiltonian in the state object.
 
     .. rubric:: Modifications
-    state[dh_qc_dzc_name] : tuple
-        Gradient of the quantum-classical Hamiltonian.
+    state[dh_qc_dzc_name] : tuple or BatchInvariantSparseGradient
+        Gradient of the quantum-classical Hamiltonian. If the model does not
+        update the gradient during the dynamics and marks it as the same in
+        every trajectory (``model.batch_invariant_dh_qc_dzc``), it is
+        calculated for a single trajectory and stored once for the batch as a
+        ``BatchInvariantSparseGradient``.
+    """
+    return _bind_update_dh_qc_dzc(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_quantum_classical_force(sim, **kwargs):
+    """
+    Binds ``update_quantum_classical_force`` to the keyword arguments, the
+    settings, and the ingredients of the model.
     """
     z_name = kwargs.get("z_name", "z")
+    wf_db_name = kwargs.get("wf_db_name", "wf_db")
     dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
-    z = state[z_name]
-    if not (dh_qc_dzc_name in state) or sim.model.update_dh_qc_dzc:
-        # If dh_qc_dzc has not been calculated yet, or if the
-        # model requires it to be updated, calculate it.
-        dh_qc_dzc, has_dh_qc_dzc = sim.model.get("dh_qc_dzc")
-        if has_dh_qc_dzc:
-            state[dh_qc_dzc_name] = dh_qc_dzc(sim.model, parameters, z=z)
-        else:
-            if sim.settings.debug:
-                logger.info("dh_qc_dzc not found; using finite differences.")
-            state, parameters = update_dh_qc_dzc_finite_differences(
-                sim, state, parameters, **kwargs
+    quantum_classical_force_name = kwargs.get(
+        "quantum_classical_force_name", "quantum_classical_force"
+    )
+    state_ind_name = kwargs.get("state_ind_name", "act_surf_ind")
+    wf_changed = kwargs.get("wf_changed", True)
+    # Update the gradient of h_qc.
+    update_dh_qc_dzc_step = _bind_update_dh_qc_dzc(
+        sim, z_name=z_name, dh_qc_dzc_name=dh_qc_dzc_name
+    )
+    # Calculate the expectation value w.r.t. the wavefunction.
+    # If not(wf_changed) and sim.model.update_dh_qc_dzc then recalculate.
+    # If wf_changed then recalculate.
+    # If quantum_classical_force_name not in state then recalculate.
+    always_recalculate = wf_changed or sim.model.update_dh_qc_dzc
+    add_gauge_field_force_step = None
+    if sim.algorithm.settings.get("use_gauge_field_force"):
+        add_gauge_field_force_step = _bind_add_gauge_field_force(
+            sim, state_ind_name=state_ind_name
+        )
+
+    def step(sim, state, parameters):
+        state, parameters = update_dh_qc_dzc_step(sim, state, parameters)
+        if always_recalculate or not (quantum_classical_force_name in state):
+            wf_db = state[wf_db_name]
+            quantum_classical_force = functions.state_buffer(
+                state, quantum_classical_force_name, np.shape(state[z_name])
             )
-    # If dh_qc_dzc has already been calculated and does not need to be updated,
-    # return the existing parameters and state objects.
-    return state, parameters
+            dh_qc_dzc = state[dh_qc_dzc_name]
+            if isinstance(dh_qc_dzc, functions.BatchInvariantSparseGradient):
+                calc_sparse_inner_product = (
+                    functions.calc_batch_invariant_sparse_inner_product
+                )
+            else:
+                calc_sparse_inner_product = functions.calc_sparse_inner_product
+            calc_sparse_inner_product(
+                *dh_qc_dzc,
+                wf_db.conj(),
+                wf_db,
+                out=quantum_classical_force.reshape(-1),
+            )
+        if add_gauge_field_force_step is not None:
+            state, parameters = add_gauge_field_force_step(sim, state, parameters)
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_update_quantum_classical_force)
 def update_quantum_classical_force(sim, state, parameters, **kwargs):
     """
     Updates the quantum-classical force w.r.t. the wavefunction defined by ``wf_db``.
@@ -255,49 +414,43 @@ def update_quantum_classical_force(sim, state, parameters, **kwargs):
         If ``True``, the wavefunction has changed since the last time the force were calculated.
 
     .. rubric:: Modifications
-    state[dh_qc_dzc_name] : tuple
+    state[dh_qc_dzc_name] : tuple or BatchInvariantSparseGradient
         Gradient of the quantum-classical Hamiltonian.
     state[quantum_classical_force_name] : ndarray
         Quantum-classical force.
     """
+    return _bind_update_quantum_classical_force(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_add_gauge_field_force(sim, **kwargs):
+    """
+    Binds ``add_gauge_field_force`` to the keyword arguments and the ingredients
+    of the model.
+    """
     z_name = kwargs.get("z_name", "z")
-    wf_db_name = kwargs.get("wf_db_name", "wf_db")
-    dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
+    adb_state_ind_name = kwargs.get("adb_state_ind_name", "act_surf_ind")
     quantum_classical_force_name = kwargs.get(
         "quantum_classical_force_name", "quantum_classical_force"
     )
-    state_ind_name = kwargs.get("state_ind_name", "act_surf_ind")
-    wf_changed = kwargs.get("wf_changed", True)
-    z = state[z_name]
-    wf_db = state[wf_db_name]
-    # Update the gradient of h_qc.
-    state, parameters = update_dh_qc_dzc(
-        sim, state, parameters, z_name=z_name, dh_qc_dzc_name=dh_qc_dzc_name
-    )
-    # Calculate the expectation value w.r.t. the wavefunction.
-    # If not(wf_changed) and sim.model.update_dh_qc_dzc then recalculate.
-    # If wf_changed then recalculate.
-    # If quantum_classical_force_name not in state then recalculate.
-    if (
-        not (quantum_classical_force_name in state)
-        or wf_changed
-        or (not (wf_changed) and sim.model.update_dh_qc_dzc)
-    ):
-        if not (quantum_classical_force_name in state):
-            state[quantum_classical_force_name] = np.zeros_like(z)
-        state[quantum_classical_force_name] = functions.calc_sparse_inner_product(
-            *state[dh_qc_dzc_name],
-            wf_db.conj(),
-            wf_db,
-            out=state[quantum_classical_force_name].reshape(-1),
-        ).reshape(np.shape(z))
-    if sim.algorithm.settings.get("use_gauge_field_force"):
-        state, parameters = add_gauge_field_force(
-            sim, state, parameters, z=z, state_ind_name=state_ind_name
-        )
-    return state, parameters
+    model = sim.model
+    gauge_field_force, has_gauge_field_force = model.get("gauge_field_force")
+    debug = sim.settings.debug
+
+    def step(sim, state, parameters):
+        if has_gauge_field_force:
+            gauge_field_force_val = gauge_field_force(
+                model, parameters, z=state[z_name], state_ind=state[adb_state_ind_name]
+            )
+            state[quantum_classical_force_name] += gauge_field_force_val
+        else:
+            if debug:
+                logger.warning("gauge_field_force not found; skipping.")
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_add_gauge_field_force)
 def add_gauge_field_force(sim, state, parameters, **kwargs):
     """
     Adds the quantum-classical force with the gauge field force if the model has a
@@ -318,30 +471,101 @@ def add_gauge_field_force(sim, state, parameters, **kwargs):
     state[quantum_classical_force_name] : ndarray
         Quantum-classical force with gauge field force added.
     """
-    z_name = kwargs.get("z_name", "z")
-    adb_state_ind_name = kwargs.get("adb_state_ind_name", "act_surf_ind")
-    quantum_classical_force_name = kwargs.get(
-        "quantum_classical_force_name", "quantum_classical_force"
-    )
-    z = state[z_name]
-    adb_state_ind = state[adb_state_ind_name]
-    gauge_field_force, has_gauge_field_force = sim.model.get("gauge_field_force")
-    if has_gauge_field_force:
-        gauge_field_force_val = gauge_field_force(
-            sim.model, parameters, z=z, state_ind=adb_state_ind
-        )
-        state[quantum_classical_force_name] += gauge_field_force_val
+    return _bind_add_gauge_field_force(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_diagonalize_matrix(sim, **kwargs):
+    """
+    Binds ``diagonalize_matrix`` to the keyword arguments and the settings.
+    """
+    matrix_name = kwargs["matrix_name"]
+    eigvals_name = kwargs["eigvals_name"]
+    eigvecs_name = kwargs["eigvecs_name"]
+    eigvecs_previous_name = kwargs.get("eigvecs_previous_name")
+    if eigvecs_previous_name is None or DISABLE_NUMBA:
+        track_eigvecs = False
+    elif "track_eigvecs" in kwargs:
+        track_eigvecs = kwargs["track_eigvecs"]
     else:
-        if sim.settings.debug:
-            logger.warning("gauge_field_force not found; skipping.")
-    return state, parameters
+        track_eigvecs = sim.algorithm.settings.get("track_eigvecs", False)
+
+    def step(sim, state, parameters):
+        matrix = state[matrix_name]
+        if matrix.ndim == 3 and matrix.shape[-2:] == (2, 2) and not DISABLE_NUMBA:
+            eigvals = functions.state_buffer(
+                state, eigvals_name, matrix.shape[:-1], dtype=np.float64
+            )
+            eigvecs = functions.state_buffer(
+                state,
+                eigvecs_name,
+                matrix.shape,
+                dtype=np.result_type(matrix.dtype, np.float64),
+            )
+            functions.eigh_2x2(matrix, eigvals, eigvecs)
+            return state, parameters
+        if track_eigvecs and matrix.ndim == 3:
+            batch_size, num_quantum_states = matrix.shape[:-1]
+            eigvals = functions.state_buffer(
+                state, eigvals_name, matrix.shape[:-1], dtype=np.float64
+            )
+            eigvecs = functions.state_buffer(state, eigvecs_name, matrix.shape)
+            tracked = functions.state_buffer(
+                state, "_" + eigvecs_name + "_tracked", (batch_size,), dtype=np.bool_
+            )
+            work = functions.state_buffer(
+                state,
+                "_" + eigvecs_name + "_tracking_work",
+                (2, num_quantum_states, num_quantum_states),
+            )
+            functions.eigh_tracking(
+                matrix,
+                state[eigvecs_previous_name],
+                eigvals,
+                eigvecs,
+                tracked,
+                work,
+                numerical_constants.SMALL,
+                numerical_constants.EIGH_TRACKING_NUM_SWEEPS,
+            )
+            if not np.all(tracked):
+                untracked = np.where(~tracked)[0]
+                eigvals_untracked, eigvecs_untracked = np.linalg.eigh(matrix[untracked])
+                # Use the same sign convention as the tracked eigenvectors.
+                overlap = np.sum(
+                    np.conj(state[eigvecs_previous_name][untracked])
+                    * eigvecs_untracked,
+                    axis=-2,
+                )
+                eigvecs_untracked *= np.where(np.real(overlap) < 0, -1, 1)[:, None, :]
+                eigvals[untracked] = eigvals_untracked
+                eigvecs[untracked] = eigvecs_untracked
+            return state, parameters
+        eigvals, eigvecs = np.linalg.eigh(matrix)
+        state[eigvals_name] = eigvals
+        state[eigvecs_name] = eigvecs
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_diagonalize_matrix)
 def diagonalize_matrix(sim, state, parameters, **kwargs):
     """
     Diagonalizes a given matrix from the state object and stores the eigenvalues and
     eigenvectors in the state object.
 
+    Batches of 2x2 matrices are diagonalized in closed form with
+    ``functions.eigh_2x2`` when numba is available, and other matrices with
+    ``np.linalg.eigh``. In both cases the eigenvalues are in ascending order.
+
+    If ``track_eigvecs`` is True and ``eigvecs_previous_name`` is given, larger
+    matrices are instead diagonalized starting from the previous eigenvectors with
+    ``functions.eigh_tracking``, so that each eigenvector is the continuation of
+    the previous one. Trajectories with nearly degenerate or reordered eigenvalues
+    are diagonalized with ``np.linalg.eigh``. In both cases the sign of each
+    eigenvector is chosen so that the real part of its overlap with the previous
+    eigenvector is positive, as with the ``"sign_overlap"`` gauge fixing.
+
     .. rubric:: Required Constants
     None
 
@@ -352,6 +576,11 @@ def diagonalize_matrix(sim, state, parameters, **kwargs):
         Name of the eigenvalues in the state object.
     eigvecs_name : str
         Name of the eigenvectors in the state object.
+    eigvecs_previous_name : str, default: None
+        Name of the previous eigenvectors in the state object.
+    track_eigvecs : bool, default: sim.algorithm.settings.track_eigvecs
+        If True, the eigenvectors are tracked from the previous eigenvectors.
+        Defaults to False if the algorithm has no ``track_eigvecs`` setting.
 
     .. rubric:: Modifications
     state[eigvals_name] : ndarray
@@ -359,13 +588,89 @@ def diagonalize_matrix(sim, state, parameters, **kwargs):
     state[eigvecs_name] : ndarray
         Eigenvectors of the matrix.
     """
-    matrix = state[kwargs["matrix_name"]]
-    eigvals, eigvecs = np.linalg.eigh(matrix)
-    state[kwargs["eigvals_name"]] = eigvals
-    state[kwargs["eigvecs_name"]] = eigvecs
-    return state, parameters
+    return _bind_diagonalize_matrix(sim, **kwargs)(sim, state, parameters)
 
 
+def _bind_update_eigvecs_gauge(sim, **kwargs):
+    """
+    Binds ``update_eigvecs_gauge`` to the keyword arguments and the settings.
+    """
+    eigvals_name = kwargs.get("eigvals_name", "eigvals")
+    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
+    eigvecs_previous_name = kwargs.get("eigvecs_previous_name", "eigvecs_previous")
+    output_eigvecs_name = kwargs.get("output_eigvecs_name", eigvecs_name)
+    z_name = kwargs.get("z_name", "z")
+    dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
+    gauge_fixing = kwargs.get("gauge_fixing", sim.algorithm.settings.gauge_fixing)
+    gauge_fixing_numerical_values = {
+        "sign_overlap": 0,
+        "phase_overlap": 1,
+        "phase_der_couple": 2,
+    }
+    try:
+        gauge_fixing_value = gauge_fixing_numerical_values[gauge_fixing]
+    except KeyError:
+        logger.critical("Invalid gauge_fixing value: %s", gauge_fixing)
+        raise ValueError(f"Invalid gauge_fixing value: {gauge_fixing}")
+    debug = sim.settings.debug
+    if gauge_fixing_value == 2:
+        update_dh_qc_dzc_step = _bind_update_dh_qc_dzc(sim, z_name=z_name)
+
+    def step(sim, state, parameters):
+        eigvals = state[eigvals_name]
+        eigvecs = state[eigvecs_name]
+        eigvecs_previous = state[eigvecs_previous_name]
+        if gauge_fixing_value == 1:
+            # Maximize the real part of the overlap (guaranteed to be positive).
+            overlap = np.sum(np.conj(eigvecs_previous) * eigvecs, axis=-2)
+            phase = np.exp(-1j * np.angle(overlap))
+            eigvecs *= phase[:, None, :]
+        if gauge_fixing_value == 2:
+            # Make the derivative couplings real-valued (but not necessarily positive).
+            state, parameters = update_dh_qc_dzc_step(sim, state, parameters)
+            der_couple_dq_phase, _ = functions.analytic_der_couple_phase(
+                sim, state[dh_qc_dzc_name], eigvals, eigvecs
+            )
+            eigvecs *= np.conj(der_couple_dq_phase)[:, None, :]
+        if gauge_fixing_value == 0 or gauge_fixing_value == 2:
+            # Make the real part positive based on the sign of the real part of the overlap.
+            overlap = np.sum(np.conj(eigvecs_previous) * eigvecs, axis=-2)
+            signs = np.sign(np.real(overlap))
+            if debug:
+                if np.any(np.abs(signs) < numerical_constants.SMALL):
+                    logger.error(
+                        "Zero overlap encountered when fixing gauge.\n"
+                        "This may indicate a trivial crossing or degeneracy.\n"
+                        "Normalization will be broken and results will be incorrect."
+                    )
+            eigvecs *= signs[:, None, :]
+        if gauge_fixing_value == 2 and debug:
+            der_couple_dq_phase_new, der_couple_dp_phase_new = (
+                functions.analytic_der_couple_phase(
+                    sim, state[dh_qc_dzc_name], eigvals, eigvecs
+                )
+            )
+            if (
+                np.sum(
+                    np.abs(np.imag(der_couple_dq_phase_new)) ** 2
+                    + np.abs(np.imag(der_couple_dp_phase_new)) ** 2
+                )
+                > numerical_constants.SMALL
+            ):
+                logger.error(
+                    "Phase error encountered when fixing gauge analytically. %s",
+                    np.sum(
+                        np.abs(np.imag(der_couple_dq_phase_new)) ** 2
+                        + np.abs(np.imag(der_couple_dp_phase_new)) ** 2
+                    ),
+                )
+        state[output_eigvecs_name] = eigvecs
+        return state, parameters
+
+    return step
+
+
+@functions.bind_task(_bind_update_eigvecs_gauge)
 def update_eigvecs_gauge(sim, state, parameters, **kwargs):
     """
     Updates the gauge of the eigenvectors as specified by the gauge_fixing parameter.
@@ -409,74 +714,28 @@ def update_eigvecs_gauge(sim, state, parameters, **kwargs):
     state[output_eigvecs_name] : ndarray
         Gauge-fixed eigenvectors.
     """
-    eigvals_name = kwargs.get("eigvals_name", "eigvals")
-    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
-    eigvecs_previous_name = kwargs.get("eigvecs_previous_name", "eigvecs_previous")
-    output_eigvecs_name = kwargs.get("output_eigvecs_name", eigvecs_name)
-    z_name = kwargs.get("z_name", "z")
-    dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
-    eigvals = state[eigvals_name]
-    eigvecs = state[eigvecs_name]
-    eigvecs_previous = state[eigvecs_previous_name]
-    gauge_fixing = kwargs.get("gauge_fixing", sim.algorithm.settings.gauge_fixing)
-    gauge_fixing_numerical_values = {
-        "sign_overlap": 0,
-        "phase_overlap": 1,
-        "phase_der_couple": 2,
-    }
-    try:
-        gauge_fixing_value = gauge_fixing_numerical_values[gauge_fixing]
-    except KeyError:
-        logger.critical("Invalid gauge_fixing value: %s", gauge_fixing)
-        raise ValueError(f"Invalid gauge_fixing value: {gauge_fixing}")
-    if gauge_fixing_value == 1:
-        # Maximize the real part of the overlap (guaranteed to be positive).
-        overlap = np.sum(np.conj(eigvecs_previous) * eigvecs, axis=-2)
-        phase = np.exp(-1j * np.angle(overlap))
-        eigvecs *= phase[:, None, :]
-    if gauge_fixing_value == 2:
-        # Make the derivative couplings real-valued (but not necessarily positive).
-        state, parameters = update_dh_qc_dzc(sim, state, parameters, z_name=z_name)
-        der_couple_dq_phase, _ = functions.analytic_der_couple_phase(
-            sim, state[dh_qc_dzc_name], eigvals, eigvecs
-        )
-        eigvecs *= np.conj(der_couple_dq_phase)[:, None, :]
-    if gauge_fixing_value == 0 or gauge_fixing_value == 2:
-        # Make the real part positive based on the sign of the real part of the overlap.
-        overlap = np.sum(np.conj(eigvecs_previous) * eigvecs, axis=-2)
-        signs = np.sign(np.real(overlap))
-        if sim.settings.debug:
-            if np.any(np.abs(signs) < numerical_constants.SMALL):
-                logger.error(
-                    "Zero overlap encountered when fixing gauge.\n"
-                    "This may indicate a trivial crossing or degeneracy.\n"
-                    "Normalization will be broken and results will be incorrect."
-                )
-        eigvecs *= signs[:, None, :]
-    if gauge_fixing_value == 2 and sim.settings.debug:
-        der_couple_dq_phase_new, der_couple_dp_phase_new = (
-            functions.analytic_der_couple_phase(
-                sim, state[dh_qc_dzc_name], eigvals, eigvecs
-            )
+    return _bind_update_eigvecs_gauge(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_vector_basis(sim, **kwargs):
+    """
+    Binds ``update_vector_basis`` to the keyword arguments.
+    """
+    input_vec_name = kwargs["input_vec_name"]
+    basis_name = kwargs["basis_name"]
+    output_vec_name = kwargs["output_vec_name"]
+    adb_to_db = kwargs["adb_to_db"]
+
+    def step(sim, state, parameters):
+        state[output_vec_name] = functions.transform_vec(
+            state[input_vec_name], state[basis_name], adb_to_db=adb_to_db
         )
-        if (
-            np.sum(
-                np.abs(np.imag(der_couple_dq_phase_new)) ** 2
-                + np.abs(np.imag(der_couple_dp_phase_new)) ** 2
-            )
-            > numerical_constants.SMALL
-        ):
-            logger.error(
-                "Phase error encountered when fixing gauge analytically. %s",
-                np.sum(
-                    np.abs(np.imag(der_couple_dq_phase_new)) ** 2
-                    + np.abs(np.imag(der_couple_dp_phase_new)) ** 2
-                ),
-            )
-    state[output_eigvecs_name] = eigvecs
-    return state, parameters
+        return state, parameters
 
+    return step
 
+
+@functions.bind_task(_bind_update_vector_basis)
 def update_vector_basis(sim, state, parameters, **kwargs):
     """
     Transforms a vector to a new basis.
@@ -501,15 +760,28 @@ def update_vector_basis(sim, state, parameters, **kwargs):
     state[output_vec_name] : ndarray
         Vector expressed in the new basis.
     """
-    input_vec = state[kwargs["input_vec_name"]]
-    basis = state[kwargs["basis_name"]]
-    adb_to_db = kwargs["adb_to_db"]
-    state[kwargs["output_vec_name"]] = functions.transform_vec(
-        input_vec, basis, adb_to_db=adb_to_db
-    )
-    return state, parameters
+    return _bind_update_vector_basis(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_act_surf_wf(sim, **kwargs):
+    """
+    Binds ``update_act_surf_wf`` to the keyword arguments and the settings.
+    """
+    act_surf_wf_name = kwargs.get("act_surf_wf_name", "act_surf_wf")
+    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
+    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
+    traj_inds = np.arange(sim.settings.batch_size, dtype=int)
+
+    def step(sim, state, parameters):
+        state[act_surf_wf_name] = state[eigvecs_name][
+            traj_inds, :, state[act_surf_ind_name]
+        ]
+        return state, parameters
 
+    return step
 
+
+@functions.bind_task(_bind_update_act_surf_wf)
 def update_act_surf_wf(sim, state, parameters, **kwargs):
     """
     Updates the wavefunction corresponding to the active surface.
@@ -529,20 +801,51 @@ def update_act_surf_wf(sim, state, parameters, **kwargs):
     state[act_surf_wf_name] : ndarray
         Wavefunction of the active surface.
     """
-    act_surf_wf_name = kwargs.get("act_surf_wf_name", "act_surf_wf")
-    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
+    return _bind_update_act_surf_wf(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_wf_db_propagator(sim, **kwargs):
+    """
+    Binds ``update_wf_db_propagator`` to the keyword arguments and the settings.
+    """
+    wf_db_name = kwargs.get("wf_db_name", "wf_db")
+    eigvals_name = kwargs.get("eigvals_name", "eigvals")
     eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
-    num_trajs = sim.settings.batch_size
-    act_surf_wf = state[eigvecs_name][
-        np.arange(num_trajs, dtype=int), :, state[act_surf_ind_name]
-    ]
-    state[act_surf_wf_name] = act_surf_wf
-    return state, parameters
+    if "prop_db_name" in kwargs:
+        prop_db_name = kwargs["prop_db_name"]
+    elif sim.algorithm is not None and sim.algorithm.settings.get("store_prop_db"):
+        prop_db_name = "prop_db"
+    else:
+        prop_db_name = None
+    work_name = "_" + wf_db_name + "_propagator_work"
+    dt_update = sim.settings.dt_update
+
+    def step(sim, state, parameters):
+        wf_db = state[wf_db_name]
+        eigvals = state[eigvals_name]
+        eigvecs = state[eigvecs_name]
+        if prop_db_name is not None:
+            prop_db = functions.state_buffer(state, prop_db_name, np.shape(eigvecs))
+            np.matmul(
+                eigvecs * np.exp(-1j * eigvals * dt_update)[..., None, :],
+                np.swapaxes(eigvecs.conj(), -1, -2),
+                out=prop_db,
+            )
+        work = functions.state_buffer(state, work_name, (np.shape(wf_db)[-1],))
+        functions.update_wf_db_propagator_step(wf_db, eigvals, eigvecs, dt_update, work)
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_update_wf_db_propagator)
 def update_wf_db_propagator(sim, state, parameters, **kwargs):
     """
-    Updates the diabatic wavefunction by calculating and applying the propagator.
+    Updates the diabatic wavefunction by applying the propagator of the eigenvalues
+    and eigenvectors in the state object.
+
+    The propagator is applied in the adiabatic basis with two matrix-vector products
+    per trajectory instead of being constructed in the diabatic basis.
 
     .. rubric:: Required Constants
     None
@@ -554,31 +857,41 @@ def update_wf_db_propagator(sim, state, parameters, **kwargs):
         Name of the eigenvalues in the state object.
     eigvecs_name : str, default: "eigvecs"
         Name of the eigenvectors in the state object.
+    prop_db_name : str, default: None
+        If given, name under which to also store the propagator in the diabatic
+        basis in the state object. This costs an additional matrix product per
+        trajectory, so it should only be given if the propagator is used by
+        another task. Defaults to "prop_db" if the algorithm has a
+        ``store_prop_db`` setting that is True.
 
     .. rubric:: Modifications
     state[wf_db_name] : ndarray
         Updated diabatic wavefunction.
+    state[prop_db_name] : ndarray
+        Propagator in the diabatic basis, only if ``prop_db_name`` is given.
+    """
+    return _bind_update_wf_db_propagator(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_wf_db_rk4(sim, **kwargs):
     """
+    Binds ``update_wf_db_rk4`` to the keyword arguments and the settings.
+    """
+    dt_update = sim.settings.dt_update
     wf_db_name = kwargs.get("wf_db_name", "wf_db")
-    eigvals_name = kwargs.get("eigvals_name", "eigvals")
-    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
-    wf_db = state[wf_db_name]
-    eigvals = state[eigvals_name]
-    eigvecs = state[eigvecs_name]
-    batch_size = sim.settings.batch_size
-    num_quantum_states = sim.model.constants.num_quantum_states
-    # Calculate the propagator in the adiabatic basis.
-    prop_adb = np.zeros(
-        (batch_size, num_quantum_states, num_quantum_states), dtype=complex
-    )
-    idx = np.arange(num_quantum_states)
-    prop_adb[:, idx, idx] = np.exp(-1j * eigvals * sim.settings.dt_update)
-    # Transform propagator to the diabatic basis.
-    prop_db = functions.transform_mat(prop_adb, eigvecs, adb_to_db=True)
-    state[wf_db_name] = functions.batch_matvec(prop_db, wf_db)
-    return state, parameters
+    h_q_tot_name = kwargs.get("h_q_tot_name", "h_q_tot")
+    work_name = "_" + wf_db_name + "_rk4_work"
+
+    def step(sim, state, parameters):
+        wf_db = state[wf_db_name]
+        work = functions.state_buffer(state, work_name, (3, np.shape(wf_db)[-1]))
+        functions.update_wf_db_rk4_step(wf_db, state[h_q_tot_name], dt_update, work)
+        return state, parameters
 
+    return step
 
+
+@functions.bind_task(_bind_update_wf_db_rk4)
 def update_wf_db_rk4(sim, state, parameters, **kwargs):
     """
     Updates the wavefunction using the 4th-order Runge-Kutta method.
@@ -596,22 +909,59 @@ def update_wf_db_rk4(sim, state, parameters, **kwargs):
     state[wf_db_name] : ndarray
         Updated diabatic wavefunction.
     """
-    dt_update = sim.settings.dt_update
-    wf_db_name = kwargs.get("wf_db_name", "wf_db")
-    h_q_tot_name = kwargs.get("h_q_tot_name", "h_q_tot")
-    wf_db = state[wf_db_name]
-    h_q_tot = state[h_q_tot_name]
-    k1 = -1j * functions.batch_matvec(h_q_tot, wf_db)
-    k2 = -1j * functions.batch_matvec(h_q_tot, (wf_db + 0.5 * dt_update * k1))
-    k3 = -1j * functions.batch_matvec(h_q_tot, (wf_db + 0.5 * dt_update * k2))
-    k4 = -1j * functions.batch_matvec(h_q_tot, (wf_db + dt_update * k3))
-    wf_db += dt_update * 0.16666666666666666 * k1
-    wf_db += dt_update * 0.3333333333333333 * k2
-    wf_db += dt_update * 0.3333333333333333 * k3
-    wf_db += dt_update * 0.16666666666666666 * k4
-    return state, parameters
+    return _bind_update_wf_db_rk4(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_hop_prob_fssh(sim, **kwargs):
+    """
+    Binds ``update_hop_prob_fssh`` to the keyword arguments and the settings.
+    """
+    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
+    wf_adb_name = kwargs.get("wf_adb_name", "wf_adb")
+    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
+    eigvecs_previous_name = kwargs.get("eigvecs_previous_name", "eigvecs_previous")
+    hop_prob_name = kwargs.get("hop_prob_name", "hop_prob")
+    if sim.algorithm.settings.fssh_deterministic:
+        num_branches = sim.model.constants.num_quantum_states
+    else:
+        num_branches = 1
+    num_trajs = sim.settings.batch_size // num_branches
+    traj_inds = np.arange(num_trajs * num_branches, dtype=int)
+    debug = sim.settings.debug
+
+    def step(sim, state, parameters):
+        act_surf_ind = state[act_surf_ind_name]
+        wf_adb = state[wf_adb_name]
+        eigvecs = state[eigvecs_name]
+        eigvecs_previous = state[eigvecs_previous_name]
+        # Check if any of the coefficients on the active surface are zero.
+        if debug:
+            if np.any(np.abs(wf_adb[traj_inds, act_surf_ind]) == 0.0):
+                logger.warning(
+                    "Zero coefficient on active surface encountered when calculating hopping probabilities."
+                )
+        # Calculates < act_surf(t) | b(t-dt) > = -\dot{q} \cdot d_{act_surf,b} dt
+        nac_prod = functions.batch_matvec(
+            np.swapaxes(eigvecs_previous, -1, -2),
+            np.conj(eigvecs[traj_inds, :, act_surf_ind]),
+        )
+        # Calculates -2 Re( (C_b / C_act_surf) < act_surf(t) | b(t-dt) > )
+        hop_prob = -2.0 * np.real(
+            nac_prod * wf_adb / wf_adb[traj_inds, act_surf_ind][:, np.newaxis]
+        )
+        # Sets hopping probabilities to 0 at the active surface.
+        hop_prob[traj_inds, act_surf_ind] = 0.0
+        # Check for singular values.
+        if debug:
+            if np.any(np.isnan(hop_prob)):
+                logger.warning("Singluar value encountered in hopping probabilities.")
+        state[hop_prob_name] = hop_prob
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_update_hop_prob_fssh)
 def update_hop_prob_fssh(sim, state, parameters, **kwargs):
     """
     Calculates the hopping probabilities according to the FSSH algorithm.
@@ -637,51 +987,54 @@ def update_hop_prob_fssh(sim, state, parameters, **kwargs):
     state[hop_prob_name] : ndarray
         Hopping probabilities between the active surface and all other surfaces.
     """
-    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
-    wf_adb_name = kwargs.get("wf_adb_name", "wf_adb")
-    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
-    eigvecs_previous_name = kwargs.get("eigvecs_previous_name", "eigvecs_previous")
+    return _bind_update_hop_prob_fssh(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_hop_inds_fssh(sim, **kwargs):
+    """
+    Binds ``update_hop_inds_fssh`` to the keyword arguments and the settings.
+    """
     hop_prob_name = kwargs.get("hop_prob_name", "hop_prob")
-    act_surf_ind = state[act_surf_ind_name]
-    wf_adb = state[wf_adb_name]
-    eigvecs = state[eigvecs_name]
-    eigvecs_previous = state[eigvecs_previous_name]
+    hop_prob_rand_vals_name = kwargs.get(
+        "hop_prob_rand_vals_name", "hop_prob_rand_vals"
+    )
+    hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
+    hop_dest_name = kwargs.get("hop_dest_name", "hop_dest")
     if sim.algorithm.settings.fssh_deterministic:
         num_branches = sim.model.constants.num_quantum_states
     else:
         num_branches = 1
     num_trajs = sim.settings.batch_size // num_branches
-    # Check if any of the coefficients on the active surface are zero.
-    if sim.settings.debug:
-        if np.any(
-            np.abs(wf_adb[np.arange(num_trajs * num_branches), act_surf_ind]) == 0.0
-        ):
-            logger.warning(
-                "Zero coefficient on active surface encountered when calculating hopping probabilities."
-            )
-    # Calculates < act_surf(t) | b(t-dt) > = -\dot{q} \cdot d_{act_surf,b} dt
-    nac_prod = functions.batch_matvec(
-        np.swapaxes(eigvecs_previous, -1, -2),
-        np.conj(
-            eigvecs[np.arange(num_trajs * num_branches, dtype=int), :, act_surf_ind]
-        ),
-    )
-    # Calculates -2 Re( (C_b / C_act_surf) < act_surf(t) | b(t-dt) > )
-    hop_prob = -2.0 * np.real(
-        nac_prod
-        * wf_adb
-        / wf_adb[np.arange(num_trajs * num_branches), act_surf_ind][:, np.newaxis]
-    )
-    # Sets hopping probabilities to 0 at the active surface.
-    hop_prob[np.arange(num_branches * num_trajs), act_surf_ind] = 0.0
-    # Check for singular values.
-    if sim.settings.debug:
-        if np.any(np.isnan(hop_prob)):
-            logger.warning("Singluar value encountered in hopping probabilities.")
-    state[hop_prob_name] = hop_prob
-    return state, parameters
-
-
+    branch_ones = np.ones((num_trajs, num_branches))
+
+    def step(sim, state, parameters):
+        hop_prob = state[hop_prob_name]
+        # Create a copy of hop_prob and set negative values to 0.
+        hop_prob_positive = np.copy(hop_prob)
+        hop_prob_positive[np.where(hop_prob < 0)] *= 0
+        rand = state[hop_prob_rand_vals_name][:, sim.t_ind]
+        cumulative_probs = np.cumsum(
+            np.nan_to_num(
+                hop_prob_positive, nan=0, posinf=100e100, neginf=0, copy=False
+            ),
+            axis=1,
+        )
+        rand_branch = (rand[:, np.newaxis] * branch_ones).flatten()
+        hop_ind = np.where(
+            np.sum((cumulative_probs > rand_branch[:, np.newaxis]).astype(int), axis=1)
+            > 0
+        )[0]
+        hop_dest = np.argmax(
+            (cumulative_probs > rand_branch[:, np.newaxis]).astype(int), axis=1
+        )[hop_ind]
+        state[hop_ind_name] = hop_ind
+        state[hop_dest_name] = hop_dest
+        return state, parameters
+
+    return step
+
+
+@functions.bind_task(_bind_update_hop_inds_fssh)
 def update_hop_inds_fssh(sim, state, parameters, **kwargs):
     """
     Updates indices of trajectories that hop according to their probabilities (but may later be frustrated) and their destination state indices.
@@ -705,38 +1058,42 @@ def update_hop_inds_fssh(sim, state, parameters, **kwargs):
     state[hop_dest_name] : ndarray
         Destination surface for each hop.
     """
-    hop_prob_name = kwargs.get("hop_prob_name", "hop_prob")
-    hop_prob_rand_vals_name = kwargs.get(
-        "hop_prob_rand_vals_name", "hop_prob_rand_vals"
-    )
-    hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
-    hop_dest_name = kwargs.get("hop_dest_name", "hop_dest")
-    if sim.algorithm.settings.fssh_deterministic:
-        num_branches = sim.model.constants.num_quantum_states
-    else:
-        num_branches = 1
-    num_trajs = sim.settings.batch_size // num_branches
-    hop_prob = state[hop_prob_name]
-    # Create a copy of hop_prob and set negative values to 0.
-    hop_prob_positive = np.copy(hop_prob)
-    hop_prob_positive[np.where(hop_prob < 0)] *= 0
-    rand = state[hop_prob_rand_vals_name][:, sim.t_ind]
-    cumulative_probs = np.cumsum(
-        np.nan_to_num(hop_prob_positive, nan=0, posinf=100e100, neginf=0, copy=False),
-        axis=1,
+    return _bind_update_hop_inds_fssh(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_z_shift_fssh(sim, **kwargs):
+    """
+    Binds ``update_z_shift_fssh`` to the keyword arguments and the ingredients of
+    the model.
+    """
+    z_traj_name = kwargs.get("z_traj_name", "z_traj")
+    resc_dir_z_traj_name = kwargs.get("resc_dir_z_traj_name", "resc_dir_z_traj")
+    eigval_diff_traj_name = kwargs.get("eigval_diff_traj_name", "eigval_diff_traj")
+    hop_successful_traj_name = kwargs.get(
+        "hop_successful_traj_name", "hop_successful_traj"
     )
-    rand_branch = (rand[:, np.newaxis] * np.ones((num_trajs, num_branches))).flatten()
-    hop_ind = np.where(
-        np.sum((cumulative_probs > rand_branch[:, np.newaxis]).astype(int), axis=1) > 0
-    )[0]
-    hop_dest = np.argmax(
-        (cumulative_probs > rand_branch[:, np.newaxis]).astype(int), axis=1
-    )[hop_ind]
-    state[hop_ind_name] = hop_ind
-    state[hop_dest_name] = hop_dest
-    return state, parameters
+    z_shift_traj_name = kwargs.get("z_shift_traj_name", "z_shift_traj")
+    model = sim.model
+    hop, has_hop = model.get("hop")
+    if not has_hop:
+        hop = functions.numerical_fssh_hop
 
+    def step(sim, state, parameters):
+        z_shift, hopped = hop(
+            model,
+            parameters,
+            z=state[z_traj_name],
+            resc_dir_z=state[resc_dir_z_traj_name],
+            eigval_diff=state[eigval_diff_traj_name],
+        )
+        state[hop_successful_traj_name] = hopped
+        state[z_shift_traj_name] = z_shift
+        return state, parameters
+
+    return step
 
+
+@functions.bind_task(_bind_update_z_shift_fssh)
 def update_z_shift_fssh(sim, state, parameters, **kwargs):
     """
     Determines if a hop occurs and calculates the shift in the classical coordinate
@@ -764,6 +1121,23 @@ def update_z_shift_fssh(sim, state, parameters, **kwargs):
     state[z_shift_traj_name] : ndarray
         Shift required to conserve energy.
     """
+    return _bind_update_z_shift_fssh(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_hop_vals_fssh(sim, **kwargs):
+    """
+    Binds ``update_hop_vals_fssh`` to the keyword arguments, the settings, and the
+    ingredients of the model.
+    """
+    z_shift_name = kwargs.get("z_shift_name", "z_shift")
+    hop_successful_name = kwargs.get("hop_successful_name", "hop_successful")
+    eigvals_name = kwargs.get("eigvals_name", "eigvals")
+    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
+    z_name = kwargs.get("z_name", "z")
+    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
+    hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
+    hop_dest_name = kwargs.get("hop_dest_name", "hop_dest")
+    dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
     z_traj_name = kwargs.get("z_traj_name", "z_traj")
     resc_dir_z_traj_name = kwargs.get("resc_dir_z_traj_name", "resc_dir_z_traj")
     eigval_diff_traj_name = kwargs.get("eigval_diff_traj_name", "eigval_diff_traj")
@@ -771,31 +1145,86 @@ def update_z_shift_fssh(sim, state, parameters, **kwargs):
         "hop_successful_traj_name", "hop_successful_traj"
     )
     z_shift_traj_name = kwargs.get("z_shift_traj_name", "z_shift_traj")
-    z = state[z_traj_name]
-    resc_dir_z = state[resc_dir_z_traj_name]
-    eigval_diff = state[eigval_diff_traj_name]
-    hop, has_hop = sim.model.get("hop")
-    if has_hop:
-        z_shift, hopped = hop(
-            sim.model,
-            parameters,
-            z=z,
-            resc_dir_z=resc_dir_z,
-            eigval_diff=eigval_diff,
-        )
-    else:
-        z_shift, hopped = functions.numerical_fssh_hop(
-            sim.model,
-            parameters,
-            z=z,
-            resc_dir_z=resc_dir_z,
-            eigval_diff=eigval_diff,
+    model = sim.model
+    num_classical_coordinates = model.constants.num_classical_coordinates
+    rescaling_direction_fssh, has_rescaling_direction_fssh = model.get(
+        "rescaling_direction_fssh"
+    )
+    update_z_shift_fssh_step = _bind_update_z_shift_fssh(sim, **kwargs)
+
+    def step(sim, state, parameters):
+        hop_ind = state[hop_ind_name]
+        hop_dest = state[hop_dest_name]
+        state[z_shift_name] = np.zeros(
+            (len(hop_ind), num_classical_coordinates), dtype=complex
         )
-    state[hop_successful_traj_name] = hopped
-    state[z_shift_traj_name] = z_shift
-    return state, parameters
+        state[hop_successful_name] = np.zeros(len(hop_ind), dtype=bool)
+        eigvals = state[eigvals_name]
+        eigvecs = state[eigvecs_name]
+        z = state[z_name]
+        act_surf_ind = state[act_surf_ind_name]
+        state_hop_successful = state[hop_successful_name]
+        state_z_shift = state[z_shift_name]
+        hop_traj_ind = 0
+        for traj_ind in hop_ind:
+            final_state_ind = hop_dest[hop_traj_ind]
+            init_state_ind = act_surf_ind[traj_ind]
+            eigval_init_state = eigvals[traj_ind][init_state_ind]
+            eigval_final_state = eigvals[traj_ind][final_state_ind]
+            eigval_diff = eigval_final_state - eigval_init_state
+            eigvec_init_state = eigvecs[traj_ind, :, init_state_ind]
+            eigvec_final_state = eigvecs[traj_ind, :, final_state_ind]
+            if has_rescaling_direction_fssh:
+                resc_dir_z = rescaling_direction_fssh(
+                    model,
+                    parameters,
+                    z=z[traj_ind],
+                    init_state_ind=init_state_ind,
+                    final_state_ind=final_state_ind,
+                )
+            elif isinstance(
+                state[dh_qc_dzc_name], functions.BatchInvariantSparseGradient
+            ):
+                # The gradient is the same in every trajectory.
+                resc_dir_z = functions.calc_resc_dir_z_fssh(
+                    sim,
+                    eigval_diff,
+                    eigvec_init_state,
+                    eigvec_final_state,
+                    state[dh_qc_dzc_name],
+                )
+            else:
+                inds, mels, shape = state[dh_qc_dzc_name]
+                dh_qc_dzc_traj_ind = inds[0] == traj_ind
+                inds_traj = (
+                    inds[0][dh_qc_dzc_traj_ind],
+                    inds[1][dh_qc_dzc_traj_ind],
+                    inds[2][dh_qc_dzc_traj_ind],
+                    inds[3][dh_qc_dzc_traj_ind],
+                )
+                mels_traj = mels[dh_qc_dzc_traj_ind]
+                shape_traj = (1, shape[1], shape[2], shape[3])
+                dh_qc_dzc_traj = (inds_traj, mels_traj, shape_traj)
+                resc_dir_z = functions.calc_resc_dir_z_fssh(
+                    sim,
+                    eigval_diff,
+                    eigvec_init_state,
+                    eigvec_final_state,
+                    dh_qc_dzc_traj,
+                )
+            state[z_traj_name] = z[traj_ind]
+            state[resc_dir_z_traj_name] = resc_dir_z
+            state[eigval_diff_traj_name] = eigval_diff
+            state, parameters = update_z_shift_fssh_step(sim, state, parameters)
+            state_hop_successful[hop_traj_ind] = state[hop_successful_traj_name]
+            state_z_shift[hop_traj_ind] = state[z_shift_traj_name]
+            hop_traj_ind += 1
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_update_hop_vals_fssh)
 def update_hop_vals_fssh(sim, state, parameters, **kwargs):
     """
     Updates trajectory hopping information for FSSH.
@@ -848,79 +1277,27 @@ def update_hop_vals_fssh(sim, state, parameters, **kwargs):
     state[hop_successful_name] : ndarray
         Flags indicating if each hop was successful.
     """
+    return _bind_update_hop_vals_fssh(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_z_hop(sim, **kwargs):
+    """
+    Binds ``update_z_hop`` to the keyword arguments.
+    """
     z_shift_name = kwargs.get("z_shift_name", "z_shift")
-    hop_successful_name = kwargs.get("hop_successful_name", "hop_successful")
-    eigvals_name = kwargs.get("eigvals_name", "eigvals")
-    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
-    z_name = kwargs.get("z_name", "z")
-    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
     hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
-    hop_dest_name = kwargs.get("hop_dest_name", "hop_dest")
-    dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
-    z_traj_name = kwargs.get("z_traj_name", "z_traj")
-    resc_dir_z_traj_name = kwargs.get("resc_dir_z_traj_name", "resc_dir_z_traj")
-    eigval_diff_traj_name = kwargs.get("eigval_diff_traj_name", "eigval_diff_traj")
-    hop_successful_traj_name = kwargs.get(
-        "hop_successful_traj_name", "hop_successful_traj"
-    )
-    z_shift_traj_name = kwargs.get("z_shift_traj_name", "z_shift_traj")
-    hop_ind = state[hop_ind_name]
-    hop_dest = state[hop_dest_name]
-    state[z_shift_name] = np.zeros(
-        (len(hop_ind), sim.model.constants.num_classical_coordinates), dtype=complex
-    )
-    state[hop_successful_name] = np.zeros(len(hop_ind), dtype=bool)
-    eigvals = state[eigvals_name]
-    eigvecs = state[eigvecs_name]
-    z = state[z_name]
-    act_surf_ind = state[act_surf_ind_name]
-    state_hop_successful = state[hop_successful_name]
-    state_z_shift = state[z_shift_name]
-    hop_traj_ind = 0
-    for traj_ind in hop_ind:
-        final_state_ind = hop_dest[hop_traj_ind]
-        init_state_ind = act_surf_ind[traj_ind]
-        eigval_init_state = eigvals[traj_ind][init_state_ind]
-        eigval_final_state = eigvals[traj_ind][final_state_ind]
-        eigval_diff = eigval_final_state - eigval_init_state
-        eigvec_init_state = eigvecs[traj_ind, :, init_state_ind]
-        eigvec_final_state = eigvecs[traj_ind, :, final_state_ind]
-        rescaling_direction_fssh, has_rescaling_direction_fssh = sim.model.get(
-            "rescaling_direction_fssh"
-        )
-        if has_rescaling_direction_fssh:
-            resc_dir_z = rescaling_direction_fssh(
-                sim.model,
-                parameters,
-                z=z[traj_ind],
-                init_state_ind=init_state_ind,
-                final_state_ind=final_state_ind,
-            )
-        else:
-            inds, mels, shape = state[dh_qc_dzc_name]
-            dh_qc_dzc_traj_ind = inds[0] == traj_ind
-            inds_traj = (
-                inds[0][dh_qc_dzc_traj_ind],
-                inds[1][dh_qc_dzc_traj_ind],
-                inds[2][dh_qc_dzc_traj_ind],
-                inds[3][dh_qc_dzc_traj_ind],
-            )
-            mels_traj = mels[dh_qc_dzc_traj_ind]
-            shape_traj = (1, shape[1], shape[2], shape[3])
-            dh_qc_dzc_traj = (inds_traj, mels_traj, shape_traj)
-            resc_dir_z = functions.calc_resc_dir_z_fssh(
-                sim, eigval_diff, eigvec_init_state, eigvec_final_state, dh_qc_dzc_traj
-            )
-        state[z_traj_name] = z[traj_ind]
-        state[resc_dir_z_traj_name] = resc_dir_z
-        state[eigval_diff_traj_name] = eigval_diff
-        state, parameters = update_z_shift_fssh(sim, state, parameters, **kwargs)
-        state_hop_successful[hop_traj_ind] = state[hop_successful_traj_name]
-        state_z_shift[hop_traj_ind] = state[z_shift_traj_name]
-        hop_traj_ind += 1
-    return state, parameters
+    z_name = kwargs.get("z_name", "z")
+
+    def step(sim, state, parameters):
+        z = state[z_name]
+        z[state[hop_ind_name]] += state[z_shift_name]
+        state[z_name] = z
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_update_z_hop)
 def update_z_hop(sim, state, parameters, **kwargs):
     """
     Updates the classical coordinates in trajectories that have hopped.
@@ -940,17 +1317,38 @@ def update_z_hop(sim, state, parameters, **kwargs):
     state[z_name] : ndarray
         Classical coordinates.
     """
-    z_shift_name = kwargs.get("z_shift_name", "z_shift")
-    hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
-    z_name = kwargs.get("z_name", "z")
-    z = state[z_name]
-    hop_ind = state[hop_ind_name]
-    z_shift = state[z_shift_name]
-    z[hop_ind] += z_shift
-    state[z_name] = z
-    return state, parameters
+    return _bind_update_z_hop(sim, **kwargs)(sim, state, parameters)
+
 
+def _bind_update_act_surf_hop(sim, **kwargs):
+    """
+    Binds ``update_act_surf_hop`` to the keyword arguments.
+    """
+    hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
+    hop_dest_name = kwargs.get("hop_dest_name", "hop_dest")
+    hop_successful_name = kwargs.get("hop_successful_name", "hop_successful")
+    act_surf_name = kwargs.get("act_surf_name", "act_surf")
+    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
 
+    def step(sim, state, parameters):
+        hop_successful = state[hop_successful_name]
+        act_surf = state[act_surf_name]
+        # Get the index of the trajectories that successfully hopped.
+        hop_successful_traj_ind = state[hop_ind_name][hop_successful]
+        # Get their destination states.
+        hop_dest_ind = state[hop_dest_name][hop_successful]
+        # Zero out the active surface in the ones that hopped.
+        act_surf[hop_successful_traj_ind] = 0
+        # Set the new active surface to 1.
+        act_surf[hop_successful_traj_ind, hop_dest_ind] = 1
+        # Update the active surface index.
+        state[act_surf_ind_name][hop_successful_traj_ind] = hop_dest_ind
+        return state, parameters
+
+    return step
+
+
+@functions.bind_task(_bind_update_act_surf_hop)
 def update_act_surf_hop(sim, state, parameters, **kwargs):
     """
     Updates the active surface, active surface index, and active surface wavefunction
@@ -977,29 +1375,44 @@ def update_act_surf_hop(sim, state, parameters, **kwargs):
     state[act_surf_name] : ndarray
         Active surface wavefunctions.
     """
-    hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
-    hop_dest_name = kwargs.get("hop_dest_name", "hop_dest")
-    hop_successful_name = kwargs.get("hop_successful_name", "hop_successful")
-    act_surf_name = kwargs.get("act_surf_name", "act_surf")
-    act_surf_ind_name = kwargs.get("act_surf_ind_name", "act_surf_ind")
-    hop_successful = state[hop_successful_name]
-    hop_ind = state[hop_ind_name]
-    hop_dest = state[hop_dest_name]
-    act_surf = state[act_surf_name]
-    act_surf_ind = state[act_surf_ind_name]
-    # Get the index of the trajectories that successfully hopped.
-    hop_successful_traj_ind = hop_ind[hop_successful]
-    # Get their destination states.
-    hop_dest_ind = hop_dest[hop_successful]
-    # Zero out the active surface in the ones that hopped.
-    act_surf[hop_successful_traj_ind] = 0
-    # Set the new active surface to 1.
-    act_surf[hop_successful_traj_ind, hop_dest_ind] = 1
-    # Update the active surface index.
-    act_surf_ind[hop_successful_traj_ind] = hop_dest_ind
-    return state, parameters
+    return _bind_update_act_surf_hop(sim, **kwargs)(sim, state, parameters)
 
 
+def _bind_update_h_q_tot(sim, **kwargs):
+    """
+    Binds ``update_h_q_tot`` to the keyword arguments, the settings, and the
+    ingredients of the model.
+    """
+    z_name = kwargs.get("z_name", "z")
+    h_q_name = kwargs.get("h_q_name", "h_q")
+    h_qc_name = kwargs.get("h_qc_name", "h_qc")
+    h_q_tot_name = kwargs.get("h_q_tot_name", "h_q_tot")
+    model = sim.model
+    h_q, _ = model.get("h_q")
+    h_qc, _ = model.get("h_qc")
+    update_h_q = model.update_h_q
+    batch_size = sim.settings.batch_size
+
+    def step(sim, state, parameters):
+        if update_h_q or not (h_q_name in state):
+            # Update the quantum Hamiltonian if required or if it is not set.
+            state[h_q_name] = h_q(model, parameters, batch_size=batch_size)
+        # Update the quantum-classical Hamiltonian.
+        state[h_qc_name] = h_qc(model, parameters, z=state[z_name])
+        # Update the total Hamiltonian of the quantum subsystem in place.
+        h_q_tot = functions.state_buffer(
+            state,
+            h_q_tot_name,
+            np.broadcast(state[h_q_name], state[h_qc_name]).shape,
+            np.result_type(state[h_q_name], state[h_qc_name]),
+        )
+        np.add(state[h_q_name], state[h_qc_name], out=h_q_tot)
+        return state, parameters
+
+    return step
+
+
+@functions.bind_task(_bind_update_h_q_tot)
 def update_h_q_tot(sim, state, parameters, **kwargs):
     """
     Updates the Hamiltonian matrix of the quantum subsystem.
@@ -1026,23 +1439,45 @@ def update_h_q_tot(sim, state, parameters, **kwargs):
     state[h_q_tot_name] : ndarray
         Total Hamiltonian of the quantum subsystem.
     """
+    return _bind_update_h_q_tot(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_z_rk4_k123(sim, **kwargs):
+    """
+    Binds ``update_z_rk4_k123`` to the keyword arguments and the settings.
+    """
     z_name = kwargs.get("z_name", "z")
-    h_q_name = kwargs.get("h_q_name", "h_q")
-    h_qc_name = kwargs.get("h_qc_name", "h_qc")
-    h_q_tot_name = kwargs.get("h_q_tot_name", "h_q_tot")
-    z = state[z_name]
-    h_q, _ = sim.model.get("h_q")
-    h_qc, _ = sim.model.get("h_qc")
-    if sim.model.update_h_q or not (h_q_name in state):
-        # Update the quantum Hamiltonian if required or if it is not set.
-        state[h_q_name] = h_q(sim.model, parameters, batch_size=sim.settings.batch_size)
-    # Update the quantum-classical Hamiltonian.
-    state[h_qc_name] = h_qc(sim.model, parameters, z=z)
-    # Update the total Hamiltonian of the quantum subsystem.
-    state[h_q_tot_name] = state[h_q_name] + state[h_qc_name]
-    return state, parameters
+    z_k_name = kwargs.get("z_k_name", "z_1")
+    k_name = kwargs.get("k_name", "z_rk4_k1")
+    dt_factor = kwargs.get("dt_factor", 0.5)
+    if sim.settings.debug:
+        if dt_factor not in [0.5, 1.0]:
+            logger.warning(
+                "Unusual dt_factor %s passed to update_z_rk4_k123_sum. Typical values are 0.5 or 1.0.",
+                dt_factor,
+            )
+    classical_force_name = kwargs.get("classical_force_name", "classical_force")
+    quantum_classical_force_name = kwargs.get(
+        "quantum_classical_force_name", "quantum_classical_force"
+    )
+    dt = dt_factor * sim.settings.dt_update
+
+    def step(sim, state, parameters):
+        z = state[z_name]
+        functions.update_z_rk4_k123_sum(
+            z,
+            state[classical_force_name],
+            state[quantum_classical_force_name],
+            dt,
+            out=functions.state_buffer(state, z_k_name, np.shape(z)),
+            k=functions.state_buffer(state, k_name, np.shape(z)),
+        )
+        return state, parameters
+
+    return step
 
 
+@functions.bind_task(_bind_update_z_rk4_k123)
 def update_z_rk4_k123(sim, state, parameters, **kwargs):
     """
     Computes the first three RK4 intermediates for evolving the classical coordinates.
@@ -1071,32 +1506,39 @@ def update_z_rk4_k123(sim, state, parameters, **kwargs):
     state[k_name] : ndarray
         First RK4 slope.
     """
+    return _bind_update_z_rk4_k123(sim, **kwargs)(sim, state, parameters)
+
+
+def _bind_update_z_rk4_k4(sim, **kwargs):
+    """
+    Binds ``update_z_rk4_k4`` to the keyword arguments and the settings.
+    """
     z_name = kwargs.get("z_name", "z")
-    z_k_name = kwargs.get("z_k_name", "z_1")
-    k_name = kwargs.get("k_name", "z_rk4_k1")
-    dt_factor = kwargs.get("dt_factor", 0.5)
-    if sim.settings.debug:
-        if dt_factor not in [0.5, 1.0]:
-            logger.warning(
-                "Unusual dt_factor %s passed to update_z_rk4_k123_sum. Typical values are 0.5 or 1.0.",
-                dt_factor,
-            )
+    k1_name = kwargs.get("k1_name", "z_rk4_k1")
+    k2_name = kwargs.get("k2_name", "z_rk4_k2")
+    k3_name = kwargs.get("k3_name", "z_rk4_k3")
     classical_force_name = kwargs.get("classical_force_name", "classical_force")
     quantum_classical_force_name = kwargs.get(
         "quantum_classical_force_name", "quantum_classical_force"
     )
-    classical_force = state[classical_force_name]
-    quantum_classical_force = state[quantum_classical_force_name]
     dt_update = sim.settings.dt_update
-    z = state[z_name]
-    z_k, k = functions.update_z_rk4_k123_sum(
-        z, classical_force, quantum_classical_force, dt_factor * dt_update
-    )
-    state[z_k_name] = z_k
-    state[k_name] = k
-    return state, parameters
 
+    def step(sim, state, parameters):
+        state[z_name] = functions.update_z_rk4_k4_sum(
+            state[z_name],
+            state[k1_name],
+            state[k2_name],
+            state[k3_name],
+            state[classical_force_name],
+            state[quantum_classical_force_name],
+            dt_update,
+        )
+        return state, parameters
 
+    return step
+
+
+@functions.bind_task(_bind_update_z_rk4_k4)
 def update_z_rk4_k4(sim, state, parameters, **kwargs):
     """
     Computes the final RK4 update for evolving the classical coordinates.
@@ -1122,31 +1564,7 @@ def update_z_rk4_k4(sim, state, parameters, **kwargs):
     state[z_name] : ndarray
         Updated classical coordinates.
     """
-    z_name = kwargs.get("z_name", "z")
-    k1_name = kwargs.get("k1_name", "z_rk4_k1")
-    k2_name = kwargs.get("k2_name", "z_rk4_k2")
-    k3_name = kwargs.get("k3_name", "z_rk4_k3")
-    k1 = state[k1_name]
-    k2 = state[k2_name]
-    k3 = state[k3_name]
-    classical_force_name = kwargs.get("classical_force_name", "classical_force")
-    quantum_classical_force_name = kwargs.get(
-        "quantum_classical_force_name", "quantum_classical_force"
-    )
-    classical_force = state[classical_force_name]
-    quantum_classical_force = state[quantum_classical_force_name]
-    z = state[z_name]
-    out = functions.update_z_rk4_k4_sum(
-        z,
-        k1,
-        k2,
-        k3,
-        classical_force,
-        quantum_classical_force,
-        sim.settings.dt_update,
-    )
-    state[z_name] = out
-    return state, parameters
+    return _bind_update_z_rk4_k4(sim, **kwargs)(sim, state, parameters)
 
 
 def update_dm_db_wf(sim, state, parameters, **kwargs):
@@ -1169,9 +1587,11 @@ def update_dm_db_wf(sim, state, parameters, **kwargs):
     wf_db_name = kwargs.get("wf_db_name", "wf_db")
     dm_db_name = kwargs.get("dm_db_name", "dm_db")
     wf_db = state[wf_db_name]
-    state[dm_db_name] = np.einsum(
-        "ti,tj->tij", wf_db, np.conj(wf_db), optimize="greedy"
+    batch_size, num_quantum_states = np.shape(wf_db)
+    dm_db = functions.state_buffer(
+        state, dm_db_name, (batch_size, num_quantum_states, num_quantum_states)
     )
+    np.multiply(wf_db[:, :, np.newaxis], np.conj(wf_db)[:, np.newaxis, :], out=dm_db)
     return state, parameters
 
 
@@ -1388,12 +1808,8 @@ def update_dm_db_fssh(sim, state, parameters, **kwargs):
     dm_adb_0 = state[dm_adb_0_name]
     act_surf = state[act_surf_name]
     eigvecs = state[eigvecs_name]
-    dm_adb = np.einsum(
-        "ti,tj->tij",
-        wf_adb,
-        np.conj(wf_adb),
-        optimize="greedy",
-    )
+    dm_adb = functions.state_buffer(state, dm_adb_name, np.shape(eigvecs))
+    np.multiply(wf_adb[:, :, np.newaxis], np.conj(wf_adb)[:, np.newaxis, :], out=dm_adb)
     if sim.algorithm.settings.fssh_deterministic:
         num_branches = sim.model.constants.num_quantum_states
     else:
@@ -1404,16 +1820,20 @@ def update_dm_db_fssh(sim, state, parameters, **kwargs):
         np.einsum("jj->j", dm_adb[nt])[...] = act_surf[nt]
     if sim.algorithm.settings.fssh_deterministic:
         # This reweighting by num_branches simplifies the subsequent averaging.
-        dm_adb = num_branches * (
-            np.einsum(
+        dm_adb *= (
+            num_branches
+            * np.einsum(
                 "tbbb->tb",
                 dm_adb_0.reshape(
                     (batch_size, num_branches, num_quantum_states, num_quantum_states)
                 ),
             ).flatten()[:, np.newaxis, np.newaxis]
-            * dm_adb
         )
-    dm_db = functions.transform_mat(dm_adb, eigvecs, adb_to_db=True)
-    state[dm_adb_name] = dm_adb
-    state[dm_db_name] = dm_db
+    # Transform to the diabatic basis, V dm_adb V^dagger.
+    dm_adb_eigvecs_conj = functions.state_buffer(
+        state, "_" + dm_db_name + "_work", np.shape(eigvecs)
+    )
+    np.matmul(dm_adb, np.swapaxes(np.conj(eigvecs), -1, -2), out=dm_adb_eigvecs_conj)
+    dm_db = functions.state_buffer(state, dm_db_name, np.shape(eigvecs))
+    np.matmul(eigvecs, dm_adb_eigvecs_conj, out=dm_db)
     return state, parameters
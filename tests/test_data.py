@@ -152,7 +152,54 @@ def test_load_sum():
     os.remove("test_data.h5")
 
 
+def test_save_load_failed_seeds():
+    import numpy as np
+    from qclab import Simulation, Data
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import serial_driver
+    from qclab.utils import DISABLE_H5PY
+    import os
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 40
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 1
+    sim.settings.dt_update = 0.01
+    sim.settings.batch_retries = 0
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+
+    def fail(sim, state, parameters):
+        # Make the batch with seed 10 fail.
+        if state["seed"][0] == 10:
+            raise ValueError("Batch failed.")
+        return state, parameters
+
+    sim.algorithm.update_recipe.append(fail)
+    data_serial = serial_driver(sim)
+    assert np.all(data_serial.failed_seeds == np.arange(10, 20))
+    for filename, disable_h5py in [
+        ("test_data.h5", DISABLE_H5PY),
+        ("test_data.npz", True),
+    ]:
+        data_serial.save(filename, disable_h5py=disable_h5py)
+        loaded_data = Data().load(filename, disable_h5py=disable_h5py)
+        assert np.all(loaded_data.failed_seeds == data_serial.failed_seeds)
+        assert loaded_data.worker_times == data_serial.worker_times
+        assert "failed_seeds" not in loaded_data.data_dict
+        os.remove(filename)
+    return
+
+
 if __name__ == "__main__":
     test_save_load_h5py()
     test_save_load_no_h5py()
     test_load_sum()
+    test_save_load_failed_seeds()
@@ -2,6 +2,7 @@
 This module tests the serial and multiprocessing drivers for a few simple cases.
 """
 
+import os
 import pytest
 
 
@@ -117,6 +118,134 @@ def test_drivers_spinboson_mpi():
     return
 
 
+@pytest.mark.mpi
+def test_mpi_idle_ranks():
+    """
+    This test checks that the MPI driver gives the same results as the serial
+    driver when some ranks have no batches to run.
+
+    This test requires MPI to be set up and run with a command like:
+    mpirun -n 4 pytest -m mpi -s tests/test_drivers.py
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+
+    pytest.importorskip("mpi4py")
+    from mpi4py import MPI  # import MPI for parallel processing
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_mpi,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 30
+    sim.settings.batch_size = 20
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+
+    data_parallel_mpi = parallel_driver_mpi(sim)
+    rank = MPI.COMM_WORLD.Get_rank()
+    if rank == 0:
+        sim.settings.batch_size = 20
+        data_serial = serial_driver(sim)
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_parallel_mpi.data_dict[key])
+        assert (
+            data_serial.data_dict["norm_factor"]
+            == data_parallel_mpi.data_dict["norm_factor"]
+        )
+    return
+
+
+@pytest.mark.mpi
+def test_mpi_dynamic():
+    """
+    This test checks that the dynamic mode of the MPI driver gives the same
+    results as the serial driver.
+
+    This test requires MPI to be set up and run with a command like:
+    mpirun -n 4 pytest -m mpi -s tests/test_drivers.py
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+
+    pytest.importorskip("mpi4py")
+    from mpi4py import MPI  # import MPI for parallel processing
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_mpi,
+        convergence_driver,
+        executor_driver,
+        MPIExecutor,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 110
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+
+    data_parallel_mpi = parallel_driver_mpi(sim, dynamic=True)
+    # The window holding the batch counter is released when the executor stops.
+    executor = MPIExecutor(dynamic=True)
+    progress_list = []
+    data_executor = executor_driver(
+        sim, executor, progress_callback=progress_list.append
+    )
+    assert executor._win is None
+    # The progress counts the trajectories finished by all ranks.
+    assert all(progress["num_trajs"] == 110 for progress in progress_list)
+    num_trajs_done = [progress["num_trajs_done"] for progress in progress_list]
+    assert max(MPI.COMM_WORLD.allgather(max(num_trajs_done, default=0))) == 110
+    rank = MPI.COMM_WORLD.Get_rank()
+    if rank == 0:
+        sim.settings.batch_size = 10
+        data_serial = serial_driver(sim)
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_parallel_mpi.data_dict[key])
+                assert np.allclose(val, data_executor.data_dict[key])
+        # The batch statistics are combined across ranks as well.
+        assert np.allclose(
+            data_serial.standard_error("classical_energy"),
+            data_parallel_mpi.standard_error("classical_energy"),
+        )
+    # The automatic batch size is selected on rank 0 and used by every rank.
+    sim.settings.batch_size = "auto"
+    data_auto = parallel_driver_mpi(sim, dynamic=True)
+    assert len(set(MPI.COMM_WORLD.allgather(sim.settings.batch_size))) == 1
+    if rank == 0:
+        assert data_auto.batch_size == sim.settings.batch_size
+        assert np.all(np.sort(data_auto.data_dict["seed"]) == np.arange(110))
+    # Each rank would decide on its own when the outputs have converged.
+    with pytest.raises(ValueError):
+        convergence_driver(sim, {"classical_energy": 1e-3}, executor=MPIExecutor())
+    return
+
+
 def test_incommensurate_batch_size_serial():
     """
     This test checks that the drivers work correctly when the number of trajectories
@@ -217,7 +346,856 @@ def test_incommensurate_batch_size_multiprocessing():
     return
 
 
+def test_multiprocessing_chunk_size():
+    """
+    This test checks that the dynamic scheduling of the multiprocessing driver
+    gives the same results as the serial driver for different chunk sizes.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 100
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    print("Running serial driver...")
+    data_serial = serial_driver(sim)
+    for chunk_size in [1, 3]:
+        sim.settings.batch_size = 10
+        print(f"Running parallel driver with chunk_size={chunk_size}...")
+        data_parallel = parallel_driver_multiprocessing(
+            sim, num_tasks=2, chunk_size=chunk_size
+        )
+        print("Comparing results...")
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_parallel.data_dict[key])
+    print("results match!")
+    return
+
+
+def test_multiprocessing_worker_pool():
+    """
+    This test checks that a WorkerPool can be shared between calls of the
+    multiprocessing driver and gives the same results as the serial driver.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+        WorkerPool,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 100
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    print("Running serial driver...")
+    data_serial = serial_driver(sim)
+    with WorkerPool(num_tasks=2) as pool:
+        pids = set(p.pid for p in pool._pool._pool)
+        for _ in range(2):
+            sim.settings.batch_size = 10
+            print("Running parallel driver with a shared worker pool...")
+            data_parallel = parallel_driver_multiprocessing(sim, pool=pool)
+            print("Comparing results...")
+            for key, val in data_serial.data_dict.items():
+                if isinstance(val, np.ndarray):
+                    assert np.allclose(val, data_parallel.data_dict[key])
+        # The same worker processes are used for both calls.
+        assert set(p.pid for p in pool._pool._pool) == pids
+    print("results match!")
+    return
+
+
+def test_worker_pool_replaced_worker():
+    """
+    This test checks that a worker process that replaces a failed one loads
+    the simulations installed in the pool.
+    """
+    import os
+    import time
+    import numpy as np
+    from qclab import Simulation
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import WorkerPool
+    from qclab.dynamics import worker_pool
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 10
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 1
+    sim.settings.dt_update = 0.01
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.array([1.0, 0.0], dtype=complex)
+    sim.initialize_timesteps()
+    pool = WorkerPool(num_tasks=2)
+    try:
+        token = pool.add_simulation(sim)
+        pids = [p.pid for p in pool._pool._pool]
+        # Make one worker process exit while it runs a task, so that it does not
+        # hold the lock of the task queue, and wait until it is replaced.
+        pool._pool.apply_async(os._exit, (1,))
+        while set(pids) <= set(p.pid for p in pool._pool._pool):
+            time.sleep(0.1)
+        while len(pool._pool._pool) < 2:
+            time.sleep(0.1)
+        # Each worker process, including the replacement, runs the same batch.
+        results = pool.broadcast(worker_pool._run_batches, token, [(0, np.arange(10))])
+        pool.remove_simulation(token)
+    finally:
+        # The task of the worker process that exited never finishes, so the
+        # pool cannot be closed normally.
+        pool.terminate()
+    energies = [data.data_dict["classical_energy"] for _, data, _ in results]
+    assert np.allclose(energies[0], energies[1])
+    return
+
+
+def _fail_batch(sim, state, parameters):
+    """
+    Task that makes every batch fail, used in the worker processes.
+    """
+    if sim.t_ind == 10:
+        raise ValueError("Batch failed.")
+    return state, parameters
+
+
+def _num_worker_simulations():
+    """
+    Returns the number of simulations cached in a worker process.
+    """
+    from qclab.dynamics import worker_pool
+
+    return len(worker_pool._worker_sims)
+
+
+def test_worker_pool_failed_run():
+    """
+    This test checks that a failed run on a shared WorkerPool removes its
+    simulation from the pool and its worker processes.
+    """
+    import numpy as np
+    import pytest
+    from qclab import Simulation
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import parallel_driver_multiprocessing, WorkerPool
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 40
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 1
+    sim.settings.dt_update = 0.01
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.array([1.0, 0.0], dtype=complex)
+    sim.algorithm.update_recipe.append(_fail_batch)
+    with WorkerPool(num_tasks=2) as pool:
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                parallel_driver_multiprocessing(sim, pool=pool)
+            assert pool._payloads == {}
+        # Broadcasts run after the batches of the failed runs, so every worker
+        # process has removed the simulations by now.
+        assert pool.broadcast(_num_worker_simulations) == [0, 0]
+    return
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "sched_getaffinity"),
+    reason="Pinning to CPU cores is not supported on this platform.",
+)
+def test_thread_budget():
+    """
+    This test checks that the worker processes are limited to the requested
+    number of threads and pinned to CPU cores, and that the multiprocessing
+    driver gives the same results as the serial driver with a thread budget.
+    """
+    import os
+    import numba
+    import numpy as np
+    import threadpoolctl
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+        WorkerPool,
+    )  # import dynamics driver
+    from qclab.dynamics.thread_budget import available_cpus
+
+    cpus = available_cpus()
+    with WorkerPool(num_tasks=2) as pool:
+        pool.set_thread_budget(threads_per_task=1, pin_cpus=True)
+        affinities = pool.broadcast(os.sched_getaffinity, 0)
+        assert sorted(len(affinity) for affinity in affinities) == [1, 1]
+        if len(cpus) > 1:
+            assert affinities[0] != affinities[1]
+        assert pool.broadcast(numba.get_num_threads) == [1, 1]
+        for info in pool.broadcast(threadpoolctl.threadpool_info):
+            assert all(lib["num_threads"] == 1 for lib in info)
+        # The cores of the pool are kept when the budget is set again.
+        pool.set_thread_budget(threads_per_task=len(cpus))
+        assert pool.broadcast(os.sched_getaffinity, 0) == [set(cpus)] * 2
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 20
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_serial = serial_driver(sim)
+    sim.settings.pin_cpus = True
+    data_parallel = parallel_driver_multiprocessing(sim, num_tasks=2)
+    for key, val in data_serial.data_dict.items():
+        if isinstance(val, np.ndarray):
+            assert np.allclose(val, data_parallel.data_dict[key])
+    return
+
+
+def test_multiprocessing_shared_memory():
+    """
+    This test checks that returning the output data through shared memory
+    gives the same results as the serial driver.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import HolsteinLattice  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 40
+    sim.settings.batch_size = 4
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = HolsteinLattice()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_serial = serial_driver(sim)
+    data_parallel = parallel_driver_multiprocessing(
+        sim, num_tasks=2, shared_memory=True
+    )
+    # Only the first chunks are returned through the pipe of the pool.
+    assert "shared memory block" in data_parallel.log
+    for key, val in data_serial.data_dict.items():
+        assert np.allclose(val, data_parallel.data_dict[key])
+    assert np.allclose(
+        data_serial.standard_error("dm_db"), data_parallel.standard_error("dm_db")
+    )
+    return
+
+
+def test_threads():
+    """
+    This test checks that the thread driver gives the same results as the
+    serial driver for mean-field and surface hopping dynamics.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField, FewestSwitchesSurfaceHopping
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_threads,
+    )  # import dynamics driver
+
+    for algorithm in [MeanField, FewestSwitchesSurfaceHopping]:
+        sim = Simulation()
+        sim.settings.progress_bar = False
+        sim.settings.num_trajs = 100
+        sim.settings.batch_size = 10
+        sim.settings.tmax = 5
+        sim.settings.dt_update = 0.01
+
+        sim.model = SpinBoson()
+        sim.algorithm = algorithm()
+        sim.model.initialize_constants()
+        sim.initial_state["wf_db"] = np.zeros(
+            (sim.model.constants.num_quantum_states), dtype=complex
+        )
+        sim.initial_state["wf_db"][0] += 1.0
+        print("Running serial driver...")
+        data_serial = serial_driver(sim)
+        sim.settings.batch_size = 10
+        print("Running thread driver...")
+        data_threads = parallel_driver_threads(sim, num_tasks=4)
+        # The settings of the caller are not changed by the worker threads.
+        assert sim.settings.batch_size == 10
+        print("Comparing results...")
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_threads.data_dict[key])
+    print("results match!")
+    return
+
+
+def test_custom_executor():
+    """
+    This test checks that a custom executor plugged into the executor driver
+    gives the same results as the serial driver.
+    """
+    import concurrent.futures
+    import numpy as np
+    from qclab import Simulation, Data  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        executor_driver,
+        run_dynamics,
+        Executor,
+    )  # import dynamics driver
+
+    class ReversedExecutor(Executor):
+        """
+        Runs the batches in reverse order when they are submitted.
+        """
+
+        chunk_size = 2
+
+        def __init__(self):
+            self.submitted = []
+
+        def batch_inds(self, num_batches):
+            return iter(range(num_batches - 1, -1, -1))
+
+        def submit(self, batch_seeds_chunk):
+            future = concurrent.futures.Future()
+            data = Data()
+            for n, batch_seeds in batch_seeds_chunk:
+                self.submitted.append(n)
+                self.sim.settings.batch_size = len(batch_seeds)
+                data.add_data(
+                    run_dynamics(self.sim, {"seed": batch_seeds}, {}, Data(batch_seeds))
+                )
+            future.set_result(data)
+            return future
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 45
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_serial = serial_driver(sim)
+    executor = ReversedExecutor()
+    data_custom = executor_driver(sim, executor)
+    assert executor.submitted == [4, 3, 2, 1, 0]
+    for key, val in data_serial.data_dict.items():
+        if isinstance(val, np.ndarray):
+            assert np.allclose(val, data_custom.data_dict[key])
+    return
+
+
+def test_run_async():
+    """
+    This test checks that the asyncio driver gives the same results as the
+    serial driver and that it can be cancelled between batches.
+    """
+    import asyncio
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        run_async,
+        ThreadExecutor,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 50
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_serial = serial_driver(sim)
+
+    async def run_to_completion():
+        progress = []
+        async for num_batches_done, num_batches, data in run_async(
+            sim, ThreadExecutor(num_tasks=2)
+        ):
+            progress.append((num_batches_done, num_batches))
+        return progress, data
+
+    progress, data_async = asyncio.run(run_to_completion())
+    assert progress[-1] == (5, 5)
+    assert [p[0] for p in progress] == sorted(p[0] for p in progress)
+    for key, val in data_serial.data_dict.items():
+        if isinstance(val, np.ndarray):
+            assert np.allclose(val, data_async.data_dict[key])
+
+    async def run_and_cancel():
+        run = run_async(sim, ThreadExecutor(num_tasks=1))
+        num_batches_done, num_batches, _ = await run.__anext__()
+        await run.aclose()
+        return num_batches_done, num_batches
+
+    num_batches_done, num_batches = asyncio.run(run_and_cancel())
+    assert num_batches_done < num_batches
+    return
+
+
+def test_checkpoint_resume():
+    """
+    This test checks that a simulation interrupted part way through continues
+    from its last checkpoint and gives the same results as an uninterrupted
+    simulation.
+    """
+    import os
+    import tempfile
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import FewestSwitchesSurfaceHopping  # import algorithm class
+    from qclab.dynamics import serial_driver  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 20
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = FewestSwitchesSurfaceHopping()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_reference = serial_driver(sim)
+
+    t_inds = []
+    interrupted = []
+
+    def interrupt(sim, state, parameters):
+        # Record the time steps that are run and stop the first batch part way.
+        t_inds.append(sim.t_ind)
+        if sim.t_ind == 255 and not interrupted:
+            interrupted.append(sim.t_ind)
+            raise KeyboardInterrupt
+        return state, parameters
+
+    sim.algorithm.update_recipe.append(interrupt)
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        sim.settings.checkpoint_dir = checkpoint_dir
+        sim.settings.checkpoint_interval = 2
+        try:
+            serial_driver(sim)
+        except KeyboardInterrupt:
+            pass
+        assert len(os.listdir(checkpoint_dir)) == 1
+        t_inds.clear()
+        data_resumed = serial_driver(sim)
+        # The first batch continues after the last checkpoint at t_ind = 240.
+        assert t_inds[0] == 241
+        assert len(os.listdir(checkpoint_dir)) == 2
+        # Both batches are complete, so running again only loads the results.
+        t_inds.clear()
+        data_loaded = serial_driver(sim)
+        assert len(t_inds) == 0
+        # The batch statistics of the finished batches are loaded unchanged.
+        assert (
+            data_loaded.batch_stats["norm_factor_sq"]
+            == data_resumed.batch_stats["norm_factor_sq"]
+        )
+        for key, val in data_resumed.batch_stats["m2"].items():
+            assert np.allclose(val, data_loaded.batch_stats["m2"][key])
+        # The checkpoints are ignored once a constant of the model changes.
+        sim.model.constants.kBT = 2 * sim.model.constants.kBT
+        t_inds.clear()
+        serial_driver(sim)
+        assert t_inds[0] == 0
+        assert len(t_inds) == 2 * len(sim.settings.t_update_n)
+    for key, val in data_reference.data_dict.items():
+        if isinstance(val, np.ndarray):
+            assert np.allclose(val, data_resumed.data_dict[key])
+            assert np.allclose(val, data_loaded.data_dict[key])
+    return
+
+
+def test_convergence_driver():
+    """
+    This test checks that the convergence driver stops once the target
+    standard error is reached and that the standard error estimated from the
+    batch statistics agrees with the spread of the batch averages.
+    """
+    import numpy as np
+    from qclab import Simulation, Data  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        convergence_driver,
+        ThreadExecutor,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 400
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+
+    # Compare the standard error with the spread of the batch averages.
+    batch_averages = []
+    for n in range(8):
+        sim.settings.num_trajs = 10
+        data_batch = serial_driver(sim, seeds=np.arange(10 * n, 10 * (n + 1)))
+        batch_averages.append(data_batch.data_dict["classical_energy"])
+    data_serial = serial_driver(sim, seeds=np.arange(80))
+    expected_error = np.std(batch_averages, axis=0, ddof=1) / np.sqrt(8)
+    assert np.allclose(data_serial.standard_error("classical_energy"), expected_error)
+
+    sim.settings.num_trajs = 400
+    target_error = 2 * np.max(expected_error)
+    data_converged = convergence_driver(
+        sim, {"classical_energy": target_error}, executor=ThreadExecutor(num_tasks=2)
+    )
+    num_trajs = len(data_converged.data_dict["seed"])
+    assert num_trajs < 400
+    assert np.max(data_converged.standard_error("classical_energy")) <= target_error
+    assert np.all(data_converged.data_dict["seed"] == np.arange(num_trajs))
+    data_serial = serial_driver(sim, seeds=np.arange(num_trajs))
+    for key, val in data_serial.data_dict.items():
+        if isinstance(val, np.ndarray):
+            assert np.allclose(val, data_converged.data_dict[key])
+    return
+
+
+def test_auto_batch_size():
+    """
+    This test checks that the batch size selected automatically fits the
+    memory budget, respects deterministic surface hopping, and gives the same
+    results as a fixed batch size.
+    """
+    import os
+    import tempfile
+    import numpy as np
+    from qclab import Simulation, Data  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField, FewestSwitchesSurfaceHopping
+    from qclab.dynamics import serial_driver, auto_batch_size
+    from qclab.utils import DISABLE_H5PY
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 1000
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 5
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = FewestSwitchesSurfaceHopping({"fssh_deterministic": True})
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    sim.initialize_timesteps()
+    batch_sizes = [
+        auto_batch_size(sim, memory_budget=memory_budget)
+        for memory_budget in [1e6, 1e7]
+    ]
+    assert batch_sizes[0] < batch_sizes[1]
+    assert all(batch_size % 2 == 0 for batch_size in batch_sizes)
+    # The batch size is limited by the number of trajectories of each task.
+    assert auto_batch_size(sim, num_trajs=64, num_tasks=4, memory_budget=1e9) == 16
+
+    sim.algorithm = MeanField()
+    sim.settings.num_trajs = 40
+    data_serial = serial_driver(sim)
+    sim.settings.batch_size = "auto"
+    data_auto = serial_driver(sim)
+    assert data_auto.batch_size == sim.settings.batch_size == 40
+    for key, val in data_serial.data_dict.items():
+        if isinstance(val, np.ndarray):
+            assert np.allclose(val, data_auto.data_dict[key])
+    # The selected batch size is saved with the data.
+    with tempfile.TemporaryDirectory() as data_dir:
+        for filename, disable_h5py in [("data.h5", DISABLE_H5PY), ("data.npz", True)]:
+            path = os.path.join(data_dir, filename)
+            data_auto.save(path, disable_h5py=disable_h5py)
+            assert Data().load(path, disable_h5py=disable_h5py).batch_size == 40
+    return
+
+
+def test_batch_retries():
+    """
+    This test checks that failed batches are retried, that batches which keep
+    failing are skipped with their seeds recorded, and that running only the
+    failed seeds again completes the simulation.
+    """
+    import numpy as np
+    import pytest
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_threads,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 40
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_reference = serial_driver(sim)
+
+    failures = {}
+
+    def fail(sim, state, parameters):
+        # Fail the second batch twice and the third batch every time.
+        if sim.t_ind == 10 and state["seed"][0] in max_failures:
+            seed = state["seed"][0]
+            failures[seed] = failures.get(seed, 0) + 1
+            if failures[seed] <= max_failures[seed]:
+                raise ValueError("Batch failed.")
+        return state, parameters
+
+    sim.algorithm.update_recipe.append(fail)
+    max_failures = {10: 1}
+    with pytest.raises(ValueError):
+        serial_driver(sim)
+
+    failures.clear()
+    max_failures = {10: 2, 20: np.inf}
+    sim.settings.batch_retries = 2
+    data = parallel_driver_threads(sim, num_tasks=2)
+    assert failures == {10: 3, 20: 3}
+    assert np.all(data.failed_seeds == np.arange(20, 30))
+    assert np.all(
+        data.data_dict["seed"] == np.concatenate((np.arange(20), np.arange(30, 40)))
+    )
+
+    max_failures = {}
+    data = serial_driver(sim, seeds=data.failed_seeds, data=data)
+    assert len(data.failed_seeds) == 0
+    for key, val in data_reference.data_dict.items():
+        if key == "seed":
+            assert np.all(np.sort(val) == np.sort(data.data_dict[key]))
+        elif isinstance(val, np.ndarray):
+            assert np.allclose(val, data.data_dict[key])
+    return
+
+
+def test_sweep_driver():
+    """
+    This test checks that the sweep driver gives the same results for each
+    parameter point as separate simulations, both when the points are packed
+    into the same batches and when they are run one after the other.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import FewestSwitchesSurfaceHopping  # import algorithm class
+    from qclab.dynamics import serial_driver, sweep_driver, ThreadExecutor
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 20
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.algorithm = FewestSwitchesSurfaceHopping({"fssh_deterministic": True})
+    sim.initial_state["wf_db"] = np.array([1, 0], dtype=complex)
+    # Packed sweep over constants of the vectorized ingredients.
+    constants_list = [{"kBT": 0.5, "V": 0.3}, {"kBT": 1.0, "l_reorg": 0.05}, {"E": 0.2}]
+    sim.model = SpinBoson()
+    sim.settings.batch_size = 30
+    data_list = sweep_driver(sim, constants_list, executor=ThreadExecutor(num_tasks=2))
+    # Sweeping the bath frequencies changes the classical coordinates, so the
+    # points are run one after the other.
+    constants_list_unpacked = [{"W": 0.1}, {"W": 0.2}]
+    sim.settings.batch_size = 10
+    data_list_unpacked = sweep_driver(sim, constants_list_unpacked)
+    for constants, data in zip(
+        constants_list + constants_list_unpacked, data_list + data_list_unpacked
+    ):
+        sim.model = SpinBoson(constants)
+        data_serial = serial_driver(sim)
+        for key, val in data_serial.data_dict.items():
+            assert np.allclose(val, data.data_dict[key])
+        assert np.allclose(
+            data_serial.standard_error("classical_energy"),
+            data.standard_error("classical_energy"),
+        )
+    return
+
+
+def test_progress_reporting():
+    """
+    This test checks that the progress of a parallel simulation is reported
+    to a callback after each chunk of batches and that the busy time of every
+    worker is collected.
+    """
+    import contextlib
+    import io
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import serial_driver, parallel_driver_threads
+    from qclab.dynamics import executor_driver, ThreadExecutor
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 40
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    progress_list = []
+    data = executor_driver(
+        sim, ThreadExecutor(num_tasks=2), progress_callback=progress_list.append
+    )
+    assert len(progress_list) == 4
+    assert [progress["num_trajs_done"] for progress in progress_list] == [
+        10,
+        20,
+        30,
+        40,
+    ]
+    progress = progress_list[-1]
+    assert progress["num_trajs"] == 40
+    assert progress["eta"] == 0
+    assert progress["traj_steps_per_second"] > 0
+    assert 0 < len(progress["utilization"]) <= 2
+    assert all(0 < val <= 1 for val in progress["utilization"].values())
+    assert set(data.worker_times) == set(progress["utilization"])
+    # The progress bar is shown by the driver instead of each batch.
+    sim.settings.progress_bar = True
+    num_steps = len(sim.settings.t_update_n)
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        data_bar = parallel_driver_threads(sim, num_tasks=2)
+    assert np.allclose(
+        data_bar.data_dict["classical_energy"], data.data_dict["classical_energy"]
+    )
+    assert "40/40" in stderr.getvalue()
+    assert f"{num_steps}/{num_steps}" not in stderr.getvalue()
+    # A simulation with a single batch also shows the progress of its time steps.
+    sim.settings.num_trajs = 10
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        serial_driver(sim)
+    assert f"{num_steps}/{num_steps}" in stderr.getvalue()
+    return
+
+
 if __name__ == "__main__":
     test_drivers_spinboson()
     test_incommensurate_batch_size_serial()
     test_incommensurate_batch_size_multiprocessing()
+    test_multiprocessing_chunk_size()
+    test_multiprocessing_worker_pool()
+    test_worker_pool_replaced_worker()
+    test_worker_pool_failed_run()
+    test_thread_budget()
+    test_multiprocessing_shared_memory()
+    test_threads()
+    test_custom_executor()
+    test_run_async()
+    test_checkpoint_resume()
+    test_convergence_driver()
+    test_auto_batch_size()
+    test_batch_retries()
+    test_sweep_driver()
+    test_progress_reporting()
@@ -7,7 +7,7 @@ import pytest
 import os
 import time
 import numpy as np
-from qclab import Simulation, Data
+from qclab import Simulation, Data, tasks
 from qclab.models import (
     SpinBoson,
     HolsteinLattice,
@@ -315,6 +315,38 @@ def test_dh_qc_dzc_finite_differences():
     return
 
 
+def test_dh_qc_dzc_finite_differences_learned_pattern():
+    """
+    Tests the output when using finite differences to compute dh_qc_dzc and
+    reusing the positions of its nonzero elements found at the first time step.
+    """
+    reference_folder = os.path.join(os.path.dirname(__file__), "reference/")
+    for model_class in [TullyProblemOne, TullyProblemTwo, TullyProblemThree]:
+        for algorithm_class in [MeanField, FewestSwitchesSurfaceHopping]:
+            print(f"Testing {model_class.__name__} with {algorithm_class.__name__}")
+            sim = Simulation(model_sim_settings[model_class.__name__])
+            model_name = model_class.__name__
+            algorithm_name = algorithm_class.__name__
+            sim.model = model_class(model_settings[model_class.__name__])
+            sim.model.ingredients.append(("dh_qc_dzc", None))
+            sim.model.constants.dh_qc_dzc_finite_difference_learn_pattern = True
+            sim.model.initialize_constants()
+            sim.algorithm = algorithm_class()
+            sim.initial_state["wf_db"] = np.zeros(
+                sim.model.constants.num_quantum_states, dtype=complex
+            )
+            sim.initial_state["wf_db"][0] = 1j
+            data = serial_driver(sim)
+            data_correct = Data().load(
+                os.path.join(reference_folder, f"{model_name}_{algorithm_name}.h5")
+            )
+            for key, val in data.data_dict.items():
+                np.testing.assert_allclose(
+                    val, data_correct.data_dict[key], rtol=1e-5, atol=1e-5
+                )
+    return
+
+
 def test_dh_c_dzc_finite_differences():
     """
     Tests the output when using finite differences to compute dh_c_dzc.
@@ -363,6 +395,343 @@ def test_dh_c_dzc_finite_differences():
     return
 
 
+def test_output_repeated_runs():
+    """
+    Tests that running the same simulation object twice gives the same output,
+    so that reinitializing the model constants at the start of each run does
+    not change them.
+    """
+    reference_folder = os.path.join(os.path.dirname(__file__), "reference/")
+    for model_class in [TullyProblemOne, TullyProblemTwo, TullyProblemThree]:
+        print(f"Testing {model_class.__name__} with MeanField")
+        sim = Simulation(model_sim_settings[model_class.__name__])
+        sim.model = model_class(model_settings[model_class.__name__])
+        sim.algorithm = MeanField()
+        sim.model.initialize_constants()
+        sim.initial_state["wf_db"] = np.zeros(
+            sim.model.constants.num_quantum_states, dtype=complex
+        )
+        sim.initial_state["wf_db"][0] = 1j
+        serial_driver(sim)
+        data = serial_driver(sim)
+        assert np.shape(sim.model.constants.init_position) == (1,)
+        assert np.shape(sim.model.constants.init_momentum) == (1,)
+        data_correct = Data().load(
+            os.path.join(reference_folder, f"{model_class.__name__}_MeanField.h5")
+        )
+        for key, val in data.data_dict.items():
+            np.testing.assert_allclose(
+                val, data_correct.data_dict[key], rtol=1e-5, atol=1e-8
+            )
+    return
+
+
+def test_output_compiled_dynamics():
+    """
+    Tests the output of the mean-field algorithm when the update steps between
+    collect steps are carried out by the compiled dynamics engine.
+    """
+    reference_folder = os.path.join(os.path.dirname(__file__), "reference/")
+    for model_class in [SpinBoson, HolsteinLattice, FMOComplex]:
+        print(f"Testing {model_class.__name__} with compiled MeanField")
+        sim = Simulation(model_sim_settings[model_class.__name__])
+        sim.settings.compiled_dynamics = True
+        sim.model = model_class(model_settings[model_class.__name__])
+        sim.algorithm = MeanField()
+        sim.model.initialize_constants()
+        sim.initial_state["wf_db"] = np.zeros(
+            sim.model.constants.num_quantum_states, dtype=complex
+        )
+        sim.initial_state["wf_db"][0] = 1j
+        data = serial_driver(sim)
+        assert "Using compiled dynamics." in data.log
+        data_correct = Data().load(
+            os.path.join(reference_folder, f"{model_class.__name__}_MeanField.h5")
+        )
+        for key, val in data.data_dict.items():
+            np.testing.assert_allclose(
+                val, data_correct.data_dict[key], rtol=1e-5, atol=1e-8
+            )
+    return
+
+
+def test_state_buffers_reused():
+    """
+    Tests that the update recipes write their outputs into the arrays already
+    in the state object instead of allocating new arrays at every time step.
+    """
+    buffer_names = {
+        "MeanField": [
+            "h_q_tot",
+            "z_1",
+            "z_rk4_k1",
+            "quantum_classical_force",
+            "wf_db",
+        ],
+        "FewestSwitchesSurfaceHopping": [
+            "h_q_tot",
+            "z_1",
+            "z_rk4_k1",
+            "quantum_classical_force",
+            "wf_db",
+            "eigvals",
+            "eigvecs",
+            "eigvecs_previous",
+        ],
+    }
+    for algorithm_class in [MeanField, FewestSwitchesSurfaceHopping]:
+        print(f"Testing state buffers of {algorithm_class.__name__}")
+        sim = Simulation(model_sim_settings["SpinBoson"])
+        sim.model = SpinBoson(model_settings["SpinBoson"])
+        sim.algorithm = algorithm_class()
+        sim.model.initialize_constants()
+        sim.initial_state["wf_db"] = np.zeros(
+            sim.model.constants.num_quantum_states, dtype=complex
+        )
+        sim.initial_state["wf_db"][0] = 1j
+        sim.initialize_timesteps()
+        state = {"seed": np.arange(sim.settings.batch_size)}
+        parameters = {}
+        sim.t_ind = 0
+        state, parameters = sim.algorithm.execute_recipe(
+            sim, state, parameters, sim.algorithm.initialization_recipe
+        )
+        state, parameters = sim.algorithm.execute_recipe(
+            sim, state, parameters, sim.algorithm.update_recipe
+        )
+        buffers = {name: state[name] for name in buffer_names[algorithm_class.__name__]}
+        sim.t_ind = 1
+        state, parameters = sim.algorithm.execute_recipe(
+            sim, state, parameters, sim.algorithm.update_recipe
+        )
+        for name, buffer in buffers.items():
+            assert state[name] is buffer, name
+    return
+
+
+def test_diagonalize_matrix_2x2():
+    """
+    Tests that batches of 2x2 matrices, which are diagonalized in closed form,
+    have the same eigenvalues as with np.linalg.eigh and orthonormal
+    eigenvectors.
+    """
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(100, 2, 2)) + 1j * rng.normal(size=(100, 2, 2))
+    matrix = matrix + np.conj(np.swapaxes(matrix, -1, -2))
+    # Diagonal, degenerate and nearly degenerate matrices.
+    matrix[0] = np.diag([1.0, 2.0])
+    matrix[1] = np.diag([2.0, 1.0])
+    matrix[2] = np.eye(2)
+    matrix[3] = [[1.0, 1e-12j], [-1e-12j, 1.0]]
+    matrix[4] = [[1e6, 1e-9], [1e-9, -1e6]]
+    state = {"h_q_tot": matrix}
+    state, _ = tasks.diagonalize_matrix(
+        None,
+        state,
+        {},
+        matrix_name="h_q_tot",
+        eigvals_name="eigvals",
+        eigvecs_name="eigvecs",
+    )
+    eigvals, eigvecs = state["eigvals"], state["eigvecs"]
+    eigvals_correct = np.linalg.eigvalsh(matrix)
+    assert np.allclose(eigvals, eigvals_correct, rtol=1e-12, atol=1e-12)
+    assert np.allclose(
+        np.matmul(matrix, eigvecs), eigvecs * eigvals[:, None, :], atol=1e-9
+    )
+    assert np.allclose(
+        np.matmul(np.conj(np.swapaxes(eigvecs, -1, -2)), eigvecs),
+        np.eye(2)[None],
+        atol=1e-12,
+    )
+    assert np.allclose(eigvecs[2], np.eye(2))
+    return
+
+
+def test_output_fssh_eigvecs_tracking():
+    """
+    Tests that tracking the eigenvectors from the previous time step in FSSH
+    reproduces the reference data.
+    """
+    reference_folder = os.path.join(os.path.dirname(__file__), "reference/")
+    algorithm_name = "FewestSwitchesSurfaceHopping"
+    for model_class in [HolsteinLattice, HolsteinLatticeReciprocalSpace, FMOComplex]:
+        print(f"Testing {model_class.__name__} with eigenvector tracking")
+        model_name = model_class.__name__
+        sim = Simulation(model_sim_settings[model_name])
+        sim.model = model_class(model_settings[model_name])
+        sim.model.initialize_constants()
+        sim.algorithm = FewestSwitchesSurfaceHopping({"track_eigvecs": True})
+        sim.initial_state["wf_db"] = np.zeros(
+            sim.model.constants.num_quantum_states, dtype=complex
+        )
+        sim.initial_state["wf_db"][0] = 1j
+        data = serial_driver(sim)
+        data_correct = Data().load(
+            os.path.join(reference_folder, f"{model_name}_{algorithm_name}.h5")
+        )
+        for key, val in data.data_dict.items():
+            np.testing.assert_allclose(
+                val, data_correct.data_dict[key], rtol=1e-5, atol=1e-8
+            )
+    return
+
+
+def test_diagonalize_matrix_eigvecs_tracking():
+    """
+    Tests that tracking the eigenvectors from the previous eigenvectors gives
+    the eigenvectors of np.linalg.eigh with the sign convention of the
+    "sign_overlap" gauge fixing, also for trajectories that fall back to
+    np.linalg.eigh.
+    """
+    rng = np.random.default_rng(0)
+    batch_size, num_states = 20, 6
+    sim = Simulation()
+    for dtype in [float, complex]:
+        matrix = rng.normal(size=(batch_size, num_states, num_states)).astype(dtype)
+        if dtype is complex:
+            matrix += 1j * rng.normal(size=(batch_size, num_states, num_states))
+        matrix = matrix + np.conj(np.swapaxes(matrix, -1, -2))
+        matrix += 5 * np.diag(np.arange(num_states))
+        _, eigvecs_previous = np.linalg.eigh(matrix)
+        eigvecs_previous = eigvecs_previous.astype(complex)
+        # Swapping two previous eigenvectors of the first trajectory makes its
+        # eigenvalues come out of order, so that it falls back to eigh.
+        eigvecs_previous[0] = eigvecs_previous[0][:, [1, 0, 2, 3, 4, 5]]
+        delta = 0.01 * rng.normal(size=matrix.shape).astype(dtype)
+        matrix = (matrix + delta + np.conj(np.swapaxes(delta, -1, -2))).astype(complex)
+        state = {"matrix": matrix, "eigvecs_previous": eigvecs_previous}
+        state, _ = tasks.diagonalize_matrix(
+            sim,
+            state,
+            {},
+            matrix_name="matrix",
+            eigvals_name="eigvals",
+            eigvecs_name="eigvecs",
+            eigvecs_previous_name="eigvecs_previous",
+            track_eigvecs=True,
+        )
+        assert not state["_eigvecs_tracked"][0] and np.all(
+            state["_eigvecs_tracked"][1:]
+        )
+        eigvals_correct, eigvecs_correct = np.linalg.eigh(matrix)
+        np.testing.assert_allclose(state["eigvals"], eigvals_correct, atol=1e-12)
+        overlap = np.sum(np.conj(eigvecs_previous) * state["eigvecs"], axis=-2)
+        assert np.all(np.real(overlap) > 0)
+        np.testing.assert_allclose(
+            np.matmul(matrix, state["eigvecs"]),
+            state["eigvecs"] * state["eigvals"][:, None, :],
+            atol=1e-12,
+        )
+        if dtype is float:
+            overlap = np.sum(np.conj(eigvecs_previous) * eigvecs_correct, axis=-2)
+            eigvecs_correct *= np.sign(np.real(overlap))[:, None, :]
+            np.testing.assert_allclose(state["eigvecs"], eigvecs_correct, atol=1e-12)
+    return
+
+
+def test_update_wf_db_propagator_prop_db():
+    """
+    Tests that update_wf_db_propagator still stores the propagator in the
+    diabatic basis when prop_db_name is given or the store_prop_db setting of
+    the algorithm is True, and that it propagates the wavefunction in the same
+    way.
+    """
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(10, 5, 5)) + 1j * rng.normal(size=(10, 5, 5))
+    matrix = matrix + np.conj(np.swapaxes(matrix, -1, -2))
+    eigvals, eigvecs = np.linalg.eigh(matrix)
+    wf_db = rng.normal(size=(10, 5)) + 1j * rng.normal(size=(10, 5))
+    sim = Simulation({"dt_update": 0.01})
+    state = {"wf_db": wf_db.copy(), "eigvals": eigvals, "eigvecs": eigvecs}
+    state, _ = tasks.update_wf_db_propagator(sim, state, {}, prop_db_name="prop_db")
+    prop_db_correct = np.matmul(
+        eigvecs * np.exp(-1j * eigvals * sim.settings.dt_update)[:, None, :],
+        np.conj(np.swapaxes(eigvecs, -1, -2)),
+    )
+    np.testing.assert_allclose(state["prop_db"], prop_db_correct, atol=1e-12)
+    np.testing.assert_allclose(
+        state["wf_db"], np.einsum("tij,tj->ti", prop_db_correct, wf_db), atol=1e-12
+    )
+    state, _ = tasks.update_wf_db_propagator(
+        sim, {"wf_db": wf_db.copy(), "eigvals": eigvals, "eigvecs": eigvecs}, {}
+    )
+    assert "prop_db" not in state
+    # The FSSH algorithm stores the propagator if its store_prop_db setting is
+    # True.
+    sim.algorithm = FewestSwitchesSurfaceHopping({"store_prop_db": True})
+    state, _ = tasks.update_wf_db_propagator(
+        sim, {"wf_db": wf_db.copy(), "eigvals": eigvals, "eigvecs": eigvecs}, {}
+    )
+    np.testing.assert_allclose(state["prop_db"], prop_db_correct, atol=1e-12)
+    return
+
+
+def test_compile_recipe():
+    """
+    Tests that compile_recipe replaces the built-in tasks by their bound
+    functions, keeps other tasks, rejects tasks that are not callable, and that
+    the bound tasks give the same result as the tasks themselves.
+    """
+    from functools import partial
+
+    sim = Simulation(model_sim_settings["SpinBoson"])
+    sim.model = SpinBoson(model_settings["SpinBoson"])
+    sim.algorithm = MeanField()
+    sim.model.initialize_constants()
+
+    def custom_task(sim, state, parameters):
+        return state, parameters
+
+    task = partial(tasks.update_classical_force, z_name="z")
+    recipe = sim.algorithm.compile_recipe(sim, [task, custom_task])
+    assert isinstance(recipe, tuple)
+    assert recipe[0] is not task and not isinstance(recipe[0], partial)
+    assert recipe[1] is custom_task
+    rng = np.random.default_rng(0)
+    shape = (4, sim.model.constants.num_classical_coordinates)
+    z = rng.normal(size=shape) + 1j * rng.normal(size=shape)
+    state_task, _ = task(sim, {"z": z.copy()}, {})
+    state_bound, _ = recipe[0](sim, {"z": z.copy()}, {})
+    np.testing.assert_allclose(
+        state_bound["classical_force"], state_task["classical_force"]
+    )
+    with pytest.raises(TypeError):
+        sim.algorithm.compile_recipe(sim, [task, "update_classical_force"])
+    return
+
+
+def test_update_dh_qc_dzc_batch_invariant():
+    """
+    Tests that the gradient of a model that marks it as the same in every
+    trajectory is stored once for the batch, and that the cached indices of
+    batched_sparse_inds are reused only for the same pattern and shape.
+    """
+    from qclab import functions
+
+    sim = Simulation(model_sim_settings["HolsteinLattice"])
+    sim.model = HolsteinLattice(model_settings["HolsteinLattice"])
+    sim.model.initialize_constants()
+    sim.algorithm = MeanField()
+    rng = np.random.default_rng(0)
+    shape = (8, sim.model.constants.num_classical_coordinates)
+    z = rng.normal(size=shape) + 1j * rng.normal(size=shape)
+    state, _ = tasks.update_dh_qc_dzc(sim, {"z": z}, {})
+    dh_qc_dzc = state["dh_qc_dzc"]
+    assert isinstance(dh_qc_dzc, functions.BatchInvariantSparseGradient)
+    dh_qc_dzc_correct = sim.model.get("dh_qc_dzc")[0](sim.model, {}, z=z)
+    for val, val_correct in zip(dh_qc_dzc.to_batched(), dh_qc_dzc_correct):
+        np.testing.assert_equal(val, val_correct)
+    inds = functions.batched_sparse_inds(((0, 1), (0, 1), (0, 1)), (4, 2, 2, 2))
+    assert inds is functions.batched_sparse_inds(
+        (np.arange(2), np.arange(2), np.arange(2)), (4, 2, 2, 2)
+    )
+    inds_other = functions.batched_sparse_inds(((0, 1), (0, 1), (1, 0)), (4, 2, 2, 2))
+    np.testing.assert_equal(inds_other[3], [1, 0, 1, 0, 1, 0, 1, 0])
+    assert not inds[0].flags.writeable
+    return
+
+
 if __name__ == "__main__":
     st = time.time()
     test_output_serial()
@@ -386,4 +755,32 @@ if __name__ == "__main__":
     test_dh_c_dzc_finite_differences()
     et7 = time.time()
     print(f"dh_c_dzc finite difference tests completed in {et7 - et6:.2f} seconds.")
-    print(f"All tests completed in {et7 - st:.2f} seconds.")
+    test_output_repeated_runs()
+    et8 = time.time()
+    print(f"Repeated run tests completed in {et8 - et7:.2f} seconds.")
+    test_output_compiled_dynamics()
+    et9 = time.time()
+    print(f"Compiled dynamics tests completed in {et9 - et8:.2f} seconds.")
+    test_state_buffers_reused()
+    et10 = time.time()
+    print(f"State buffer tests completed in {et10 - et9:.2f} seconds.")
+    test_dh_qc_dzc_finite_differences_learned_pattern()
+    et11 = time.time()
+    print(f"dh_qc_dzc learned pattern tests completed in {et11 - et10:.2f} seconds.")
+    test_diagonalize_matrix_2x2()
+    et12 = time.time()
+    print(f"2x2 diagonalization tests completed in {et12 - et11:.2f} seconds.")
+    test_output_fssh_eigvecs_tracking()
+    test_diagonalize_matrix_eigvecs_tracking()
+    et13 = time.time()
+    print(f"Eigenvector tracking tests completed in {et13 - et12:.2f} seconds.")
+    test_update_wf_db_propagator_prop_db()
+    et14 = time.time()
+    print(f"Propagator tests completed in {et14 - et13:.2f} seconds.")
+    test_compile_recipe()
+    et15 = time.time()
+    print(f"Recipe compilation tests completed in {et15 - et14:.2f} seconds.")
+    test_update_dh_qc_dzc_batch_invariant()
+    et16 = time.time()
+    print(f"Batch-invariant gradient tests completed in {et16 - et15:.2f} seconds.")
+    print(f"All tests completed in {et16 - st:.2f} seconds.")